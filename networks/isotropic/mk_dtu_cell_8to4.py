@@ -6,16 +6,21 @@ import logging
 import numpy as np
 
 
-def make_net(unet, labels, added_steps, loss_name="loss_total", mode="train"):
+def make_net(
+    unet, labels, added_steps, loss_name="loss_total", mode="train", batch_size=1
+):
     names = dict()
     input_size = unet.min_input_shape
     input_size_actual = (input_size + added_steps * unet.step_valid_shape).astype(
         np.int
     )
 
-    raw = tf.placeholder(tf.float32, shape=tuple(input_size_actual))
+    # inputs, outputs and targets get a leading batch dimension for batch_size > 1 only
+    batch_shape = (batch_size,) if batch_size > 1 else ()
+    names["batch_size"] = batch_size
+    raw = tf.placeholder(tf.float32, shape=batch_shape + tuple(input_size_actual))
     names["raw"] = raw.name
-    raw_bc = tf.reshape(raw, (1, 1) + tuple(input_size_actual))
+    raw_bc = tf.reshape(raw, (batch_size, 1) + tuple(input_size_actual))
     last_fmap, fov, anisotropy = unet.build(raw_bc)
     last_fmap_up, anisotropy = ops3d.upsample(
         last_fmap,
@@ -47,10 +52,11 @@ def make_net(unet, labels, added_steps, loss_name="loss_total", mode="train"):
     output_shape_c = output_shape_bc[1:]  # strip the batch dimension
     output_shape = output_shape_c[1:]
 
-    dist_c = tf.reshape(dist_bc, output_shape_c)
+    dist_c = tf.reshape(dist_bc, batch_shape + tuple(output_shape_c))
     names["dist"] = dist_c.name
-    network_outputs = tf.unstack(dist_c, len(labels), axis=0)
+    network_outputs = tf.unstack(dist_c, len(labels), axis=len(batch_shape))
     if mode.lower() == "train" or mode.lower() == "training":
+        target_shape = batch_shape + tuple(output_shape)
         # mask = tf.placeholder(tf.float32, shape=output_shape)
         # ribo_mask = tf.placeholder(tf.float32, shape=output_shape)
 
@@ -59,9 +65,9 @@ def make_net(unet, labels, added_steps, loss_name="loss_total", mode="train"):
         cw = []
         masks = []
         for l in labels:
-            masks.append(tf.placeholder(tf.float32, shape=output_shape))
-            gt.append(tf.placeholder(tf.float32, shape=output_shape))
-            w.append(tf.placeholder(tf.float32, shape=output_shape))
+            masks.append(tf.placeholder(tf.float32, shape=target_shape))
+            gt.append(tf.placeholder(tf.float32, shape=target_shape))
+            w.append(tf.placeholder(tf.float32, shape=target_shape))
             cw.append(l.class_weight)
 
         lb = []
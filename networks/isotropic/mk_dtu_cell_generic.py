@@ -6,11 +6,14 @@ from utils.label import *
 import logging
 
 
-def make_net(labels, input_shape, loss_name="loss_total", mode="train"):
+def make_net(labels, input_shape, loss_name="loss_total", mode="train", batch_size=1):
     names = dict()
-    raw = tf.placeholder(tf.float32, shape=input_shape)
+    # inputs, outputs and targets get a leading batch dimension for batch_size > 1 only
+    batch_shape = (batch_size,) if batch_size > 1 else ()
+    names["batch_size"] = batch_size
+    raw = tf.placeholder(tf.float32, shape=batch_shape + input_shape)
     names["raw"] = raw.name
-    raw_bc = tf.reshape(raw, (1, 1) + input_shape)
+    raw_bc = tf.reshape(raw, (batch_size, 1) + input_shape)
 
     last_fmap, fov, anisotropy = unet.unet(
         raw_bc,
@@ -45,10 +48,11 @@ def make_net(labels, input_shape, loss_name="loss_total", mode="train"):
     output_shape_c = output_shape_bc[1:]  # strip the batch dimension
     output_shape = output_shape_c[1:]
 
-    dist_c = tf.reshape(dist_bc, output_shape_c)
+    dist_c = tf.reshape(dist_bc, batch_shape + tuple(output_shape_c))
     names["dist"] = dist_c.name
-    network_outputs = tf.unstack(dist_c, len(labels), axis=0)
+    network_outputs = tf.unstack(dist_c, len(labels), axis=len(batch_shape))
     if mode.lower() == "train" or mode.lower() == "training":
+        target_shape = batch_shape + tuple(output_shape)
         # mask = tf.placeholder(tf.float32, shape=output_shape)
         # ribo_mask = tf.placeholder(tf.float32, shape=output_shape)
 
@@ -57,9 +61,9 @@ def make_net(labels, input_shape, loss_name="loss_total", mode="train"):
         cw = []
         masks = []
         for l in labels:
-            masks.append(tf.placeholder(tf.float32, shape=output_shape))
-            gt.append(tf.placeholder(tf.float32, shape=output_shape))
-            w.append(tf.placeholder(tf.float32, shape=output_shape))
+            masks.append(tf.placeholder(tf.float32, shape=target_shape))
+            gt.append(tf.placeholder(tf.float32, shape=target_shape))
+            w.append(tf.placeholder(tf.float32, shape=target_shape))
             cw.append(l.class_weight)
 
         lb = []
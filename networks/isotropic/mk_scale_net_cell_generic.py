@@ -4,7 +4,7 @@ import numpy as np
 import json
 
 
-def make_net(labels, added_steps, mode="train", loss_name="loss_total"):
+def make_net(labels, added_steps, mode="train", loss_name="loss_total", batch_size=1):
     unet0 = scale_net.SerialUNet(
         [12, 12 * 6, 12 * 6 ** 2],
         [48, 12 * 6, 12 * 6 ** 2],
@@ -28,9 +28,12 @@ def make_net(labels, added_steps, mode="train", loss_name="loss_total"):
     scnet = scale_net.ScaleNet([unet0, unet1], input_size_actual, name="scnet_" + mode)
     inputs = []
     names = dict()
+    # inputs, outputs and targets get a leading batch dimension for batch_size > 1 only
+    batch_shape = (batch_size,) if batch_size > 1 else ()
+    names["batch_size"] = batch_size
     for k, (inp, vs) in enumerate(zip(scnet.input_shapes, scnet.voxel_sizes)):
-        raw = tf.placeholder(tf.float32, shape=inp)
-        raw_bc = tf.reshape(raw, (1, 1) + tuple(inp.astype(np.int)))
+        raw = tf.placeholder(tf.float32, shape=batch_shape + tuple(inp.astype(np.int)))
+        raw_bc = tf.reshape(raw, (batch_size, 1) + tuple(inp.astype(np.int)))
         inputs.append(raw_bc)
         names["raw_{0:}".format(vs[0])] = raw.name
 
@@ -48,10 +51,11 @@ def make_net(labels, added_steps, mode="train", loss_name="loss_total"):
     output_shape_c = output_shape_bc[1:]
     output_shape = output_shape_c[1:]
 
-    dist_c = tf.reshape(dist_bc, output_shape_c)
+    dist_c = tf.reshape(dist_bc, batch_shape + tuple(output_shape_c))
     names["dist"] = dist_c.name
-    network_outputs = tf.unstack(dist_c, len(labels), axis=0)
+    network_outputs = tf.unstack(dist_c, len(labels), axis=len(batch_shape))
     if mode.lower() == "train" or mode.lower() == "training":
+        target_shape = batch_shape + tuple(output_shape)
         # mask = tf.placeholder(tf.float32, shape=output_shape)
         # names['mask'] = mask.name
         # ribo_mask = tf.placeholder(tf.float32, shape=output_shape)
@@ -61,9 +65,9 @@ def make_net(labels, added_steps, mode="train", loss_name="loss_total"):
         cw = []
         masks = []
         for l in labels:
-            masks.append(tf.placeholder(tf.float32, shape=output_shape))
-            gt.append(tf.placeholder(tf.float32, shape=output_shape))
-            w.append(tf.placeholder(tf.float32, shape=output_shape))
+            masks.append(tf.placeholder(tf.float32, shape=target_shape))
+            gt.append(tf.placeholder(tf.float32, shape=target_shape))
+            w.append(tf.placeholder(tf.float32, shape=target_shape))
             cw.append(l.class_weight)
         lb = []
         lub = []
@@ -131,7 +135,12 @@ def make_net(labels, added_steps, mode="train", loss_name="loss_total"):
 
 
 def make_any_scale_net(
-    serial_unet_list, labels, added_steps, mode="train", loss_name="loss_total"
+    serial_unet_list,
+    labels,
+    added_steps,
+    mode="train",
+    loss_name="loss_total",
+    batch_size=1,
 ):
     # input_voxel_size=(
     # 36,36,36))
@@ -142,9 +151,12 @@ def make_any_scale_net(
     )
     inputs = []
     names = dict()
+    # inputs, outputs and targets get a leading batch dimension for batch_size > 1 only
+    batch_shape = (batch_size,) if batch_size > 1 else ()
+    names["batch_size"] = batch_size
     for k, (inp, vs) in enumerate(zip(scnet.input_shapes, scnet.voxel_sizes)):
-        raw = tf.placeholder(tf.float32, shape=inp)
-        raw_bc = tf.reshape(raw, (1, 1) + tuple(inp.astype(np.int)))
+        raw = tf.placeholder(tf.float32, shape=batch_shape + tuple(inp.astype(np.int)))
+        raw_bc = tf.reshape(raw, (batch_size, 1) + tuple(inp.astype(np.int)))
         inputs.append(raw_bc)
         names["raw_{0:}".format(vs[0])] = raw.name
 
@@ -162,10 +174,11 @@ def make_any_scale_net(
     output_shape_c = output_shape_bc[1:]
     output_shape = output_shape_c[1:]
 
-    dist_c = tf.reshape(dist_bc, output_shape_c)
+    dist_c = tf.reshape(dist_bc, batch_shape + tuple(output_shape_c))
     names["dist"] = dist_c.name
-    network_outputs = tf.unstack(dist_c, len(labels), axis=0)
+    network_outputs = tf.unstack(dist_c, len(labels), axis=len(batch_shape))
     if mode.lower() == "train" or mode.lower() == "training":
+        target_shape = batch_shape + tuple(output_shape)
         # mask = tf.placeholder(tf.float32, shape=output_shape)
         # names['mask'] = mask.name
         # ribo_mask = tf.placeholder(tf.float32, shape=output_shape)
@@ -175,9 +188,9 @@ def make_any_scale_net(
         cw = []
         masks = []
         for l in labels:
-            masks.append(tf.placeholder(tf.float32, shape=output_shape))
-            gt.append(tf.placeholder(tf.float32, shape=output_shape))
-            w.append(tf.placeholder(tf.float32, shape=output_shape))
+            masks.append(tf.placeholder(tf.float32, shape=target_shape))
+            gt.append(tf.placeholder(tf.float32, shape=target_shape))
+            w.append(tf.placeholder(tf.float32, shape=target_shape))
             cw.append(l.class_weight)
         lb = []
         lub = []
@@ -244,7 +257,9 @@ def make_any_scale_net(
     return scnet
 
 
-def make_mini_net(labels, added_steps, mode="train", loss_name="loss_total"):
+def make_mini_net(
+    labels, added_steps, mode="train", loss_name="loss_total", batch_size=1
+):
     unet0 = scale_net.SerialUNet(
         [12, 12 * 6],
         [48, 12 * 6],
@@ -269,9 +284,12 @@ def make_mini_net(labels, added_steps, mode="train", loss_name="loss_total"):
     scnet = scale_net.ScaleNet([unet0, unet1], input_size_actual, name="scnet_" + mode)
     inputs = []
     names = dict()
+    # inputs, outputs and targets get a leading batch dimension for batch_size > 1 only
+    batch_shape = (batch_size,) if batch_size > 1 else ()
+    names["batch_size"] = batch_size
     for k, (inp, vs) in enumerate(zip(scnet.input_shapes, scnet.voxel_sizes)):
-        raw = tf.placeholder(tf.float32, shape=inp)
-        raw_bc = tf.reshape(raw, (1, 1) + tuple(inp.astype(np.int)))
+        raw = tf.placeholder(tf.float32, shape=batch_shape + tuple(inp.astype(np.int)))
+        raw_bc = tf.reshape(raw, (batch_size, 1) + tuple(inp.astype(np.int)))
         inputs.append(raw_bc)
         names["raw_{0:}".format(vs[0])] = raw.name
 
@@ -289,10 +307,11 @@ def make_mini_net(labels, added_steps, mode="train", loss_name="loss_total"):
     output_shape_c = output_shape_bc[1:]
     output_shape = output_shape_c[1:]
 
-    dist_c = tf.reshape(dist_bc, output_shape_c)
+    dist_c = tf.reshape(dist_bc, batch_shape + tuple(output_shape_c))
     names["dist"] = dist_c.name
-    network_outputs = tf.unstack(dist_c, len(labels), axis=0)
+    network_outputs = tf.unstack(dist_c, len(labels), axis=len(batch_shape))
     if mode.lower() == "train" or mode.lower() == "training":
+        target_shape = batch_shape + tuple(output_shape)
         # mask = tf.placeholder(tf.float32, shape=output_shape)
         # names['mask'] = mask.name
         # ribo_mask = tf.placeholder(tf.float32, shape=output_shape)
@@ -302,9 +321,9 @@ def make_mini_net(labels, added_steps, mode="train", loss_name="loss_total"):
         cw = []
         masks = []
         for l in labels:
-            masks.append(tf.placeholder(tf.float32, shape=output_shape))
-            gt.append(tf.placeholder(tf.float32, shape=output_shape))
-            w.append(tf.placeholder(tf.float32, shape=output_shape))
+            masks.append(tf.placeholder(tf.float32, shape=target_shape))
+            gt.append(tf.placeholder(tf.float32, shape=target_shape))
+            w.append(tf.placeholder(tf.float32, shape=target_shape))
             cw.append(l.class_weight)
         lb = []
         lub = []
@@ -1,11 +1,17 @@
 import z5py
 import os
-import numpy as np
-import scipy.ndimage
 import logging
+from utils.blockwise_cc import label_volume
 
 
-def cc(filename_src, dataset_src, filename_tgt, dataset_tgt):
+def cc(
+    filename_src,
+    dataset_src,
+    filename_tgt,
+    dataset_tgt,
+    block_shape=None,
+    num_workers=1,
+):
     srcf = z5py.File(filename_src, use_zarr_format=False)
     if not os.path.exists(filename_tgt):
         os.makedirs(filename_tgt)
@@ -17,10 +23,12 @@ def cc(filename_src, dataset_src, filename_tgt, dataset_tgt):
         dtype="uint64",
         chunks=srcf[dataset_src].chunks,
     )
-    data = np.array(srcf[dataset_src][:])
-    tgt = np.ones(data.shape, dtype=np.uint64)
-    maxid = scipy.ndimage.label(data, output=tgt)
-    tgtf[dataset_tgt][:] = tgt.astype(np.uint64)
+    maxid = label_volume(
+        (filename_src, dataset_src),
+        (filename_tgt, dataset_tgt),
+        block_shape=block_shape,
+        num_workers=num_workers,
+    )
     if "offset" in srcf[dataset_src].attrs.keys():
         tgtf[dataset_tgt].attrs["offset"] = srcf[dataset_src].attrs["offset"]
     tgtf[dataset_tgt].attrs["max_id"] = maxid
@@ -1,13 +1,17 @@
 import z5py
 import os
-import numpy as np
-import scipy.ndimage
 import logging
-import scipy.ndimage
+from utils.blockwise_cc import label_volume
 
 
 def cc2(
-    filename_src, dataset_src_high_thr, dataset_src_low_thr, filename_tgt, dataset_tgt
+    filename_src,
+    dataset_src_high_thr,
+    dataset_src_low_thr,
+    filename_tgt,
+    dataset_tgt,
+    block_shape=None,
+    num_workers=1,
 ):
 
     srcf = z5py.File(filename_src, use_zarr_format=False)
@@ -26,17 +30,13 @@ def cc2(
         dtype="uint64",
         chunks=srcf[dataset_src_high_thr].chunks,
     )
-    data_high_thr = np.array(srcf[dataset_src_high_thr][:])
-    data_low_thr = np.array(srcf[dataset_src_low_thr][:])
-    tgt = np.ones(data_low_thr.shape, dtype=np.uint64)
-    maxid = scipy.ndimage.label(data_low_thr, output=tgt)
-    maxes = scipy.ndimage.maximum(data_high_thr, labels=tgt, index=range(1, maxid + 1))
-    maxes = np.array([0] + list(maxes))
-    factors = maxes[tgt]
-
-    tgt *= factors.astype(np.uint64)
-    maxid = scipy.ndimage.label(tgt, output=tgt)
-    tgtf[dataset_tgt][:] = tgt.astype(np.uint64)
+    maxid = label_volume(
+        (filename_src, dataset_src_low_thr),
+        (filename_tgt, dataset_tgt),
+        seeds=(filename_src, dataset_src_high_thr),
+        block_shape=block_shape,
+        num_workers=num_workers,
+    )
     tgtf[dataset_tgt].attrs["offset"] = srcf[dataset_src_high_thr].attrs["offset"]
     tgtf[dataset_tgt].attrs["max_id"] = maxid
 
@@ -1,6 +1,7 @@
 import z5py
 import os
 import logging
+from utils import streaming
 
 # offsets_minicrop = {
 #    'A+': (37, 1676, 1598),
@@ -41,7 +42,33 @@ shapes["B+"] = {True: (125, 1701, 2792), False: (125, 1250, 1250)}
 shapes["C+"] = {True: (125, 1424, 1470), False: (125, 1250, 1250)}
 
 
-def crop_to_seg(filename_src, dataset_src, filename_tgt, dataset_tgt, offset, shape):
+def require_dataset(tgtf, filename_tgt, dataset_tgt, shape, dtype, chunks):
+    # creates the dataset or checks that an existing one from a previous run fits
+    if os.path.exists(os.path.join(filename_tgt, dataset_tgt)):
+        assert (
+            tgtf[dataset_tgt].shape == shape
+            and tgtf[dataset_tgt].dtype == dtype
+            and tgtf[dataset_tgt].chunks == chunks
+        ), "existing dataset {0:} is incompatible".format(dataset_tgt)
+    else:
+        tgtf.create_dataset(
+            dataset_tgt, shape=shape, compression="gzip", dtype=dtype, chunks=chunks
+        )
+
+
+def crop_to_seg(
+    filename_src,
+    dataset_src,
+    filename_tgt,
+    dataset_tgt,
+    offset,
+    shape,
+    thrs=(),
+    dataset_tgt_thr=None,
+    num_threads=4,
+):
+    # crops the source to the given region in a single streaming pass. The crop can additionally be thresholded at
+    # thrs within the same pass, written to dataset_tgt_thr.format(thr).
     srcf = z5py.File(filename_src, use_zarr_format=False)
     if not os.path.exists(filename_tgt):
         os.makedirs(filename_tgt)
@@ -53,27 +80,19 @@ def crop_to_seg(filename_src, dataset_src, filename_tgt, dataset_tgt, offset, sh
             tgtf.create_group(grps)
         grps += "/"
     chunk_size = tuple(min(c, s) for c, s in zip(srcf[dataset_src].chunks, shape))
-    if os.path.exists(os.path.join(filename_tgt, dataset_tgt)):
-        assert (
-            tgtf[dataset_tgt].shape == shape
-            and tgtf[dataset_tgt].dtype == srcf[dataset_src].dtype
-            and tgtf[dataset_tgt].chunks == chunk_size
-        )
-        skip_ds_creation = True
-
-    else:
-        skip_ds_creation = False
-    if not skip_ds_creation:
-        tgtf.create_dataset(
-            dataset_tgt,
-            shape=shape,
-            compression="gzip",
-            dtype=srcf[dataset_src].dtype,
-            chunks=chunk_size,
+    require_dataset(
+        tgtf, filename_tgt, dataset_tgt, shape, srcf[dataset_src].dtype, chunk_size
+    )
+    targets = [(tgtf[dataset_tgt], streaming.copy)]
+    for thr in thrs:
+        require_dataset(
+            tgtf, filename_tgt, dataset_tgt_thr.format(thr), shape, "uint8", chunk_size
         )
-    bb = tuple(slice(off, off + sh, None) for off, sh in zip(offset, shape))
-    tgtf[dataset_tgt][:] = srcf[dataset_src][bb]
+        targets.append((tgtf[dataset_tgt_thr.format(thr)], streaming.threshold(thr)))
+    streaming.stream(srcf[dataset_src], targets, offset=offset, num_threads=num_threads)
     tgtf[dataset_tgt].attrs["offset"] = offset[::-1]
+    for thr in thrs:
+        tgtf[dataset_tgt_thr.format(thr)].attrs["offset"] = offset[::-1]
 
 
 def main():
@@ -2,17 +2,36 @@ from __future__ import print_function
 import z5py
 import os
 import numpy as np
-import numpy.ma as ma
 import scipy.ndimage
 import itertools
 import cremi
+import h5py
+from utils.label_index import LabelIndex, label_segment_components, sum_labels
+from utils import morphology
+from utils.point_cloud import PointCloud
+from utils.blockwise import (
+    block_of,
+    block_slice,
+    grow_slice,
+    iterate_blocks,
+    CachedRoi,
+)
+from utils.parallel import imap_ordered
 import sys
-from joblib import Parallel, delayed
-import multiprocessing
+import collections
 
 SEG_BG_VAL = 0
 
 
+def cleft_context(dilation_steps=7):
+    # context that a Cleft adds around the bounding box of the cleft
+    return (
+        1 + (5 * dilation_steps) // 10,
+        4 * dilation_steps + 1,
+        4 * dilation_steps + 1,
+    )
+
+
 def bbox_ND(img):
     N = img.ndim
     out = []
@@ -27,7 +46,7 @@ class SynapticRegion(object):
         self,
         segmentid,
         parentcleft,
-        region,
+        label,
         pre_thr=42,
         post_thr=42,
         size_thr=5,
@@ -37,6 +56,7 @@ class SynapticRegion(object):
     ):
         self.segmentid = segmentid
         self.cleft = parentcleft
+        self.label = label
         self.pre_thr = pre_thr
         self.post_thr = post_thr
         self.dist_thr = dist_thr
@@ -54,30 +74,28 @@ class SynapticRegion(object):
         self.post_status = None
 
         # these are wasteful to keep
-        self.region_for_acc = region
+        self.region_for_acc = None
         self.dilated_region = None
         self.eroded_region = None
         self.region_minus_cleft = None
-        self.distance_map = None
+        self.point_cloud = None
         self.segmask_eroded = None
         self.region_for_point = None
 
     def uninitialize_mem_save(self):
         self.region_for_acc = None
         self.region_minus_cleft = None
-        self.distance_map = None
+        self.point_cloud = None
         self.segmask_eroded = None
         self.region_for_point = None
 
     def get_region_for_acc(self):
-        # if self.region_for_acc is None:
-        #    self.make_region_for_acc()
-        # return self.region_for_acc
+        if self.region_for_acc is None:
+            self.make_region_for_acc()
         return self.region_for_acc
 
-    # def make_region_for_acc(self):
-    #    self.region_for_acc = np.copy(self.cleft.get_cleft_mask())
-    #    self.region_for_acc[np.logical_not(self.cleft.get_seg() == self.segmentid)] = False
+    def make_region_for_acc(self):
+        self.region_for_acc = self.cleft.get_region_labels() == self.label
 
     def get_dilated_region(self):
         if self.dilated_region is None:
@@ -90,23 +108,7 @@ class SynapticRegion(object):
         return self.eroded_region
 
     def dilate_region(self, steps):
-        self.dilated_region = np.copy(self.get_region_for_acc())
-        xy_structure = np.zeros((3, 3, 3))
-        xy_structure[1, :] = np.ones((3, 3))
-        z_structure = np.zeros((3, 3, 3))
-        z_structure[:, 1, 1] = np.ones((3,))
-        for k in range(int(steps / 10.0)):
-            self.dilated_region = scipy.ndimage.morphology.binary_dilation(
-                self.dilated_region, structure=xy_structure, iterations=10
-            )
-            self.dilated_region = scipy.ndimage.morphology.binary_dilation(
-                self.dilated_region, structure=z_structure, iterations=1
-            )
-        if steps % 10 != 0:
-            self.dilated_region = scipy.ndimage.morphology.binary_dilation(
-                self.dilated_region, structure=xy_structure, iterations=steps % 10
-            )
-
+        self.dilated_region = morphology.dilate(self.get_region_for_acc(), steps)
         return self.dilated_region
 
     def get_region_minus_cleft(self):
@@ -124,7 +126,7 @@ class SynapticRegion(object):
         return self.size
 
     def accumulate_acc_size(self):
-        self.size = float(np.sum(self.get_region_for_acc()))
+        self.size = float(self.cleft.get_region_sizes()[self.label])
 
     def get_pre_evidence(self):
         if self.pre_evidence is None:
@@ -133,10 +135,7 @@ class SynapticRegion(object):
 
     def accumulate_pre_evidence(self):
         try:
-            ev = (
-                np.sum(self.cleft.get_pre()[self.get_region_for_acc()])
-                / self.get_size()
-            )
+            ev = self.cleft.get_region_pre_sums()[self.label] / self.get_size()
         except RuntimeWarning:
             print(np.sum(self.get_region_for_acc()))
             print(self.get_region_for_acc())
@@ -154,10 +153,7 @@ class SynapticRegion(object):
 
     def accumulate_post_evidence(self):
         try:
-            ev = (
-                np.sum(self.cleft.get_post()[self.get_region_for_acc()])
-                / self.get_size()
-            )
+            ev = self.cleft.get_region_post_sums()[self.label] / self.get_size()
         except RuntimeWarning:
             print(np.sum(self.get_region_for_acc()))
             print(self.get_region_for_acc())
@@ -191,60 +187,24 @@ class SynapticRegion(object):
         return self.segmask_eroded
 
     def erode_seg_mask(self):
-        self.segmask_eroded = self.cleft.get_seg() == self.segmentid
-        xy_structure = np.zeros((3, 3, 3))
-        xy_structure[1, :] = np.ones((3, 3))
-        z_structure = np.zeros((3, 3, 3))
-        z_structure[:, 1, 1] = np.ones((3,))
-        for k in range(int(self.erosion_steps / 10.0)):
-            self.segmask_eroded = scipy.ndimage.morphology.binary_erosion(
-                self.segmask_eroded, structure=xy_structure, iterations=10
-            )
-            self.segmask_eroded = scipy.ndimage.morphology.binary_erosion(
-                self.segmask_eroded, structure=z_structure, iterations=1
-            )
-        if self.erosion_steps % 10 != 0:
-            self.segmask_eroded = scipy.ndimage.morphology.binary_erosion(
-                self.segmask_eroded,
-                structure=xy_structure,
-                iterations=self.erosion_steps % 10,
-            )
-        if not np.any(self.segmask_eroded):
-            self.erosion_steps -= 1
-            print(
-                "segment {0:} has been eroded so much that it disappeared, try with one less step, i.e. {1:}".format(
-                    self.segmentid, self.erosion_steps
-                )
-            )
-            self.erode_seg_mask()
+        self.segmask_eroded = self.erode_without_vanishing(
+            self.cleft.get_seg() == self.segmentid
+        )
 
     def erode_region(self):
-        self.eroded_region = self.get_region_for_acc()
-        xy_structure = np.zeros((3, 3, 3))
-        xy_structure[1, :] = np.ones((3, 3))
-        z_structure = np.zeros((3, 3, 3))
-        z_structure[:, 1, 1] = np.ones((3,))
-        for k in range(int(self.erosion_steps / 10.0)):
-            self.eroded_region = scipy.ndimage.morphology.binary_erosion(
-                self.eroded_region, structure=xy_structure, iterations=10
-            )
-            self.eroded_region = scipy.ndimage.morphology.binary_erosion(
-                self.eroded_region, structure=z_structure, iterations=1
-            )
-        if self.erosion_steps % 10 != 0:
-            self.eroded_region = scipy.ndimage.morphology.binary_erosion(
-                self.eroded_region,
-                structure=xy_structure,
-                iterations=self.erosion_steps % 10,
-            )
-        if not np.any(self.eroded_region):
-            self.erosion_steps -= 1
+        self.eroded_region = self.erode_without_vanishing(self.get_region_for_acc())
+
+    def erode_without_vanishing(self, mask):
+        erosion = morphology.ErosionDepth(mask)
+        steps = erosion.max_steps(self.erosion_steps)
+        if steps != self.erosion_steps:
             print(
-                "segment {0:} has been eroded so much that it disappeared, try with one less step, i.e. {1:}".format(
-                    self.segmentid, self.erosion_steps
+                "segment {0:} disappears when eroded by {1:} steps, using {2:} steps instead".format(
+                    self.segmentid, self.erosion_steps, steps
                 )
             )
-            self.erode_region()
+            self.erosion_steps = steps
+        return erosion.erode(steps)
 
     def get_region_for_point(self):
         if self.region_for_point is None:
@@ -266,20 +226,16 @@ class SynapticRegion(object):
         else:
             self.region_for_point = self.get_eroded_region()
 
-    def get_distance_map(self):
-        if self.distance_map is None:
-            self.compute_distance_map()
-        return self.distance_map
+    def get_point_cloud(self):
+        if self.point_cloud is None:
+            self.make_point_cloud()
+        return self.point_cloud
 
-    def compute_distance_map(self):
-        self.distance_map = scipy.ndimage.morphology.distance_transform_edt(
-            np.logical_not(self.get_region_for_point()), sampling=(40, 4, 4)
-        )
+    def make_point_cloud(self):
+        self.point_cloud = PointCloud(self.get_region_for_point(), (40, 4, 4))
 
     def is_neighbor(self, partner):
-        structure = np.zeros((3, 3, 3))
-        structure[1, :] = np.ones((3, 3))
-        structure[:, 1, 1] = np.ones((3,))
+        structure = morphology.NEIGHBOR_STRUCTURE
         if self.segmentid == partner.segmentid:
             return False
         else:
@@ -330,13 +286,9 @@ class SynapticRegion(object):
                     )
                 )
                 return False
-        post_masked_distance_map = ma.array(
-            self.get_distance_map(), mask=np.logical_not(partner.get_region_for_point())
-        )
-        post_spot = np.unravel_index(
-            np.argmin(post_masked_distance_map), post_masked_distance_map.shape
+        post_spot, post_to_pre_dist = partner.get_point_cloud().closest_to(
+            self.get_point_cloud()
         )
-        post_to_pre_dist = post_masked_distance_map[post_spot]
         self.distances.append(post_to_pre_dist)
         if post_to_pre_dist >= self.dist_thr:
             print(
@@ -345,12 +297,7 @@ class SynapticRegion(object):
                 )
             )
             return False
-        pre_masked_distance_map = ma.array(
-            partner.get_distance_map(), mask=np.logical_not(self.get_region_for_point())
-        )
-        pre_spot = np.unravel_index(
-            np.argmin(pre_masked_distance_map), pre_masked_distance_map.shape
-        )
+        pre_spot, _ = self.get_point_cloud().closest_to(partner.get_point_cloud())
         if self.mvpts:
             pre_spot = np.array(pre_spot)
             post_spot = np.array(post_spot)
@@ -406,9 +353,7 @@ class Cleft(object):
         self.cleft_id = cleft_id
         self.safe_mem = safe_mem
         self.splitcc = splitcc
-        cleft_mask_full = self.mm.cleft_cc_np == cleft_id
-
-        bbox = bbox_ND(cleft_mask_full)
+        bbox = self.mm.cleft_index.get_bbox(cleft_id)
 
         bbox = [
             bb + shift
@@ -426,11 +371,11 @@ class Cleft(object):
         ]
 
         bbox[0] = max(0, bbox[0])
-        bbox[1] = min(cleft_mask_full.shape[0], bbox[1])
+        bbox[1] = min(self.mm.cleft_index.shape[0], bbox[1])
         bbox[2] = max(0, bbox[2])
-        bbox[3] = min(cleft_mask_full.shape[1], bbox[3])
+        bbox[3] = min(self.mm.cleft_index.shape[1], bbox[3])
         bbox[4] = max(0, bbox[4])
-        bbox[5] = min(cleft_mask_full.shape[2], bbox[5])
+        bbox[5] = min(self.mm.cleft_index.shape[2], bbox[5])
         self.bbox = bbox
         self.bbox_slice = (
             slice(bbox[0], bbox[1], None),
@@ -445,10 +390,15 @@ class Cleft(object):
         if self.safe_mem:
             self.cleft_mask = None
         else:
-            self.cleft_mask = cleft_mask_full[self.bbox_slice]
-        del cleft_mask_full
+            self.cleft_mask = self.mm.cleft_cc_np[self.bbox_slice] == cleft_id
         self.dilation_steps = dilation_steps
         self.dilated_cleft_mask = None
+        self.region_structure = morphology.FULL_STRUCTURE
+        self.region_labels = None
+        self.region_segments = None
+        self.region_sizes = None
+        self.region_pre_sums = None
+        self.region_post_sums = None
         self.cleft_gradient = None
 
         # self.region_for_acc = np.copy(self.get_cleft_mask())
@@ -456,34 +406,69 @@ class Cleft(object):
         self.segments_overlapping = self.find_segments()
 
         if self.splitcc:
-            self.synregions = []
-            structure = np.ones((3, 3, 3))
-            # structure[1, :] = np.ones((3, 3))
-            # structure[:, 1, 1] = np.ones((3,))
-            for segid in self.segments_overlapping:
-                region = np.copy(self.get_cleft_mask())
-                region[np.logical_not(self.get_seg() == segid)] = False
-                region = region.astype(np.uint8)
-                num = scipy.ndimage.label(region, output=region, structure=structure)
-                for k in range(1, num + 1):
-                    self.synregions.append(
-                        SynapticRegion(
-                            segid,
-                            self,
-                            region == k,
-                            pre_thr=pre_thr,
-                            post_thr=post_thr,
-                            size_thr=size_thr,
-                            dist_thr=dist_thr,
-                            ngbrs=ngbrs,
-                            mvpts=mvpts,
-                        )
-                    )
+            self.synregions = [
+                SynapticRegion(
+                    segid,
+                    self,
+                    k + 1,
+                    pre_thr=pre_thr,
+                    post_thr=post_thr,
+                    size_thr=size_thr,
+                    dist_thr=dist_thr,
+                    ngbrs=ngbrs,
+                    mvpts=mvpts,
+                )
+                for k, segid in enumerate(self.get_region_segments())
+            ]
         else:
             self.synregions = [
                 SynapticRegion(segid, self) for segid in self.segments_overlapping
             ]
 
+    def get_region_labels(self):
+        if self.region_labels is None:
+            self.set_region_labels()
+        return self.region_labels
+
+    def get_region_segments(self):
+        if self.region_segments is None:
+            self.set_region_labels()
+        return self.region_segments
+
+    def set_region_labels(self):
+        # components of the cleft mask within every overlapping segment, labeled in one pass over the cleft's bbox
+        self.region_labels, self.region_segments = label_segment_components(
+            self.get_cleft_mask(),
+            self.get_seg(),
+            self.region_structure,
+            bg_label=SEG_BG_VAL,
+        )
+
+    def get_region_sizes(self):
+        if self.region_sizes is None:
+            self.region_sizes = sum_labels(
+                self.get_region_labels(), len(self.get_region_segments())
+            )
+        return self.region_sizes
+
+    def get_region_pre_sums(self):
+        if self.region_pre_sums is None:
+            self.region_pre_sums = sum_labels(
+                self.get_region_labels(),
+                len(self.get_region_segments()),
+                weights=self.get_pre(),
+            )
+        return self.region_pre_sums
+
+    def get_region_post_sums(self):
+        if self.region_post_sums is None:
+            self.region_post_sums = sum_labels(
+                self.get_region_labels(),
+                len(self.get_region_segments()),
+                weights=self.get_post(),
+            )
+        return self.region_post_sums
+
     def get_cleft_mask(self):
         if self.cleft_mask is None:
             self.set_cleft_mask()
@@ -547,23 +532,7 @@ class Cleft(object):
         return self.dilated_cleft_mask
 
     def dilate_cleft_mask(self, steps):
-        self.dilated_cleft_mask = np.copy(self.get_cleft_mask())
-        xy_structure = np.zeros((3, 3, 3))
-        xy_structure[1, :] = np.ones((3, 3))
-        z_structure = np.zeros((3, 3, 3))
-        z_structure[:, 1, 1] = np.ones((3,))
-        for k in range(int(steps / 10.0)):
-            self.dilated_cleft_mask = scipy.ndimage.morphology.binary_dilation(
-                self.dilated_cleft_mask, structure=xy_structure, iterations=10
-            )
-            self.dilated_cleft_mask = scipy.ndimage.morphology.binary_dilation(
-                self.dilated_cleft_mask, structure=z_structure, iterations=1
-            )
-        if steps % 10 != 0:
-            self.dilated_cleft_mask = scipy.ndimage.morphology.binary_dilation(
-                self.dilated_cleft_mask, structure=xy_structure, iterations=steps % 10
-            )
-
+        self.dilated_cleft_mask = morphology.dilate(self.get_cleft_mask(), steps)
         return self.dilated_cleft_mask
 
     def find_all_partners(self):
@@ -581,8 +550,12 @@ class Cleft(object):
                 if answer is None or not answer:
                     continue
                 pre_loc, post_loc = answer
-                pre_loc = (cpl + bboff for cpl, bboff in zip(pre_loc, self.bbox[::2]))
-                post_loc = (cpl + bboff for cpl, bboff in zip(post_loc, self.bbox[::2]))
+                pre_loc = tuple(
+                    cpl + bboff for cpl, bboff in zip(pre_loc, self.bbox[::2])
+                )
+                post_loc = tuple(
+                    cpl + bboff for cpl, bboff in zip(post_loc, self.bbox[::2])
+                )
                 partners.append(
                     (
                         pre_loc,
@@ -597,10 +570,26 @@ class Cleft(object):
                 )
         return partners
 
+    def get_region_stats(self):
+        stats = []
+        for synr in self.synregions:
+            stats.append(
+                (
+                    synr.pre_evidence,
+                    synr.post_evidence,
+                    synr.size,
+                    synr.is_pre(),
+                    synr.is_post(),
+                    synr.distances,
+                )
+            )
+        return stats
+
     def uninitialize_mem_save(self):
         for synreg in self.synregions:
             synreg.uninitialize_mem_save()
         self.dilated_cleft_mask = None
+        self.region_labels = None
         self.seg = None
         self.pre = None
         self.post = None
@@ -609,6 +598,77 @@ class Cleft(object):
             self.cleft = None
 
 
+class CleftCropSource(object):
+    # stands in for the Matchmaker inside of worker processes. It only holds the dataset handles and the (small)
+    # cleft index, such that a worker reads nothing but the bounding box crops of the clefts it processes.
+    def __init__(
+        self,
+        syn_file,
+        cleft_cc_ds,
+        cleft_ds,
+        pre_ds,
+        post_ds,
+        seg_file,
+        seg_ds,
+        cleft_index,
+        cleft_kwargs,
+    ):
+        self.synf = z5py.File(syn_file, use_zarr_format=False)
+        self.segf = z5py.File(seg_file, use_zarr_format=False)
+        self.cleft = self.synf[cleft_ds]
+        self.cleft_cc = self.synf[cleft_cc_ds]
+        self.cleft_cc_np = self.cleft_cc
+        self.cleft_index = cleft_index
+        self.seg = self.segf[seg_ds]
+        self.pre = self.synf[pre_ds]
+        self.post = self.synf[post_ds]
+        self.cleft_kwargs = cleft_kwargs
+
+
+class HaloBlockSource(object):
+    # stands in for the Matchmaker for all clefts owned by one block. The block including its halo is read only once
+    # per dataset and shared by these clefts, crops of clefts that exceed the halo are read from the datasets directly.
+    def __init__(self, source, roi):
+        self.cleft = CachedRoi(source.cleft, roi)
+        self.cleft_cc = CachedRoi(source.cleft_cc, roi)
+        self.cleft_cc_np = self.cleft_cc
+        self.cleft_index = source.cleft_index
+        self.seg = CachedRoi(source.seg, roi)
+        self.pre = CachedRoi(source.pre, roi)
+        self.post = CachedRoi(source.post, roi)
+        self.cleft_kwargs = source.cleft_kwargs
+
+
+_worker_source = None
+
+
+def _init_partner_worker(*args):
+    global _worker_source
+    _worker_source = CleftCropSource(*args)
+
+
+def _run_in_worker(func, args):
+    return func(_worker_source, *args)
+
+
+def _find_cleft_partners(source, cleft_id):
+    cleft = Cleft(source, cleft_id, **source.cleft_kwargs)
+    partners = cleft.find_all_partners()
+    region_stats = cleft.get_region_stats()
+    return partners, region_stats
+
+
+def _find_block_partners(source, roi, cleft_ids):
+    block_source = HaloBlockSource(source, roi)
+    partners = []
+    region_stats = []
+    for cid in cleft_ids:
+        cleft_partners, cleft_region_stats = _find_cleft_partners(block_source, cid)
+        partners.extend(cleft_partners)
+        region_stats.extend(cleft_region_stats)
+    return partners, region_stats
+
+
 class Matchmaker(object):
     def __init__(
         self,
@@ -632,40 +692,54 @@ class Matchmaker(object):
         ngbrs=True,
         mvpts=True,
         splitcc=True,
+        block_shape=None,
     ):
+        self.dataset_args = (
+            syn_file,
+            cleft_cc_ds,
+            cleft_ds,
+            pre_ds,
+            post_ds,
+            seg_file,
+            seg_ds,
+        )
         self.synf = z5py.File(syn_file, use_zarr_format=False)
         self.segf = z5py.File(seg_file, use_zarr_format=False)
         self.cleft = self.synf[cleft_ds]
         self.cleft_cc = self.synf[cleft_cc_ds]
-        self.cleft_cc_np = self.synf[cleft_cc_ds][:]
+        self.block_shape = block_shape
+        if self.block_shape is None:
+            self.cleft_cc_np = self.synf[cleft_cc_ds][:]
+            self.cleft_index = LabelIndex(self.cleft_cc_np)
+        else:
+            # out-of-core mode, the cleft components are never loaded as a whole
+            self.cleft_cc_np = self.cleft_cc
+            self.cleft_index = LabelIndex.from_blocks(self.cleft_cc, self.block_shape)
         self.seg = self.segf[seg_ds]
         self.pre = self.synf[pre_ds]
         self.post = self.synf[post_ds]
         self.partners = None
+        self.region_stats = None
         self.num_cores = num_cores
-        # inputs = np.unique(self.cleft_cc[:])[1:]
-        # self.list_of_clefts = Parallel(n_jobs=self.num_cores)(delayed(Cleft.__init__)(Cleft.__new__(Cleft), self,
-        # cid) for cid in inputs)
         print("finding all clefts...")
-        try:
-            self.list_of_cleftids = range(1, self.cleft_cc.attrs["max_id"] + 1)
-        except AssertionError:
-            self.list_of_cleftids = np.unique(self.cleft_cc[:])[1:]
-        self.list_of_clefts = [
-            Cleft(
-                self,
-                cid,
-                safe_mem=safe_mem,
-                splitcc=splitcc,
-                pre_thr=pre_thr,
-                post_thr=post_thr,
-                dist_thr=dist_thr,
-                size_thr=size_thr,
-                ngbrs=ngbrs,
-                mvpts=mvpts,
-            )
-            for cid in self.list_of_cleftids
-        ]
+        self.list_of_cleftids = self.cleft_index.ids()
+        self.cleft_kwargs = dict(
+            safe_mem=safe_mem,
+            splitcc=splitcc,
+            pre_thr=pre_thr,
+            post_thr=post_thr,
+            dist_thr=dist_thr,
+            size_thr=size_thr,
+            ngbrs=ngbrs,
+            mvpts=mvpts,
+        )
+        if self.num_cores > 1 or self.block_shape is not None:
+            # clefts are only instantiated when they are processed
+            self.list_of_clefts = None
+        else:
+            self.list_of_clefts = [
+                Cleft(self, cid, **self.cleft_kwargs) for cid in self.list_of_cleftids
+            ]
         self.cremi_file = cremi.CremiFile(tgt_file, "w")
         self.offset = offset
         if raw_file is not None:
@@ -677,28 +751,38 @@ class Matchmaker(object):
 
     def prepare_file(self):
         if self.raw is not None:
-            self.cremi_file.write_raw(
-                cremi.Volume(self.raw[:], resolution=(40.0, 4.0, 4.0))
-            )
-
-        self.cremi_file.write_neuron_ids(
-            cremi.Volume(self.seg[:], resolution=(40.0, 4.0, 4.0), offset=self.offset)
-        )
-        self.cremi_file.write_clefts(
-            cremi.Volume(
-                self.cleft_cc_np, resolution=(40.0, 4.0, 4.0), offset=self.offset
-            )
+            self.write_volume(self.raw, "/volumes/raw", np.uint8, (0.0, 0.0, 0.0))
+        self.write_volume(
+            self.seg, "/volumes/labels/neuron_ids", np.uint64, self.offset
         )
-        self.cremi_file.write_volume(
-            cremi.Volume(self.pre[:], resolution=(40.0, 4.0, 4.0), offset=self.offset),
-            "volumes/pre_dist",
-            np.uint8,
+        self.write_volume(
+            self.cleft_cc_np, "/volumes/labels/clefts", np.uint64, self.offset
         )
-        self.cremi_file.write_volume(
-            cremi.Volume(self.post[:], resolution=(40.0, 4.0, 4.0), offset=self.offset),
-            "volumes/post_dist",
-            np.uint8,
+        self.write_volume(self.pre, "volumes/pre_dist", np.uint8, self.offset)
+        self.write_volume(self.post, "volumes/post_dist", np.uint8, self.offset)
+
+    def write_volume(self, data, ds_name, dtype, offset):
+        # writes data to ds_name of the cremi file like CremiFile.write_volume, in block mode block by block such that
+        # the volume is never loaded as a whole
+        resolution = (40.0, 4.0, 4.0)
+        if self.block_shape is None:
+            self.cremi_file.write_volume(
+                cremi.Volume(data[:], resolution=resolution, offset=offset),
+                ds_name,
+                dtype,
+            )
+            return
+        h5file = self.cremi_file.h5file
+        if ds_name in h5file:
+            del h5file[ds_name]
+        ds = h5file.create_dataset(
+            ds_name, shape=data.shape, dtype=dtype, compression="gzip"
         )
+        for bs in iterate_blocks(data.shape, self.block_shape):
+            ds[bs] = data[bs]
+        ds.attrs["resolution"] = resolution
+        if tuple(offset) != (0.0, 0.0, 0.0):
+            ds.attrs["offset"] = offset
 
     def get_partners(self):
         if self.partners is None:
@@ -710,9 +794,73 @@ class Matchmaker(object):
     def find_all_partners(self):
         print("finding partners...")
         self.partners = []
-        for cleft in self.list_of_clefts:
-            self.partners.extend(cleft.find_all_partners())
-            cleft.uninitialize_mem_save()
+        self.region_stats = []
+        for partners, region_stats in self.iter_results():
+            self.partners.extend(partners)
+            self.region_stats.extend(region_stats)
+
+    def iter_results(self):
+        if self.block_shape is not None:
+            context = cleft_context()
+            jobs = (
+                (grow_slice(bs, context, self.cleft_index.shape), cleft_ids)
+                for bs, cleft_ids in self.clefts_by_block()
+            )
+            for result in self.run_jobs(_find_block_partners, jobs):
+                yield result
+        elif self.num_cores > 1:
+            jobs = ((cid,) for cid in self.list_of_cleftids)
+            for result in self.run_jobs(_find_cleft_partners, jobs):
+                yield result
+        else:
+            for cleft in self.list_of_clefts:
+                yield cleft.find_all_partners(), cleft.get_region_stats()
+                cleft.uninitialize_mem_save()
+
+    def clefts_by_block(self):
+        # each cleft is owned by exactly one block, namely the one that contains the lower corner of its bounding box
+        owned = collections.defaultdict(list)
+        for cid in self.list_of_cleftids:
+            corner = self.cleft_index.get_bbox(cid)[::2]
+            owned[block_of(corner, self.block_shape)].append(cid)
+        for block_id in sorted(owned.keys()):
+            yield block_slice(
+                block_id, self.block_shape, self.cleft_index.shape
+            ), owned[block_id]
+
+    def run_jobs(self, func, jobs, max_pending_per_core=2):
+        # yields func(source, *job) for all jobs in order. With num_cores > 1 jobs are processed by a pool of workers
+        # that open the datasets themselves and only read the crops they need. At most max_pending_per_core *
+        # num_cores results are outstanding at any time, such that memory is bounded and the output does not depend
+        # on the scheduling.
+        if self.num_cores <= 1:
+            for job in jobs:
+                yield func(self, *job)
+            return
+        for result in imap_ordered(
+            _run_in_worker,
+            ((func, job) for job in jobs),
+            self.num_cores,
+            initializer=_init_partner_worker,
+            initargs=self.dataset_args + (self.cleft_index, self.cleft_kwargs),
+            max_pending_per_worker=max_pending_per_core,
+        ):
+            yield result
+
+    def write_partner_rows(self, filename, dat_filenames=None):
+        # streams the partners to a text file as they are found, one row per partner with the pre and post location
+        # followed by the pre-/postness and size of the pre and the post region. With dat_filenames (the filenames of
+        # extract_dat) the region statistics are streamed in the same pass.
+        dat = DatWriter(dat_filenames) if dat_filenames is not None else None
+        with open(filename, "w") as f:
+            for partners, region_stats in self.iter_results():
+                for partner in partners:
+                    f.write(partner_row(partner) + "\n")
+                f.flush()
+                if dat is not None:
+                    dat.add(region_stats)
+        if dat is not None:
+            dat.close()
 
     def extract_dat(
         self,
@@ -723,67 +871,160 @@ class Matchmaker(object):
         postsizes_filename,
         sizes_filename,
     ):
-        preness = []
-        postness = []
-        distances = []
-        presizes = []
-        postsizes = []
-        sizes = []
-        for cleft in self.list_of_clefts:
-            for synr in cleft.synregions:
-                preness.append(synr.pre_evidence)
-                postness.append(synr.post_evidence)
-                sizes.append(synr.size)
-                if synr.is_pre():
-                    presizes.append(synr.size)
-                if synr.is_post():
-                    postsizes.append(synr.size)
-                distances.extend(synr.distances)
-
-        fmt = "%.5g"
-        np.savetxt(preness_filename, preness, fmt)
-        np.savetxt(postness_filename, postness, fmt)
-        np.savetxt(distances_filename, distances, fmt)
-        np.savetxt(presizes_filename, presizes, fmt)
-        np.savetxt(postsizes_filename, postsizes, fmt)
-        np.savetxt(sizes_filename, sizes, fmt)
-
-    def write_partners(self):
+        dat = DatWriter(
+            (
+                preness_filename,
+                postness_filename,
+                distances_filename,
+                presizes_filename,
+                postsizes_filename,
+                sizes_filename,
+            )
+        )
+        if self.region_stats is not None:
+            dat.add(self.region_stats)
+        elif self.block_shape is not None:
+            # out-of-core mode, the statistics are written as they are found
+            for _, region_stats in self.iter_results():
+                dat.add(region_stats)
+        else:
+            self.find_all_partners()
+            dat.add(self.region_stats)
+        dat.close()
+
+    def write_partners(self, dat_filenames=None):
+        # writes the partners as annotations of the cremi file, in block mode block by block as they are found. With
+        # dat_filenames (the filenames of extract_dat) the region statistics are written in the same pass.
+        if self.block_shape is not None:
+            annotations = AnnotationWriter(self.cremi_file.h5file, self.offset)
+            dat = DatWriter(dat_filenames) if dat_filenames is not None else None
+            for partners, region_stats in self.iter_results():
+                annotations.add_partners(partners)
+                if dat is not None:
+                    dat.add(region_stats)
+            if dat is not None:
+                dat.close()
+            return
         annotations = cremi.Annotations(offset=self.offset)
         syncounter = itertools.count(1)
         for partner in self.get_partners():
+            pre_comment, post_comment = partner_comments(partner)
             preid = syncounter.next()
             annotations.add_annotation(
                 preid,
                 "presynaptic_site",
                 tuple(p * r for p, r in zip(partner[0], (40.0, 4.0, 4.0))),
             )
-            annotations.add_comment(
-                preid,
-                "preness: "
-                + str(partner[2])
-                + ", postness: "
-                + str(partner[3])
-                + ", size: "
-                + str(partner[4]),
-            )
+            annotations.add_comment(preid, pre_comment)
             postid = syncounter.next()
             annotations.add_annotation(
                 postid,
                 "postsynaptic_site",
                 tuple(p * r for p, r in zip(partner[1], (40.0, 4.0, 4.0))),
             )
-            annotations.add_comment(
-                postid,
-                "preness: "
-                + str(partner[5])
-                + ", postness: "
-                + str(partner[6])
-                + ", size: "
-                + str(partner[7]),
-            )
+            annotations.add_comment(postid, post_comment)
             annotations.set_pre_post_partners(preid, postid)
         self.cremi_file.write_annotations(annotations)
+        if dat_filenames is not None:
+            self.extract_dat(*dat_filenames)
+
+
+def partner_row(partner):
+    # pre and post location and the sizes of the regions as integers, their pre-/postness with 5 significant digits
+    pre_ev, post_ev, pre_size, pre_ev_post, post_ev_post, post_size = partner[2:]
+    return " ".join(
+        "{0:d}".format(int(v)) for v in tuple(partner[0]) + tuple(partner[1])
+    ) + " {0:.5g} {1:.5g} {2:d} {3:.5g} {4:.5g} {5:d}".format(
+        pre_ev, post_ev, int(pre_size), pre_ev_post, post_ev_post, int(post_size)
+    )
+
+
+def partner_comments(partner):
+    return tuple(
+        "preness: {0:}, postness: {1:}, size: {2:}".format(*partner[k : k + 3])
+        for k in (2, 5)
+    )
+
+
+class DatWriter(object):
+    # appends region statistics to the files of preness, postness, distances, sizes of pre regions, sizes of post
+    # regions and sizes of all regions. Sizes are written as integers, everything else with 5 significant digits.
+    def __init__(self, filenames):
+        self.files = [open(filename, "w") for filename in filenames]
+
+    def add(self, region_stats):
+        preness, postness, distances, presizes, postsizes, sizes = self.files
+        for pre_ev, post_ev, size, is_pre, is_post, dists in region_stats:
+            preness.write("{0:.5g}\n".format(pre_ev))
+            postness.write("{0:.5g}\n".format(post_ev))
+            sizes.write("{0:d}\n".format(int(size)))
+            if is_pre:
+                presizes.write("{0:d}\n".format(int(size)))
+            if is_post:
+                postsizes.write("{0:d}\n".format(int(size)))
+            for d in dists:
+                distances.write("{0:.5g}\n".format(d))
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+
+class AnnotationWriter(object):
+    # writes synaptic partners to the annotations of an hdf5 file in the layout of CremiFile.write_annotations,
+    # appending them as they come such that the annotations of a whole volume are never held in memory
+    def __init__(self, h5file, offset, resolution=(40.0, 4.0, 4.0)):
+        self.h5file = h5file
+        self.resolution = resolution
+        self.next_id = 1
+        if "/annotations" in h5file:
+            del h5file["/annotations"]
+        group = h5file.create_group("/annotations")
+        if tuple(offset) != (0.0, 0.0, 0.0):
+            group.attrs["offset"] = offset
+        text = h5py.special_dtype(vlen=str)
+        for name, shape, dtype in (
+            ("/annotations/ids", (0,), np.uint64),
+            ("/annotations/types", (0,), text),
+            ("/annotations/locations", (0, 3), np.double),
+            ("/annotations/comments/target_ids", (0,), np.uint64),
+            ("/annotations/comments/comments", (0,), text),
+            ("/annotations/presynaptic_site/partners", (0, 2), np.uint64),
+        ):
+            h5file.create_dataset(
+                name,
+                shape=shape,
+                maxshape=(None,) + shape[1:],
+                dtype=dtype,
+                chunks=(1024,) + shape[1:],
+            )
+
+    def append(self, name, rows):
+        ds = self.h5file[name]
+        n = ds.shape[0]
+        ds.resize(n + len(rows), axis=0)
+        ds[n:] = rows
+
+    def add_partners(self, partners):
+        if not partners:
+            return
+        ids = np.arange(self.next_id, self.next_id + 2 * len(partners), dtype=np.uint64)
+        self.next_id += 2 * len(partners)
+        locations = []
+        comments = []
+        for partner in partners:
+            for location in partner[:2]:
+                locations.append([p * r for p, r in zip(location, self.resolution)])
+            comments.extend(partner_comments(partner))
+        self.append("/annotations/ids", ids)
+        self.append(
+            "/annotations/types",
+            ["presynaptic_site", "postsynaptic_site"] * len(partners),
+        )
+        self.append("/annotations/locations", np.array(locations, dtype=np.double))
+        self.append("/annotations/comments/target_ids", ids)
+        self.append("/annotations/comments/comments", comments)
+        self.append("/annotations/presynaptic_site/partners", ids.reshape((-1, 2)))
 
 
 def main_crop():
@@ -2,10 +2,11 @@ from __future__ import print_function
 import z5py
 import os
 import numpy as np
-import numpy.ma as ma
-import scipy.ndimage
 import itertools
 import cremi
+from utils.label_index import LabelIndex
+from utils import morphology
+from utils.point_cloud import PointCloud
 import sys
 from joblib import Parallel, delayed
 import multiprocessing
@@ -37,14 +38,14 @@ class SynapticRegion(object):
         # these are wasteful to keep
         self.region_for_acc = None
         self.region_minus_cleft = None
-        self.distance_map = None
+        self.point_cloud = None
         self.segmask_eroded = None
         self.region_for_point = None
 
     def uninitialize_mem_save(self):
         self.region_for_acc = None
         self.region_minus_cleft = None
-        self.distance_map = None
+        self.point_cloud = None
         self.segmask_eroded = None
         self.region_for_point = None
 
@@ -94,32 +95,21 @@ class SynapticRegion(object):
         return self.segmask_eroded
 
     def erode_seg_mask(self):
-        self.segmask_eroded = self.cleft.get_seg() == self.segmentid
-        xy_structure = np.zeros((3, 3, 3))
-        xy_structure[1, :] = np.ones((3, 3))
-        z_structure = np.zeros((3, 3, 3))
-        z_structure[:, 1, 1] = np.ones((3,))
-        for k in range(int(self.erosion_steps / 10.0)):
-            self.segmask_eroded = scipy.ndimage.morphology.binary_erosion(
-                self.segmask_eroded, structure=xy_structure, iterations=10
-            )
-            self.segmask_eroded = scipy.ndimage.morphology.binary_erosion(
-                self.segmask_eroded, structure=z_structure, iterations=1
-            )
-        if self.erosion_steps % 10 != 0:
-            self.segmask_eroded = scipy.ndimage.morphology.binary_erosion(
-                self.segmask_eroded,
-                structure=xy_structure,
-                iterations=self.erosion_steps % 10,
-            )
-        if not np.any(self.segmask_eroded):
-            self.erosion_steps -= 1
+        self.segmask_eroded = self.erode_without_vanishing(
+            self.cleft.get_seg() == self.segmentid
+        )
+
+    def erode_without_vanishing(self, mask):
+        erosion = morphology.ErosionDepth(mask)
+        steps = erosion.max_steps(self.erosion_steps)
+        if steps != self.erosion_steps:
             print(
-                "segment {0:} has been eroded so much that it disappeared, try with one less step, i.e. {1:}".format(
-                    self.segmentid, self.erosion_steps
+                "segment {0:} disappears when eroded by {1:} steps, using {2:} steps instead".format(
+                    self.segmentid, self.erosion_steps, steps
                 )
             )
-            self.erode_seg_mask()
+            self.erosion_steps = steps
+        return erosion.erode(steps)
 
     def get_region_for_point(self):
         if self.region_for_point is None:
@@ -141,28 +131,22 @@ class SynapticRegion(object):
         else:
             self.region_for_point = self.get_segmask_eroded()
 
-    def get_distance_map(self):
-        if self.distance_map is None:
-            self.compute_distance_map()
-        return self.distance_map
+    def get_point_cloud(self):
+        if self.point_cloud is None:
+            self.make_point_cloud()
+        return self.point_cloud
 
-    def compute_distance_map(self):
-        self.distance_map = scipy.ndimage.morphology.distance_transform_edt(
-            np.logical_not(self.get_region_for_point()), sampling=(40, 4, 4)
-        )
+    def make_point_cloud(self):
+        self.point_cloud = PointCloud(self.get_region_for_point(), (40, 4, 4))
 
     def partner_with_post(self, partner):
         if self == partner:
             return None
         assert self.is_pre()
         assert partner.is_post()
-        post_masked_distance_map = ma.array(
-            self.get_distance_map(), mask=np.logical_not(partner.get_region_for_point())
-        )
-        post_spot = np.unravel_index(
-            np.argmin(post_masked_distance_map), post_masked_distance_map.shape
+        post_spot, post_to_pre_dist = partner.get_point_cloud().closest_to(
+            self.get_point_cloud()
         )
-        post_to_pre_dist = post_masked_distance_map[post_spot]
         self.distances.append(post_to_pre_dist)
         if post_to_pre_dist >= self.dist_thr:
             print(
@@ -171,12 +155,7 @@ class SynapticRegion(object):
                 )
             )
             return False
-        pre_masked_distance_map = ma.array(
-            partner.get_distance_map(), mask=np.logical_not(self.get_region_for_point())
-        )
-        pre_spot = np.unravel_index(
-            np.argmin(pre_masked_distance_map), pre_masked_distance_map.shape
-        )
+        pre_spot, _ = self.get_point_cloud().closest_to(partner.get_point_cloud())
         return pre_spot, post_spot
 
 
@@ -188,9 +167,7 @@ class Cleft(object):
         self.cleft_id = cleft_id
         self.safe_mem = safe_mem
         self.size_thr = size_thr
-        cleft_mask_full = self.mm.cleft_cc_np == cleft_id
-
-        bbox = bbox_ND(cleft_mask_full)
+        bbox = self.mm.cleft_index.get_bbox(cleft_id)
 
         bbox = [
             bb + shift
@@ -208,11 +185,11 @@ class Cleft(object):
         ]
 
         bbox[0] = max(0, bbox[0])
-        bbox[1] = min(cleft_mask_full.shape[0], bbox[1])
+        bbox[1] = min(self.mm.cleft_index.shape[0], bbox[1])
         bbox[2] = max(0, bbox[2])
-        bbox[3] = min(cleft_mask_full.shape[1], bbox[3])
+        bbox[3] = min(self.mm.cleft_index.shape[1], bbox[3])
         bbox[4] = max(0, bbox[4])
-        bbox[5] = min(cleft_mask_full.shape[2], bbox[5])
+        bbox[5] = min(self.mm.cleft_index.shape[2], bbox[5])
         self.bbox = bbox
         self.bbox_slice = (
             slice(bbox[0], bbox[1], None),
@@ -224,8 +201,7 @@ class Cleft(object):
         if self.safe_mem:
             self.cleft_mask = None
         else:
-            self.cleft_mask = cleft_mask_full[self.bbox_slice]
-        del cleft_mask_full
+            self.cleft_mask = self.mm.cleft_cc_np[self.bbox_slice] == cleft_id
         self.dilated_cleft_mask = None
         self.dilation_steps = dilation_steps
         self.synregions = [
@@ -263,23 +239,7 @@ class Cleft(object):
         return self.dilated_cleft_mask
 
     def dilate_cleft_mask(self, steps):
-        self.dilated_cleft_mask = np.copy(self.get_cleft_mask())
-        xy_structure = np.zeros((3, 3, 3))
-        xy_structure[1, :] = np.ones((3, 3))
-        z_structure = np.zeros((3, 3, 3))
-        z_structure[:, 1, 1] = np.ones((3,))
-        for k in range(int(steps / 10.0)):
-            self.dilated_cleft_mask = scipy.ndimage.morphology.binary_dilation(
-                self.dilated_cleft_mask, structure=xy_structure, iterations=10
-            )
-            self.dilated_cleft_mask = scipy.ndimage.morphology.binary_dilation(
-                self.dilated_cleft_mask, structure=z_structure, iterations=1
-            )
-        if steps % 10 != 0:
-            self.dilated_cleft_mask = scipy.ndimage.morphology.binary_dilation(
-                self.dilated_cleft_mask, structure=xy_structure, iterations=steps % 10
-            )
-
+        self.dilated_cleft_mask = morphology.dilate(self.get_cleft_mask(), steps)
         return self.dilated_cleft_mask
 
     def find_all_partners(self):
@@ -346,6 +306,7 @@ class Matchmaker(object):
         self.segf = z5py.File(seg_file, use_zarr_format=False)
         self.cleft_cc = self.synf[cleft_cc_ds]
         self.cleft_cc_np = self.synf[cleft_cc_ds][:]
+        self.cleft_index = LabelIndex(self.cleft_cc_np)
         self.seg = self.segf[seg_ds]
         self.partners = None
         self.num_cores = num_cores
@@ -353,10 +314,7 @@ class Matchmaker(object):
         # self.list_of_clefts = Parallel(n_jobs=self.num_cores)(delayed(Cleft.__init__)(Cleft.__new__(Cleft), self,
         # cid) for cid in inputs)
         print("finding all clefts...")
-        try:
-            self.list_of_cleftids = range(1, self.cleft_cc.attrs["max_id"] + 1)
-        except AssertionError:
-            self.list_of_cleftids = np.unique(self.cleft_cc[:])[1:]
+        self.list_of_cleftids = self.cleft_index.ids()
         self.list_of_clefts = [
             Cleft(self, cid, safe_mem=safe_mem) for cid in self.list_of_cleftids
         ]
@@ -1,19 +1,19 @@
 import luigi
 import os
-import numpy as np
-import scipy.ndimage
 import z5py
-from threshold_luigi import Threshold
+from crop_luigi import Crop, SampleTask
+from utils.blockwise_cc import label_volume
 
 
-class ConnectedComponents(luigi.Task):
+class ConnectedComponents(SampleTask):
     it = luigi.IntParameter()
     dt = luigi.Parameter()
     aug = luigi.Parameter()
     de = luigi.Parameter()
+    s = luigi.Parameter()
     samples = luigi.TupleParameter()
     data_eval = luigi.TupleParameter()
-    resources = {"ram": 10}
+    default_ram = 10
 
     @property
     def priority(self):
@@ -23,60 +23,38 @@ class ConnectedComponents(luigi.Task):
             return 0.0
 
     def requires(self):
-        return Threshold(
-            self.it, self.dt, self.aug, self.de, self.samples, self.data_eval
+        return Crop(
+            self.it, self.dt, self.aug, self.de, self.s, self.samples, self.data_eval
         )
 
     def output(self):
         return luigi.LocalTarget(
-            os.path.join(os.path.dirname(self.input().fn), "cc.msg")
+            os.path.join(os.path.dirname(self.input().fn), self.s + ".cc.msg")
         )
 
     def run(self):
+        # threshold and double threshold connected components in one blockwise pass
         thr_high = 127
         thr_low = 42
-        dataset_src = "clefts_cropped_thr{0:}"
+        dataset_src = "clefts_cropped"
         dataset_tgt = "clefts_cropped_thr{0:}_cc{1:}".format(thr_high, thr_low)
-        progress = 0.0
-        self.set_progress_percentage(progress)
-        for s in self.samples:
-            filename = os.path.join(os.path.dirname(self.input().fn), s + ".n5")
-            f = z5py.File(filename, use_zarr_format=False)
-            assert (
-                f[dataset_src.format(thr_high)].attrs["offset"]
-                == f[dataset_src.format(thr_low)].attrs["offset"]
-            )
-            assert (
-                f[dataset_src.format(thr_high)].shape
-                == f[dataset_src.format(thr_low)].shape
-            )
-            f.create_dataset(
-                dataset_tgt,
-                shape=f[dataset_src.format(thr_high)].shape,
-                compression="gzip",
-                dtype="uint64",
-                chunks=f[dataset_src.format(thr_high)].chunks,
-            )
-            data_high_thr = np.array(f[dataset_src.format(thr_high)][:])
-            data_low_thr = np.array(f[dataset_src.format(thr_low)][:])
-            tgt = np.ones(data_low_thr.shape, dtype=np.uint64)
-            maxid = scipy.ndimage.label(data_low_thr, output=tgt)
-            maxes = scipy.ndimage.maximum(
-                data_high_thr, labels=tgt, index=range(1, maxid + 1)
-            )
-            maxes = np.array([0] + list(maxes))
-            factors = maxes[tgt]
-            tgt *= factors.astype(np.uint64)
-            maxid = scipy.ndimage.label(tgt, output=tgt)
-            f[dataset_tgt][:] = tgt.astype(np.uint64)
-            f[dataset_tgt].attrs["offset"] = f[dataset_src.format(thr_high)].attrs[
-                "offset"
-            ]
-            f[dataset_tgt].attrs["max_id"] = maxid
-            progress += 100.0 / len(self.samples)
-            try:
-                self.set_progress_percentage(progress)
-            except:
-                pass
+        filename = os.path.join(os.path.dirname(self.input().fn), self.s + ".n5")
+        f = z5py.File(filename, use_zarr_format=False)
+        f.create_dataset(
+            dataset_tgt,
+            shape=f[dataset_src].shape,
+            compression="gzip",
+            dtype="uint64",
+            chunks=f[dataset_src].chunks,
+        )
+        maxid = label_volume(
+            (filename, dataset_src),
+            (filename, dataset_tgt),
+            thr=thr_low,
+            seeds=(filename, dataset_src),
+            thr_seeds=thr_high,
+        )
+        f[dataset_tgt].attrs["offset"] = f[dataset_src].attrs["offset"]
+        f[dataset_tgt].attrs["max_id"] = maxid
         done = self.output().open("w")
         done.close()
@@ -1,89 +1,88 @@
 import luigi
 import os
 import numpy as np
-from scipy import ndimage
 import h5py
 import json
 import z5py
-from threshold_luigi import Threshold
+from utils.cleft_evaluation import Clefts
+from utils.results_store import ResultsStore
+from crop_luigi import Crop, SampleTask
 
-# d OUTSIDE
-# e INVALID
-# f TRANSPARENT
-class Clefts:
-    def __init__(self, to_be_evaluated, gt, inverted_mask):
-        test_clefts = to_be_evaluated
-        truth_clefts = gt
-        self.truth_clefts_invalid = np.logical_or(
-            truth_clefts == 0xFFFFFFFFFFFFFFFE, truth_clefts == 0xFFFFFFFFFFFFFFFD
+
+class SampleCleftReport(SampleTask):
+    it = luigi.IntParameter()
+    dt = luigi.Parameter()
+    aug = luigi.Parameter()
+    de = luigi.Parameter()
+    m = luigi.Parameter()
+    s = luigi.Parameter()
+    samples = luigi.TupleParameter()
+    data_eval = luigi.TupleParameter()
+    default_ram = 10
+
+    @property
+    def priority(self):
+        if int(self.it) % 10000 == 0:
+            return 1.0 / int(self.it)
+        else:
+            return 0.0
+
+    def requires(self):
+        return Crop(
+            self.it, self.dt, self.aug, self.de, self.s, self.samples, self.data_eval
         )
 
-        self.truth_clefts_mask = np.logical_or(
-            np.logical_or(
-                truth_clefts == 0xFFFFFFFFFFFFFFFF, self.truth_clefts_invalid
-            ),
-            inverted_mask,
+    def output(self):
+        cleftrep = os.path.join(
+            os.path.dirname(self.input().fn), self.s + ".cleft." + self.m + ".json"
         )
+        return luigi.LocalTarget(cleftrep)
 
-        self.test_clefts_mask = np.logical_or.reduce(
-            (test_clefts == 0, self.truth_clefts_invalid, inverted_mask)
+    def run(self):
+        thr = 127
+        testfile = os.path.join(os.path.dirname(self.input().fn), self.s + ".n5")
+        truthfile = os.path.join(
+            "/groups/saalfeld/saalfeldlab/larissa/data/cremieval/",
+            self.de,
+            self.s + ".n5",
         )
-        self.test_clefts_edt = ndimage.distance_transform_edt(
-            self.test_clefts_mask, sampling=(40.0, 4.0, 4.0)
+        # the whole crop is loaded anyway, no need for a thresholded copy
+        test = (
+            np.array(z5py.File(testfile, use_zarr_format=False)["clefts_cropped"][:])
+            > thr
+        ).astype(np.uint8)
+        truth = np.array(
+            z5py.File(truthfile, use_zarr_format=False)[
+                "volumes/labels/clefts_cropped"
+            ][:]
         )
-        self.truth_clefts_edt = ndimage.distance_transform_edt(
-            self.truth_clefts_mask, sampling=(40.0, 4.0, 4.0)
+        mask = np.array(
+            z5py.File(truthfile, use_zarr_format=False)[
+                "volumes/masks/" + self.m + "_cropped"
+            ][:]
         )
-
-    def count_false_positives(self, threshold=200):
-        mask1 = np.invert(self.test_clefts_mask)
-        mask2 = self.truth_clefts_edt > threshold
-        false_positives = self.truth_clefts_edt[np.logical_and(mask1, mask2)]
-        return false_positives.size
-
-    def count_false_negatives(self, threshold=200):
-        mask1 = np.invert(self.truth_clefts_mask)
-        mask2 = self.test_clefts_edt > threshold
-        false_negatives = self.test_clefts_edt[np.logical_and(mask1, mask2)]
-        return false_negatives.size
-
-    def acc_false_positives(self):
-        mask = np.invert(self.test_clefts_mask)
-        false_positives = self.truth_clefts_edt[mask]
-        try:
-            stats = {
-                "mean": np.mean(false_positives),
-                "std": np.std(false_positives),
-                "max": np.amax(false_positives),
-                "count": false_positives.size,
-                "median": np.median(false_positives),
-            }
-        except ValueError:
-            assert np.sum(mask) == 0
-            stats = {
-                "mean": np.mean(false_positives),
-                "std": np.std(false_positives),
-                "max": 0,
-                "count": false_positives.size,
-                "median": np.median(false_positives),
-            }
-
-        return stats
-
-    def acc_false_negatives(self):
-        mask = np.invert(self.truth_clefts_mask)
-        false_negatives = self.test_clefts_edt[mask]
-        stats = {
-            "mean": np.mean(false_negatives),
-            "std": np.std(false_negatives),
-            "max": np.amax(false_negatives),
-            "count": false_negatives.size,
-            "median": np.median(false_negatives),
-        }
-        return stats
+        clefts_evaluation = Clefts(test, truth, np.logical_not(mask))
+        results = dict()
+        results["false negatives count"] = clefts_evaluation.count_false_negatives()
+        results["false positives count"] = clefts_evaluation.count_false_positives()
+        results["false negative distance"] = clefts_evaluation.acc_false_negatives()
+        results["false positive distance"] = clefts_evaluation.acc_false_positives()
+        ResultsStore().add(
+            "cleft",
+            results,
+            experiment=self.dt,
+            augmentation=self.aug,
+            data_eval=self.de,
+            sample=self.s,
+            iteration=self.it,
+            mode=self.m,
+        )
+        with self.output().open("w") as done:
+            json.dump(results, done)
 
 
 class CleftReport(luigi.Task):
+    # collects the reports of all samples, which are evaluated by independent tasks
     it = luigi.IntParameter()
     dt = luigi.Parameter()
     aug = luigi.Parameter()
@@ -91,7 +90,6 @@ class CleftReport(luigi.Task):
     m = luigi.Parameter()
     samples = luigi.TupleParameter()
     data_eval = luigi.TupleParameter()
-    resources = {"ram": 10}
 
     @property
     def priority(self):
@@ -101,61 +99,30 @@ class CleftReport(luigi.Task):
             return 0.0
 
     def requires(self):
-        return Threshold(
-            self.it, self.dt, self.aug, self.de, self.samples, self.data_eval
-        )
+        return [
+            SampleCleftReport(
+                self.it,
+                self.dt,
+                self.aug,
+                self.de,
+                self.m,
+                s,
+                self.samples,
+                self.data_eval,
+            )
+            for s in self.samples
+        ]
 
     def output(self):
         cleftrep = os.path.join(
-            os.path.dirname(self.input().fn), "cleft." + self.m + ".json"
+            os.path.dirname(self.input()[0].fn), "cleft." + self.m + ".json"
         )
         return luigi.LocalTarget(cleftrep)
 
     def run(self):
-        progress = 0.0
-        self.set_progress_percentage(progress)
         results = dict()
-        for s in self.samples:
-            thr = 127
-            testfile = os.path.join(os.path.dirname(self.input().fn), s + ".n5")
-            truthfile = os.path.join(
-                "/groups/saalfeld/saalfeldlab/larissa/data/cremieval/",
-                self.de,
-                s + ".n5",
-            )
-            test = np.array(
-                z5py.File(testfile, use_zarr_format=False)[
-                    "clefts_cropped_thr" + str(thr)
-                ][:]
-            )
-            truth = np.array(
-                z5py.File(truthfile, use_zarr_format=False)[
-                    "volumes/labels/clefts_cropped"
-                ][:]
-            )
-            mask = np.array(
-                z5py.File(truthfile, use_zarr_format=False)[
-                    "volumes/masks/" + self.m + "_cropped"
-                ][:]
-            )
-            clefts_evaluation = Clefts(test, truth, np.logical_not(mask))
-            results[s] = dict()
-            results[s][
-                "false negatives count"
-            ] = clefts_evaluation.count_false_negatives()
-            results[s][
-                "false positives count"
-            ] = clefts_evaluation.count_false_positives()
-            results[s][
-                "false negative distance"
-            ] = clefts_evaluation.acc_false_negatives()
-            results[s][
-                "false positive distance"
-            ] = clefts_evaluation.acc_false_positives()
-            progress += 100.0 / len(self.samples)
-            try:
-                self.set_progress_percentage(progress)
-            except:
-                pass
+        for s, report in zip(self.samples, self.input()):
+            with report.open("r") as f:
+                results[s] = json.load(f)
         with self.output().open("w") as done:
             json.dump(results, done)
@@ -1,7 +1,10 @@
 import luigi
 import os
 import z5py
+import numpy as np
+from utils import streaming
 from prediction_luigi import Predict
+from profile_luigi import ProfiledTask
 
 
 offsets = dict()
@@ -14,14 +17,31 @@ shapes["B"] = {True: (125, 1451, 2112), False: (125, 1250, 1250)}
 shapes["C"] = {True: (125, 1578, 1469), False: (125, 1250, 1250)}
 
 
-class Crop(luigi.Task):
+def is_aligned(de):
+    return "unaligned" not in de
+
+
+class SampleTask(ProfiledTask):
+    # tasks that process the cropped volume of a single sample s of de
+    def volume_shape(self):
+        return shapes[self.s][is_aligned(self.de)]
+
+    def fallback_ram(self):
+        # default_ram used to be picked for looping over all samples, i.e. for the largest one
+        aligned = is_aligned(self.de)
+        largest = max(np.prod(sh[aligned]) for sh in shapes.values())
+        return int(np.ceil(self.default_ram * self.voxels() / float(largest)))
+
+
+class Crop(SampleTask):
     it = luigi.IntParameter()
     dt = luigi.Parameter()
     aug = luigi.Parameter()
     de = luigi.Parameter()
+    s = luigi.Parameter()
     samples = luigi.TupleParameter()
     data_eval = luigi.TupleParameter()
-    resources = {"ram": 50}
+    default_ram = 50
 
     @property
     def priority(self):
@@ -36,43 +56,36 @@ class Crop(luigi.Task):
 
     def output(self):
         return luigi.LocalTarget(
-            os.path.join(os.path.dirname(self.input().fn), self.de, "crop.msg")
+            os.path.join(
+                os.path.dirname(self.input().fn), self.de, self.s + ".crop.msg"
+            )
         )
 
     def run(self):
         progress = 0.0
         self.set_progress_percentage(progress)
-        if "unaligned" in self.de:
-            aligned = False
-        else:
-            aligned = True
-        for s in self.samples:
-            filename = os.path.join(
-                os.path.dirname(self.input().fn), self.de, s + ".n5"
+        aligned = is_aligned(self.de)
+        filename = os.path.join(
+            os.path.dirname(self.input().fn), self.de, self.s + ".n5"
+        )
+        datasets_src = ["clefts", "pre_dist", "post_dist"]
+        datasets_tgt = ["clefts_cropped", "pre_dist_cropped", "post_dist_cropped"]
+        off = offsets[self.s][aligned]
+        sh = shapes[self.s][aligned]
+        f = z5py.File(filename, use_zarr_format=False)
+        for dss, dst in zip(datasets_src, datasets_tgt):
+            chunk_size = tuple(min(c, shi) for c, shi in zip(f[dss].chunks, sh))
+            f.create_dataset(
+                dst, shape=sh, compression="gzip", dtype=f[dss].dtype, chunks=chunk_size
             )
-            datasets_src = ["clefts", "pre_dist", "post_dist"]
-            datasets_tgt = ["clefts_cropped", "pre_dist_cropped", "post_dist_cropped"]
-            off = offsets[s][aligned]
-            sh = shapes[s][aligned]
-            f = z5py.File(filename, use_zarr_format=False)
-            for dss, dst in zip(datasets_src, datasets_tgt):
-                chunk_size = tuple(min(c, shi) for c, shi in zip(f[dss].chunks, sh))
-                f.create_dataset(
-                    dst,
-                    shape=sh,
-                    compression="gzip",
-                    dtype=f[dss].dtype,
-                    chunks=chunk_size,
-                )
-                bb = tuple(slice(o, o + shi, None) for o, shi in zip(off, sh))
-                f[dst][:] = f[dss][bb]
-                f[dst].attrs["offset"] = off[::-1]
+            streaming.stream(f[dss], [(f[dst], streaming.copy)], offset=off)
+            f[dst].attrs["offset"] = off[::-1]
 
-                progress += 100.0 / (len(self.samples) * len(datasets_src))
-                try:
-                    self.set_progress_percentage(progress)
-                except:
-                    pass
+            progress += 100.0 / len(datasets_src)
+            try:
+                self.set_progress_percentage(progress)
+            except:
+                pass
 
         done = self.output().open("w")
         done.close()
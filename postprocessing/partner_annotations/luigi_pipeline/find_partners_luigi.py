@@ -3,11 +3,15 @@ import luigi
 import z5py
 import os
 import numpy as np
-import numpy.ma as ma
 import scipy.ndimage
 import itertools
 import cremi
+from utils.label_index import LabelIndex, label_segment_components, sum_labels
+from utils import morphology
+from utils.point_cloud import PointCloud
+from utils.partner_cache import PartnerCache, content_key
 from cc_luigi import ConnectedComponents
+from crop_luigi import SampleTask
 import logging
 
 SEG_BG_VAL = 0
@@ -32,7 +36,7 @@ class SynapticRegion(object):
         self,
         segmentid,
         parentcleft,
-        region,
+        label,
         pre_thr=42,
         post_thr=42,
         size_thr=5,
@@ -40,6 +44,7 @@ class SynapticRegion(object):
     ):
         self.segmentid = segmentid
         self.cleft = parentcleft
+        self.label = label
         self.pre_thr = pre_thr
         self.post_thr = post_thr
         self.dist_thr = dist_thr
@@ -56,24 +61,29 @@ class SynapticRegion(object):
         self.post_status = None
 
         # these are wasteful to keep
-        self.region_for_acc = region
+        self.region_for_acc = None
         self.dilated_region = None
         self.eroded_region = None
         self.region_minus_cleft = None
-        self.distance_map = None
+        self.point_cloud = None
         self.segmask_eroded = None
         self.region_for_point = None
 
     def uninitialize_mem_save(self):
         self.region_for_acc = None
         self.region_minus_cleft = None
-        self.distance_map = None
+        self.point_cloud = None
         self.segmask_eroded = None
         self.region_for_point = None
 
     def get_region_for_acc(self):
+        if self.region_for_acc is None:
+            self.make_region_for_acc()
         return self.region_for_acc
 
+    def make_region_for_acc(self):
+        self.region_for_acc = self.cleft.get_region_labels() == self.label
+
     def get_eroded_region(self):
         if self.eroded_region is None:
             self.erode_region()
@@ -85,7 +95,7 @@ class SynapticRegion(object):
         return self.size
 
     def accumulate_acc_size(self):
-        self.size = float(np.sum(self.get_region_for_acc()))
+        self.size = float(self.cleft.get_region_sizes()[self.label])
 
     def get_pre_evidence(self):
         if self.pre_evidence is None:
@@ -94,10 +104,7 @@ class SynapticRegion(object):
 
     def accumulate_pre_evidence(self):
         try:
-            ev = (
-                np.sum(self.cleft.get_pre()[self.get_region_for_acc()])
-                / self.get_size()
-            )
+            ev = self.cleft.get_region_pre_sums()[self.label] / self.get_size()
         except RuntimeWarning:
             print(np.sum(self.get_region_for_acc()))
             print(self.get_region_for_acc())
@@ -115,10 +122,7 @@ class SynapticRegion(object):
 
     def accumulate_post_evidence(self):
         try:
-            ev = (
-                np.sum(self.cleft.get_post()[self.get_region_for_acc()])
-                / self.get_size()
-            )
+            ev = self.cleft.get_region_post_sums()[self.label] / self.get_size()
         except RuntimeWarning:
             print(np.sum(self.get_region_for_acc()))
             print(self.get_region_for_acc())
@@ -147,32 +151,19 @@ class SynapticRegion(object):
         return self.post_status
 
     def erode_region(self):
-        self.eroded_region = self.get_region_for_acc()
-        xy_structure = np.zeros((3, 3, 3))
-        xy_structure[1, :] = np.ones((3, 3))
-        z_structure = np.zeros((3, 3, 3))
-        z_structure[:, 1, 1] = np.ones((3,))
-        for k in range(int(self.erosion_steps / 10.0)):
-            self.eroded_region = scipy.ndimage.morphology.binary_erosion(
-                self.eroded_region, structure=xy_structure, iterations=10
-            )
-            self.eroded_region = scipy.ndimage.morphology.binary_erosion(
-                self.eroded_region, structure=z_structure, iterations=1
-            )
-        if self.erosion_steps % 10 != 0:
-            self.eroded_region = scipy.ndimage.morphology.binary_erosion(
-                self.eroded_region,
-                structure=xy_structure,
-                iterations=self.erosion_steps % 10,
-            )
-        if not np.any(self.eroded_region):
-            self.erosion_steps -= 1
+        self.eroded_region = self.erode_without_vanishing(self.get_region_for_acc())
+
+    def erode_without_vanishing(self, mask):
+        erosion = morphology.ErosionDepth(mask)
+        steps = erosion.max_steps(self.erosion_steps)
+        if steps != self.erosion_steps:
             print(
-                "segment {0:} has been eroded so much that it disappeared, try with one less step, i.e. {1:}".format(
-                    self.segmentid, self.erosion_steps
+                "segment {0:} disappears when eroded by {1:} steps, using {2:} steps instead".format(
+                    self.segmentid, self.erosion_steps, steps
                 )
             )
-            self.erode_region()
+            self.erosion_steps = steps
+        return erosion.erode(steps)
 
     def get_region_for_point(self):
         if self.region_for_point is None:
@@ -191,20 +182,16 @@ class SynapticRegion(object):
             )
             self.region_for_point = self.get_eroded_region()
 
-    def get_distance_map(self):
-        if self.distance_map is None:
-            self.compute_distance_map()
-        return self.distance_map
+    def get_point_cloud(self):
+        if self.point_cloud is None:
+            self.make_point_cloud()
+        return self.point_cloud
 
-    def compute_distance_map(self):
-        self.distance_map = scipy.ndimage.morphology.distance_transform_edt(
-            np.logical_not(self.get_region_for_point()), sampling=(40, 4, 4)
-        )
+    def make_point_cloud(self):
+        self.point_cloud = PointCloud(self.get_region_for_point(), (40, 4, 4))
 
     def is_neighbor(self, partner):
-        structure = np.zeros((3, 3, 3))
-        structure[1, :] = np.ones((3, 3))
-        structure[:, 1, 1] = np.ones((3,))
+        structure = morphology.NEIGHBOR_STRUCTURE
         if self.segmentid == partner.segmentid:
             return False
         else:
@@ -233,13 +220,9 @@ class SynapticRegion(object):
                 )
             )
             return False
-        post_masked_distance_map = ma.array(
-            self.get_distance_map(), mask=np.logical_not(partner.get_region_for_point())
+        post_spot, post_to_pre_dist = partner.get_point_cloud().closest_to(
+            self.get_point_cloud()
         )
-        post_spot = np.unravel_index(
-            np.argmin(post_masked_distance_map), post_masked_distance_map.shape
-        )
-        post_to_pre_dist = post_masked_distance_map[post_spot]
         self.distances.append(post_to_pre_dist)
         if post_to_pre_dist >= self.dist_thr:
             print(
@@ -248,12 +231,7 @@ class SynapticRegion(object):
                 )
             )
             return False
-        pre_masked_distance_map = ma.array(
-            partner.get_distance_map(), mask=np.logical_not(self.get_region_for_point())
-        )
-        pre_spot = np.unravel_index(
-            np.argmin(pre_masked_distance_map), pre_masked_distance_map.shape
-        )
+        pre_spot, _ = self.get_point_cloud().closest_to(partner.get_point_cloud())
         pre_spot = np.array(pre_spot)
         post_spot = np.array(post_spot)
         vec = (post_spot - pre_spot) * np.array([40, 4, 4]) / post_to_pre_dist
@@ -301,10 +279,9 @@ class Cleft(object):
         self.mm = matchmaker
         self.cleft_id = cleft_id
         self.safe_mem = safe_mem
+        self.thresholds = (pre_thr, post_thr, size_thr, dist_thr)
 
-        cleft_mask_full = self.mm.cleft_cc_np == cleft_id
-
-        bbox = bbox_ND(cleft_mask_full)
+        bbox = self.mm.cleft_index.get_bbox(cleft_id)
 
         bbox = [
             bb + shift
@@ -322,11 +299,11 @@ class Cleft(object):
         ]
 
         bbox[0] = max(0, bbox[0])
-        bbox[1] = min(cleft_mask_full.shape[0], bbox[1])
+        bbox[1] = min(self.mm.cleft_index.shape[0], bbox[1])
         bbox[2] = max(0, bbox[2])
-        bbox[3] = min(cleft_mask_full.shape[1], bbox[3])
+        bbox[3] = min(self.mm.cleft_index.shape[1], bbox[3])
         bbox[4] = max(0, bbox[4])
-        bbox[5] = min(cleft_mask_full.shape[2], bbox[5])
+        bbox[5] = min(self.mm.cleft_index.shape[2], bbox[5])
         self.bbox = bbox
         self.bbox_slice = (
             slice(bbox[0], bbox[1], None),
@@ -340,36 +317,76 @@ class Cleft(object):
         if self.safe_mem:
             self.cleft_mask = None
         else:
-            self.cleft_mask = cleft_mask_full[self.bbox_slice]
-        del cleft_mask_full
+            self.cleft_mask = self.mm.cleft_cc_np[self.bbox_slice] == cleft_id
         self.dilation_steps = dilation_steps
         self.dilated_cleft_mask = None
+        self.region_structure = morphology.NEIGHBOR_STRUCTURE
+        self.region_labels = None
+        self.region_segments = None
+        self.region_sizes = None
+        self.region_pre_sums = None
+        self.region_post_sums = None
 
         # self.region_for_acc = np.copy(self.get_cleft_mask())
         # self.region_for_acc[np.logical_not(self.get_seg() == self.segmentid)] = False
         self.segments_overlapping = self.find_segments()
 
-        self.synregions = []
-        structure = np.zeros((3, 3, 3))
-        structure[1, :] = np.ones((3, 3))
-        structure[:, 1, 1] = np.ones((3,))
-        for segid in self.segments_overlapping:
-            region = np.copy(self.get_cleft_mask())
-            region[np.logical_not(self.get_seg() == segid)] = False
-            region = region.astype(np.uint32)
-            num = scipy.ndimage.label(region, output=region, structure=structure)
-            for k in range(1, num + 1):
-                self.synregions.append(
-                    SynapticRegion(
-                        segid,
-                        self,
-                        region == k,
-                        pre_thr=pre_thr,
-                        post_thr=post_thr,
-                        size_thr=size_thr,
-                        dist_thr=dist_thr,
-                    )
-                )
+        self.synregions = [
+            SynapticRegion(
+                segid,
+                self,
+                k + 1,
+                pre_thr=pre_thr,
+                post_thr=post_thr,
+                size_thr=size_thr,
+                dist_thr=dist_thr,
+            )
+            for k, segid in enumerate(self.get_region_segments())
+        ]
+
+    def get_region_labels(self):
+        if self.region_labels is None:
+            self.set_region_labels()
+        return self.region_labels
+
+    def get_region_segments(self):
+        if self.region_segments is None:
+            self.set_region_labels()
+        return self.region_segments
+
+    def set_region_labels(self):
+        # components of the cleft mask within every overlapping segment, labeled in one pass over the cleft's bbox
+        self.region_labels, self.region_segments = label_segment_components(
+            self.get_cleft_mask(),
+            self.get_seg(),
+            self.region_structure,
+            bg_label=SEG_BG_VAL,
+        )
+
+    def get_region_sizes(self):
+        if self.region_sizes is None:
+            self.region_sizes = sum_labels(
+                self.get_region_labels(), len(self.get_region_segments())
+            )
+        return self.region_sizes
+
+    def get_region_pre_sums(self):
+        if self.region_pre_sums is None:
+            self.region_pre_sums = sum_labels(
+                self.get_region_labels(),
+                len(self.get_region_segments()),
+                weights=self.get_pre(),
+            )
+        return self.region_pre_sums
+
+    def get_region_post_sums(self):
+        if self.region_post_sums is None:
+            self.region_post_sums = sum_labels(
+                self.get_region_labels(),
+                len(self.get_region_segments()),
+                weights=self.get_post(),
+            )
+        return self.region_post_sums
 
     def get_cleft_mask(self):
         if self.cleft_mask is None:
@@ -412,7 +429,32 @@ class Cleft(object):
             pass
         return segments
 
+    def cache_key(self, quantization=1):
+        # everything the partners of this cleft depend on, pre/post predictions are quantized such that clefts whose
+        # predictions changed by less than quantization between checkpoints can reuse their results
+        return content_key(
+            (self.dilation_steps, self.thresholds, quantization),
+            self.get_cleft_mask(),
+            self.get_seg(),
+            self.get_pre() // quantization,
+            self.get_post() // quantization,
+        )
+
     def find_all_partners(self):
+        return self.to_global(self.find_local_partners())
+
+    def to_global(self, partners):
+        return [
+            (
+                tuple(cpl + bboff for cpl, bboff in zip(partner[0], self.bbox[::2])),
+                tuple(cpl + bboff for cpl, bboff in zip(partner[1], self.bbox[::2])),
+            )
+            + tuple(partner[2:])
+            for partner in partners
+        ]
+
+    def find_local_partners(self):
+        # partners with locations relative to the cleft's bbox
         pre_synregs = []
         post_synregs = []
         partners = []
@@ -427,8 +469,6 @@ class Cleft(object):
                 if answer is None or not answer:
                     continue
                 pre_loc, post_loc = answer
-                pre_loc = (cpl + bboff for cpl, bboff in zip(pre_loc, self.bbox[::2]))
-                post_loc = (cpl + bboff for cpl, bboff in zip(post_loc, self.bbox[::2]))
                 partners.append(
                     (
                         pre_loc,
@@ -447,6 +487,7 @@ class Cleft(object):
         for synreg in self.synregions:
             synreg.uninitialize_mem_save()
         self.dilated_cleft_mask = None
+        self.region_labels = None
         self.seg = None
         self.pre = None
         self.post = None
@@ -472,21 +513,23 @@ class Matchmaker(object):
         post_thr=42,
         dist_thr=600,
         size_thr=5,
+        partner_cache=None,
+        quantization=1,
     ):
         logging.debug("initializing matchmaker")
         self.synf = z5py.File(syn_file, use_zarr_format=False)
         self.segf = z5py.File(seg_file, use_zarr_format=False)
         self.cleft_cc = self.synf[cleft_cc_ds]
         self.cleft_cc_np = self.synf[cleft_cc_ds][:]
+        self.cleft_index = LabelIndex(self.cleft_cc_np)
         self.seg = self.segf[seg_ds]
         self.pre = self.synf[pre_ds]
         self.post = self.synf[post_ds]
         self.partners = None
+        self.partner_cache = partner_cache
+        self.quantization = quantization
         logging.debug("finding list of cleftids")
-        try:
-            self.list_of_cleftids = range(1, self.cleft_cc.attrs["max_id"] + 1)
-        except AssertionError:
-            self.list_of_cleftids = np.unique(self.cleft_cc[:])[1:]
+        self.list_of_cleftids = self.cleft_index.ids()
         logging.debug(
             "list of cleftids from {0:} to {1:}".format(
                 np.min(self.list_of_cleftids), np.max(self.list_of_cleftids)
@@ -550,10 +593,35 @@ class Matchmaker(object):
     def find_all_partners(self):
         print("finding partners...")
         self.partners = []
+        if self.partner_cache is None:
+            for cleft in self.list_of_clefts:
+                self.partners.extend(cleft.find_all_partners())
+
+                cleft.uninitialize_mem_save()
+            return
+        # clefts whose inputs did not change since they were last evaluated (e.g. at a previous checkpoint) reuse
+        # their partners, only the others are computed and added to the cache
+        keys = []
         for cleft in self.list_of_clefts:
-            self.partners.extend(cleft.find_all_partners())
-
+            keys.append(cleft.cache_key(self.quantization))
+            cleft.uninitialize_mem_save()
+        cached = self.partner_cache.get_many(keys)
+        computed = dict()
+        for cleft, key in zip(self.list_of_clefts, keys):
+            partners = cached.get(key)
+            if partners is None:
+                partners = computed.get(key)
+            if partners is None:
+                partners = cleft.find_local_partners()
+                computed[key] = partners
+            self.partners.extend(cleft.to_global(partners))
             cleft.uninitialize_mem_save()
+        self.partner_cache.put_many(computed)
+        logging.info(
+            "computed partners of {0:} clefts, reused {1:}".format(
+                len(computed), len(self.list_of_clefts) - len(computed)
+            )
+        )
 
     def extract_dat(
         self,
@@ -627,15 +695,21 @@ class Matchmaker(object):
         self.cremi_file.write_annotations(annotations)
 
 
-class FindPartners(luigi.Task):
+class FindPartners(SampleTask):
     it = luigi.IntParameter()
     dt = luigi.Parameter()
     aug = luigi.Parameter()
     de = luigi.Parameter()
+    s = luigi.Parameter()
     samples = luigi.TupleParameter()
     data_eval = luigi.TupleParameter()
-    resources = {"ram": 400}
+    # step by which the (uint8) pre/post predictions are quantized for the partner cache. Partners only depend on them
+    # through the mean preness/postness of a region, which a quantized crop determines to within one step: reused
+    # partners have preness/postness within 16 / 255 of the exact ones, and only regions with a mean within 16 of
+    # pre_thr/post_thr can be decided differently.
+    quantization = luigi.IntParameter(default=16)
     retry_count = 1
+    default_ram = 400
 
     @property
     def priority(self):
@@ -646,65 +720,61 @@ class FindPartners(luigi.Task):
 
     def requires(self):
         return ConnectedComponents(
-            self.it, self.dt, self.aug, self.de, self.samples, self.data_eval
+            self.it, self.dt, self.aug, self.de, self.s, self.samples, self.data_eval
         )
 
     def output(self):
         return luigi.LocalTarget(
-            os.path.join(os.path.dirname(self.input().fn), "partners.msg")
+            os.path.join(os.path.dirname(self.input().fn), self.s + ".partners.msg")
         )
 
     def run(self):
         logging.debug("Starting to run partner finding")
-        progress = 0.0
-        self.set_progress_percentage(progress)
         thr = 127
         cc_thr = 42
         pre_thr = 42
         post_thr = 42
         dist_thr = 600
         size_thr = 5
-        for s in self.samples:
-            logging.debug("Starting with sample {0:}".format(s))
-            filename = os.path.join(os.path.dirname(self.input().fn), s + ".h5")
-            syn_file = os.path.join(os.path.dirname(self.input().fn), s + ".n5")
-            cleft_cc_ds = "clefts_cropped_thr{0:}_cc{1:}".format(thr, cc_thr)
-            pre_ds = "pre_dist_cropped"
-            post_ds = "post_dist_cropped"
-            seg_file = os.path.join(
-                "/groups/saalfeld/saalfeldlab/larissa/data/cremieval/",
-                self.de,
-                s + ".n5",
-            )
-            seg_ds = "volumes/labels/neuron_ids_constis_slf1_sf750_cropped"
-            if "unaligned" in self.de:
-                aligned = False
-            else:
-                aligned = True
-            off = tuple(np.array(offsets[s][aligned]) * np.array((40, 4, 4)))
-            mm = Matchmaker(
-                syn_file,
-                cleft_cc_ds,
-                pre_ds,
-                post_ds,
-                seg_file,
-                seg_ds,
-                filename,
-                offset=off,
-                safe_mem=True,
-                dist_thr=dist_thr,
-                size_thr=size_thr,
-                pre_thr=pre_thr,
-                post_thr=post_thr,
-            )
-            # mm.prepare_file()
-            mm.write_partners()
-            mm.cremi_file.close()
-            del mm
-            progress += 100.0 / len(self.samples)
-            try:
-                self.set_progress_percentage(progress)
-            except:
-                pass
+        logging.debug("Starting with sample {0:}".format(self.s))
+        filename = os.path.join(os.path.dirname(self.input().fn), self.s + ".h5")
+        syn_file = os.path.join(os.path.dirname(self.input().fn), self.s + ".n5")
+        cleft_cc_ds = "clefts_cropped_thr{0:}_cc{1:}".format(thr, cc_thr)
+        pre_ds = "pre_dist_cropped"
+        post_ds = "post_dist_cropped"
+        seg_file = os.path.join(
+            "/groups/saalfeld/saalfeldlab/larissa/data/cremieval/",
+            self.de,
+            self.s + ".n5",
+        )
+        seg_ds = "volumes/labels/neuron_ids_constis_slf1_sf750_cropped"
+        if "unaligned" in self.de:
+            aligned = False
+        else:
+            aligned = True
+        off = tuple(np.array(offsets[self.s][aligned]) * np.array((40, 4, 4)))
+        mm = Matchmaker(
+            syn_file,
+            cleft_cc_ds,
+            pre_ds,
+            post_ds,
+            seg_file,
+            seg_ds,
+            filename,
+            offset=off,
+            safe_mem=True,
+            dist_thr=dist_thr,
+            size_thr=size_thr,
+            pre_thr=pre_thr,
+            post_thr=post_thr,
+            partner_cache=PartnerCache(
+                "/nrs/saalfeld/heinrichl/synapses/data_and_augmentations/partner_cache.sqlite"
+            ),
+            quantization=self.quantization,
+        )
+        # mm.prepare_file()
+        mm.write_partners()
+        mm.cremi_file.close()
+        del mm
         done = self.output().open("w")
         done.close()
@@ -1,21 +1,27 @@
 import luigi
 import os
 import json
-from cremi.io import CremiFile
-from cremi.evaluation import SynapticPartners
 from split_modi_luigi import SplitModi
+from crop_luigi import SampleTask
+from utils.partner_evaluation import TruthCache, evaluate_partners
+from utils.results_store import ResultsStore
 
+# ground truth converted for memory mapping, shared by all evaluations of all iterations
+truth_cache = TruthCache(
+    "/nrs/saalfeld/heinrichl/synapses/data_and_augmentations/truth_cache"
+)
 
-class PartnerReport(luigi.Task):
+
+class SamplePartnerReport(SampleTask):
     it = luigi.IntParameter()
     dt = luigi.Parameter()
     aug = luigi.Parameter()
     de = luigi.Parameter()
     m = luigi.Parameter()
-
+    s = luigi.Parameter()
     samples = luigi.TupleParameter()
     data_eval = luigi.TupleParameter()
-    resources = {"ram": 50}
+    default_ram = 50
 
     @property
     def priority(self):
@@ -26,50 +32,92 @@ class PartnerReport(luigi.Task):
 
     def requires(self):
         return SplitModi(
-            self.it, self.dt, self.aug, self.de, self.m, self.samples, self.data_eval
+            self.it,
+            self.dt,
+            self.aug,
+            self.de,
+            self.m,
+            self.s,
+            self.samples,
+            self.data_eval,
         )
 
     def output(self):
         return luigi.LocalTarget(
             os.path.join(
-                os.path.dirname(self.input().fn), "partners." + self.m + ".json"
+                os.path.dirname(self.input().fn),
+                self.s + ".partners." + self.m + ".json",
             )
         )
 
     def run(self):
-        progress = 0.0
-        results = dict()
-        self.set_progress_percentage(progress)
-        for s in self.samples:
-            truth = os.path.join(
-                "/groups/saalfeld/saalfeldlab/larissa/data/cremieval/",
+        truth = os.path.join(
+            "/groups/saalfeld/saalfeldlab/larissa/data/cremieval/",
+            self.de,
+            self.s + "." + self.m + ".h5",
+        )
+        test = os.path.join(
+            os.path.dirname(self.input().fn), self.s + "." + self.m + ".h5"
+        )
+        results = evaluate_partners(test, truth, truth_cache)
+        ResultsStore().add(
+            "partners",
+            results,
+            experiment=self.dt,
+            augmentation=self.aug,
+            data_eval=self.de,
+            sample=self.s,
+            iteration=self.it,
+            mode=self.m,
+        )
+        with self.output().open("w") as done:
+            json.dump(results, done)
+
+
+class PartnerReport(luigi.Task):
+    # collects the reports of all samples, which are evaluated by independent tasks
+    it = luigi.IntParameter()
+    dt = luigi.Parameter()
+    aug = luigi.Parameter()
+    de = luigi.Parameter()
+    m = luigi.Parameter()
+
+    samples = luigi.TupleParameter()
+    data_eval = luigi.TupleParameter()
+
+    @property
+    def priority(self):
+        if int(self.it) % 10000 == 0:
+            return 1.0 / int(self.it)
+        else:
+            return 0.0
+
+    def requires(self):
+        return [
+            SamplePartnerReport(
+                self.it,
+                self.dt,
+                self.aug,
                 self.de,
-                s + "." + self.m + ".h5",
+                self.m,
+                s,
+                self.samples,
+                self.data_eval,
             )
-            test = os.path.join(
-                os.path.dirname(self.input().fn), s + "." + self.m + ".h5"
-            )
-            truth = CremiFile(truth, "a")
-            test = CremiFile(test, "a")
-            synaptic_partners_eval = SynapticPartners()
-            print(test.read_annotations())
-            fscore, precision, recall, fp, fn, filtered_matches = synaptic_partners_eval.fscore(
-                test.read_annotations(),
-                truth.read_annotations(),
-                truth.read_neuron_ids(),
-                all_stats=True,
+            for s in self.samples
+        ]
+
+    def output(self):
+        return luigi.LocalTarget(
+            os.path.join(
+                os.path.dirname(self.input()[0].fn), "partners." + self.m + ".json"
             )
-            results[s] = dict()
-            results[s]["fscore"] = fscore
-            results[s]["precision"] = precision
-            results[s]["recall"] = recall
-            results[s]["fp"] = fp
-            results[s]["fn"] = fn
-            results[s]["filtered_matches"] = filtered_matches
-            progress += 100.0 / len(self.samples)
-            try:
-                self.set_progress_percentage(progress)
-            except:
-                pass
+        )
+
+    def run(self):
+        results = dict()
+        for s, report in zip(self.samples, self.input()):
+            with report.open("r") as f:
+                results[s] = json.load(f)
         with self.output().open("w") as done:
             json.dump(results, done)
@@ -1,39 +1,61 @@
-import sys
-
-sys.path.append("/groups/saalfeld/home/heinrichl/Projects/simpleference")
 import luigi
 import os
-import re
 import z5py
-import json
 from concurrent.futures import ProcessPoolExecutor
 import subprocess
+import logging
 from prepare_luigi import MakeItFolder, CheckCheckpoint
-from simpleference.inference.util import get_offset_lists
+from utils.block_queue import BlockQueue, FAILED
+from utils.block_planning import offsets_in_mask, all_offsets
+from utils.inference_service import is_serving, wait_for_service, submit
+
+# one socket per device, named gpu<i> for the gpu with index i and cpu<i> for the i-th worker on the cpu
+inference_socket = "/tmp/cnnectome_inference/{0:}.sock"
 
 
-def single_inference(data_train, augmentation, data_eval, samples, gpu, iteration):
-    subprocess.call(
+def start_inference_worker(device):
+    # starts a persistent inference worker for the device, which keeps running for later iterations
+    if not os.path.exists(os.path.dirname(inference_socket)):
+        os.makedirs(os.path.dirname(inference_socket))
+    subprocess.Popen(
         [
             "/groups/saalfeld/home/heinrichl/Projects/CNNectome/postprocessing/partner_annotations_luigi"
             "/run_inference"
             ".sh",
-            data_train,
-            augmentation,
-            data_eval,
-            samples,
-            gpu,
-            iteration,
+            device,
+            inference_socket.format(device),
         ]
     )
 
 
+def single_inference(data_train, augmentation, queue_file, device, iteration):
+    address = inference_socket.format(device)
+    if not is_serving(address):
+        start_inference_worker(device)
+        wait_for_service(address)
+    return submit(
+        address,
+        dict(
+            data_train=data_train,
+            augmentation=augmentation,
+            queue_file=queue_file,
+            iteration=int(iteration),
+        ),
+    )
+
+
 class Predict(luigi.Task):
     it = luigi.IntParameter()
     dt = luigi.Parameter()
     aug = luigi.Parameter()
     samples = luigi.TupleParameter()
     data_eval = luigi.TupleParameter()
+    # additional workers that run on the cpu, e.g. for testing without gpus
+    cpu_workers = luigi.IntParameter(default=0, significant=False)
+    # only blocks that intersect this mask (of the raw data) are predicted, empty for all blocks
+    mask_dataset = luigi.Parameter(
+        default="volumes/masks/groundtruth", significant=False
+    )
     resources = {"gpu": 1, "ram": 10}
 
     @property
@@ -51,160 +73,106 @@ class Predict(luigi.Task):
             os.path.join(os.path.dirname(self.input().fn), "pred.msg")
         )
 
-    def run(self):
+    def queue_file(self):
+        return os.path.join(os.path.dirname(self.input().fn), "blocks.sqlite")
 
+    def run(self):
+        # all blocks of all samples go into a single queue that the workers (one per free gpu) pull from, such that a
+        # slow or failing device does not hold up the others and only blocks that are not done are ever redone
         src = "/groups/saalfeld/saalfeldlab/larissa/data/cremieval/{0:}/{1:}.n5"
         tgt = os.path.join(os.path.dirname(self.input().fn), "{0:}", "{1:}.n5")
         output_shape = (71, 650, 650)
-        gpu_list = []
-        for i in range(8):
-            nvsmi = subprocess.Popen(
-                "nvidia-smi -d PIDS -q -i {0:}".format(i),
-                shell=True,
-                stdout=subprocess.PIPE,
-            ).stdout.read()
-            if "None" in nvsmi:
-                gpu_list.append(i)
-        completed = []
+        queue = BlockQueue(self.queue_file())
+        # blocks that failed repeatedly in an earlier run of this task get another chance
+        queue.retry_failed()
         for de in self.data_eval:
             for s in self.samples:
                 srcf = z5py.File(src.format(de, s), use_zarr_format=False)
                 shape = srcf["volumes/raw"].shape
                 tgtf = z5py.File(tgt.format(de, s), use_zarr_format=False)
-                if not os.path.exists(os.path.join(tgt.format(de, s), "clefts")):
-                    tgtf.create_dataset(
-                        "clefts",
-                        shape=shape,
-                        compression="gzip",
-                        dtype="uint8",
-                        chunks=output_shape,
-                    )
-                    completed.append(False)
-                else:
-                    if self.check_completeness()[0]:
-                        completed.append(True)
-                    else:
-                        completed.append(False)
-                if not os.path.exists(os.path.join(tgt.format(de, s), "pre_dist")):
-                    tgtf.create_dataset(
-                        "pre_dist",
-                        shape=shape,
-                        compression="gzip",
-                        dtype="uint8",
-                        chunks=output_shape,
+                for ds in ["clefts", "pre_dist", "post_dist"]:
+                    if not os.path.exists(os.path.join(tgt.format(de, s), ds)):
+                        tgtf.create_dataset(
+                            ds,
+                            shape=shape,
+                            compression="gzip",
+                            dtype="uint8",
+                            chunks=output_shape,
+                        )
+                if self.mask_dataset and self.mask_dataset in srcf:
+                    offsets = offsets_in_mask(
+                        srcf[self.mask_dataset], shape, output_shape
                     )
-                    completed.append(False)
                 else:
-                    if self.check_completeness()[0]:
-                        completed.append(True)
-                    else:
-                        completed.append(False)
-
-                if not os.path.exists(os.path.join(tgt.format(de, s), "post_dist")):
-
-                    tgtf.create_dataset(
-                        "post_dist",
-                        shape=shape,
-                        compression="gzip",
-                        dtype="uint8",
-                        chunks=output_shape,
+                    offsets = all_offsets(shape, output_shape)
+                queue.add(src.format(de, s), tgt.format(de, s), offsets)
+        devices = ["gpu{0:}".format(i) for i in self.free_gpus()] + [
+            "cpu{0:}".format(i) for i in range(self.cpu_workers)
+        ]
+        if len(devices) == 0:
+            raise AssertionError("No free gpus and no cpu workers to run inference")
+
+        rounds = 0
+        while not queue.is_done():
+            counts = queue.counts()
+            if counts[FAILED] > 0:
+                raise AssertionError(
+                    "{0:} blocks failed repeatedly, see {1:}".format(
+                        counts[FAILED], self.queue_file()
                     )
-                    completed.append(False)
-                else:
-                    if self.check_completeness()[0]:
-                        completed.append(True)
-                    else:
-                        completed.append(False)
-                get_offset_lists(
-                    shape, gpu_list, tgt.format(de, s), output_shape=output_shape
                 )
-        if all(completed):
-            self.finish()
-            return
-        self.submit_inference(self.data_eval, gpu_list)
-
-        reprocess_attempts = 0
-        while reprocess_attempts < 4:
-            complete, reprocess_list = self.check_completeness(gpu_list)
-            if complete:
-                self.finish()
-                return
-            else:
-                self.set_status_message(
-                    "Reprocessing {0:}, try {1:}".format(
-                        list(reprocess_list), reprocess_attempts
+            if rounds >= 4:
+                raise AssertionError(
+                    "Blocks are still not done after {0:} rounds: {1:}, see {2:}".format(
+                        rounds, counts, self.queue_file()
                     )
                 )
-                self.submit_inference(tuple(reprocess_list), gpu_list)
-                reprocess_attempts += 1
-        if reprocess_attempts >= 4:
-            raise AssertionError
+            self.set_status_message(
+                "Predicting {0:} blocks, round {1:}".format(counts, rounds)
+            )
+            self.submit_inference(devices)
+            # all workers have exited, blocks that are still claimed were lost with their worker
+            queue.release()
+            rounds += 1
+        self.finish()
+
+    def free_gpus(self):
+        # gpus without any process on them and gpus that run one of the persistent inference workers, which show up
+        # in nvidia-smi as well but take the jobs of every task
+        gpu_list = []
+        for i in range(8):
+            if is_serving(inference_socket.format("gpu{0:}".format(i))):
+                gpu_list.append(i)
+                continue
+            nvsmi = subprocess.Popen(
+                "nvidia-smi -d PIDS -q -i {0:}".format(i),
+                shell=True,
+                stdout=subprocess.PIPE,
+            ).stdout.read()
+            if "None" in nvsmi:
+                gpu_list.append(i)
+        return gpu_list
 
-    def submit_inference(self, data_eval, gpu_list):
-        with ProcessPoolExecutor(max_workers=len(gpu_list)) as pp:
+    def submit_inference(self, devices):
+        with ProcessPoolExecutor(max_workers=len(devices)) as pp:
             tasks = [
                 pp.submit(
                     single_inference,
                     self.dt,
                     self.aug,
-                    json.dumps(list(data_eval)).replace(" ", "").replace('"', '\\"'),
-                    json.dumps(list(self.samples)).replace(" ", "").replace('"', '\\"'),
-                    str(gpu),
+                    self.queue_file(),
+                    device,
                     str(self.it),
                 )
-                for gpu in gpu_list
+                for device in devices
             ]
-            result = [t.result() for t in tasks]
+            for device, t in zip(devices, tasks):
+                # blocks of a failed worker stay in the queue for the next round
+                try:
+                    t.result()
+                except Exception:
+                    logging.exception("Inference on {0:} failed".format(device))
 
     def finish(self):
         done = self.output().open("w")
         done.close()
-
-    def check_completeness(self, gpu_list=None):
-        complete = True
-        reprocess = set()
-        tgt = os.path.join(os.path.dirname(self.input().fn), "{0:}", "{1:}.n5")
-        pattern = re.compile("list_gpu_[0-7].json")
-        for de in self.data_eval:
-            for s in self.samples:
-                if gpu_list is None:
-                    gpu_list = []
-                    for fn in os.listdir(tgt.format(de, s)):
-                        if pattern.match(fn) is not None:
-                            gpu_list.append(int(filter(str.isdigit, fn)))
-                if len(gpu_list) == 0:
-                    complete = False
-                    reprocess.add(de)
-                for gpu in gpu_list:
-                    if os.path.exists(
-                        os.path.join(tgt.format(de, s), "list_gpu_{0:}.json").format(
-                            gpu
-                        )
-                    ) and os.path.exists(
-                        os.path.join(
-                            tgt.format(de, s), "list_gpu_{0:}processed.txt".format(gpu)
-                        )
-                    ):
-                        block_list = os.path.join(
-                            tgt.format(de, s), "list_gpu_{0:}.json"
-                        ).format(gpu)
-                        block_list_processed = os.path.join(
-                            tgt.format(de, s), "list_gpu_{0:}processed.txt".format(gpu)
-                        )
-                        with open(block_list, "r") as f:
-                            block_list = json.load(f)
-                            block_list = {tuple(coo) for coo in block_list}
-                        with open(block_list_processed, "r") as f:
-                            list_as_str = f.read()
-                        list_as_str_curated = (
-                            "[" + list_as_str[: list_as_str.rfind("]") + 1] + "]"
-                        )
-                        processed_list = json.loads(list_as_str_curated)
-                        processed_list = {tuple(coo) for coo in processed_list}
-                        if processed_list < block_list:
-                            complete = False
-                            reprocess.add(de)
-                    else:
-                        complete = False
-                        reprocess.add(de)
-        return complete, reprocess
@@ -0,0 +1,73 @@
+import luigi
+import os
+import json
+import logging
+import numpy as np
+from utils.resource_profile import Profiler, ProfileHistory
+
+# profiles of all past runs, used to estimate the resources of future ones
+history = ProfileHistory(
+    "/nrs/saalfeld/heinrichl/synapses/data_and_augmentations/resource_profiles.json"
+)
+
+
+class ProfiledTask(luigi.Task):
+    # records peak rss, wall time and io of every run in a .profile.json next to its output and in the history.
+    # The ram resource (in GB) is estimated from the history of the task family, scaled by the volume the task
+    # processes, and only falls back to default_ram for families that have not been run before.
+    default_ram = 10
+    extra_resources = {}
+
+    def volume_shape(self):
+        return None
+
+    def voxels(self):
+        shape = self.volume_shape()
+        if shape is None:
+            return None
+        return int(np.prod(shape))
+
+    def fallback_ram(self):
+        return self.default_ram
+
+    @property
+    def resources(self):
+        ram = history.estimate_ram(self.task_family, self.voxels())
+        if ram is None:
+            ram = self.fallback_ram()
+        resources = {"ram": max(ram, 1)}
+        resources.update(self.extra_resources)
+        return resources
+
+    def profile_target(self):
+        path = os.path.splitext(self.output().path)[0] + ".profile.json"
+        return luigi.LocalTarget(path)
+
+
+@ProfiledTask.event_handler(luigi.Event.START)
+def start_profile(task):
+    task.profiler = Profiler()
+    task.profiler.start()
+
+
+@ProfiledTask.event_handler(luigi.Event.SUCCESS)
+def record_profile(task):
+    try:
+        profile = task.profiler.stop()
+        profile["task_family"] = task.task_family
+        profile["task_id"] = task.task_id
+        profile["volume_shape"] = task.volume_shape()
+        profile["voxels"] = task.voxels()
+        profile["resources"] = task.resources
+        with task.profile_target().open("w") as f:
+            json.dump(profile, f)
+        history.append(profile)
+    except Exception:
+        # the task itself succeeded, a missing profile only makes future estimates less informed
+        logging.exception("Could not record the profile of {0:}".format(task.task_id))
+
+
+@ProfiledTask.event_handler(luigi.Event.FAILURE)
+def cancel_profile(task, exception):
+    if getattr(task, "profiler", None) is not None:
+        task.profiler.cancel()
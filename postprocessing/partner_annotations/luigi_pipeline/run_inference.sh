@@ -1,17 +1,23 @@
 #!/bin/sh
 
+# Starts a persistent inference worker that takes jobs over a local socket
 # Inputs:
-# Path - Path to the N5 dataset with raw data and mask
-# GPU - id of the gpu used for inference
-# Iteration - iteration of the network used
+# Device - gpu<i> for the gpu with index i, cpu<i> for the i-th worker on the cpu
+# Socket - path of the socket to listen on
 
-export NAME=$(basename $PWD-prediction-$1-$2-$5-$6)
+case $1 in
+    gpu*) DEVICES=${1#gpu} ;;
+    *) DEVICES=-1 ;;
+esac
+export NAME=$(basename $PWD-inference-$1)
 export USER_ID=${UID}
 GUNPOWDER_PATH=$(readlink -f $HOME/Projects/git-repos/gunpowder)
 SIMPLEFERENCE_PATH=$(readlink -f $HOME/Projects/simpleference)
 PRED_PATH=$(readlink -f $HOME/Projects/CNNectome/postprocessing/partner_annotations_luigi/)
 Z_PATH=$(readlink -f $HOME/../papec/Work/my_projects/z5/bld27/python)
-echo $3
+CNNECTOME_PATH=$(readlink -f $HOME/Projects/CNNectome)
+SOCKET_DIR=$(dirname $2)
+echo $2
 nvidia-docker rm -f $NAME
 
 nvidia-docker run --rm \
@@ -19,9 +25,10 @@ nvidia-docker run --rm \
     -v $(pwd):/workspace \
     -v /groups/saalfeld:/groups/saalfeld \
     -v /nrs/saalfeld/:/nrs/saalfeld \
+    -v ${SOCKET_DIR}:${SOCKET_DIR} \
     -w /workspace \
     --name $NAME \
     neptunes5thmoon/gunpowder:v0.3-pre6-dask1 \
-    /bin/bash -c "export CUDA_VISIBLE_DEVICES=$5;
-    export PYTHONPATH=${GUNPOWDER_PATH}:${SIMPLEFERENCE_PATH}:${Z_PATH}:\$PYTHONPATH;
-    python -u ${PRED_PATH}/run_prediction.py $1 $2 $3 $4 $5 $6"
+    /bin/bash -c "export CUDA_VISIBLE_DEVICES=${DEVICES};
+    export PYTHONPATH=${GUNPOWDER_PATH}:${SIMPLEFERENCE_PATH}:${Z_PATH}:${CNNECTOME_PATH}:\$PYTHONPATH;
+    python -u ${PRED_PATH}/run_prediction.py serve $2 $1"
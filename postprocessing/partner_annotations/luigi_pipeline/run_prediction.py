@@ -7,18 +7,31 @@ sys.path.append("/groups/saalfeld/home/heinrichl/Projects/simpleference")
 import time
 import json
 import z5py
+import tensorflow as tf
 from functools import partial
-from simpleference.inference.inference import run_inference_n5
 from simpleference.backends.gunpowder.tensorflow.backend import TensorflowPredict
 from simpleference.backends.gunpowder.preprocess import preprocess
 from simpleference.postprocessing import *
+from utils.block_queue import BlockQueue, run_worker, worker_name
+from utils.inference_service import serve
+from utils.tiled_inference import tiled_inference
 
+input_shape = (91, 862, 862)
+output_shape = (71, 650, 650)
 
-def single_gpu_inference(data_train, augmentation, data_eval, samples, gpu, iteration):
-    path = "/nrs/saalfeld/heinrichl/synapses/data_and_augmentations/{0:}/{1:}".format(
+
+def network_path(data_train, augmentation):
+    return "/nrs/saalfeld/heinrichl/synapses/data_and_augmentations/{0:}/{1:}".format(
         data_train, augmentation
     )
-    weight_meta_graph = os.path.join(path, "unet_checkpoint_{0:}".format(iteration))
+
+
+def checkpoint(path, iteration):
+    return os.path.join(path, "unet_checkpoint_{0:}".format(iteration))
+
+
+def load_prediction(path, iteration):
+    weight_meta_graph = checkpoint(path, iteration)
     inference_meta_graph = os.path.join(path, "unet_inference")
     net_io_json = os.path.join(path, "net_io_names.json")
     with open(net_io_json, "r") as f:
@@ -30,15 +43,34 @@ def single_gpu_inference(data_train, augmentation, data_eval, samples, gpu, iter
         net_io_names["post_dist"],
         net_io_names["cleft_dist"],
     ]
-    input_shape = (91, 862, 862)
-    output_shape = (71, 650, 650)
-
-    prediction = TensorflowPredict(
+    return TensorflowPredict(
         weight_meta_graph,
         inference_meta_graph,
         input_key=input_key,
         output_key=output_key,
     )
+
+
+def predict_blocks(prediction, raw_file, out_file, offset_list, on_done=None):
+    # blocks are prefetched and written by separate threads, offsets in raster order reuse the overlapping input
+    raw = z5py.File(raw_file, use_zarr_format=False)["volumes/raw"]
+    out = z5py.File(out_file, use_zarr_format=False)
+    return tiled_inference(
+        prediction,
+        preprocess,
+        partial(clip_float_to_uint8, safe_scale=False, float_range=(-1, 1)),
+        raw,
+        [out[k] for k in ("pre_dist", "post_dist", "clefts")],
+        offset_list,
+        input_shape,
+        output_shape,
+        on_done=on_done,
+    )
+
+
+def single_gpu_inference(data_train, augmentation, data_eval, samples, gpu, iteration):
+    path = network_path(data_train, augmentation)
+    prediction = load_prediction(path, iteration)
     t_predict = time.time()
     for k, de in enumerate(data_eval):
         for s in samples:
@@ -55,21 +87,16 @@ def single_gpu_inference(data_train, augmentation, data_eval, samples, gpu, iter
             offset_file = os.path.join(out_file, "list_gpu_{0:}.json".format(gpu))
             with open(offset_file, "r") as f:
                 offset_list = json.load(f)
-            run_inference_n5(
-                prediction,
-                preprocess,
-                partial(clip_float_to_uint8, safe_scale=False, float_range=(-1, 1)),
-                raw_file,
-                out_file,
-                offset_list,
-                input_shape=input_shape,
-                output_shape=output_shape,
-                target_keys=("pre_dist", "post_dist", "clefts"),
-                input_key="volumes/raw",
-                log_processed=os.path.join(
-                    out_file, "list_gpu_{0:}processed.txt".format(gpu)
-                ),
-            )
+            with open(
+                os.path.join(out_file, "list_gpu_{0:}processed.txt".format(gpu)), "a"
+            ) as log:
+                predict_blocks(
+                    prediction,
+                    raw_file,
+                    out_file,
+                    offset_list,
+                    on_done=lambda offset: log.write(json.dumps(offset) + ", "),
+                )
             t_predict = time.time() - t_predict
 
             with open(
@@ -82,12 +109,74 @@ def single_gpu_inference(data_train, augmentation, data_eval, samples, gpu, iter
                 f.write("Inference with gpu %i in %f s\n" % (gpu, t_predict))
 
 
+class InferenceWorker(object):
+    # keeps the inference graph of a network loaded across jobs. Between iterations of the same network only the
+    # checkpoint weights are restored into the existing session, so a sweep over many checkpoints and samples does not
+    # pay for starting python, importing tensorflow and building the graph every time.
+    # consecutive blocks are claimed together such that their input halos can be reused
+    blocks_per_claim = 16
+
+    def __init__(self, device):
+        self.device = device
+        self.path = None
+        self.iteration = None
+        self.prediction = None
+        self.saver = None
+
+    def load(self, data_train, augmentation, iteration):
+        path = network_path(data_train, augmentation)
+        if path != self.path:
+            if self.prediction is not None:
+                self.prediction.session.close()
+            self.prediction = load_prediction(path, iteration)
+            self.saver = None
+        elif iteration != self.iteration:
+            if self.saver is None:
+                with self.prediction.graph.as_default():
+                    self.saver = tf.train.Saver()
+            self.saver.restore(self.prediction.session, checkpoint(path, iteration))
+        self.path = path
+        self.iteration = iteration
+
+    def run_job(self, data_train, augmentation, queue_file, iteration):
+        # pulls single blocks from the block queue of the iteration until there are none left
+        self.load(data_train, augmentation, iteration)
+        queue = BlockQueue(queue_file)
+        t_predict = time.time()
+        processed = run_worker(
+            queue,
+            lambda raw_file, out_file, offsets, done: predict_blocks(
+                self.prediction, raw_file, out_file, offsets, on_done=done
+            ),
+            worker_name(self.device),
+            max_blocks=self.blocks_per_claim,
+        )
+        t_predict = time.time() - t_predict
+        with open(
+            os.path.join(
+                os.path.dirname(queue_file),
+                "t-inf_{0:}_{1:}.txt".format(self.device, iteration),
+            ),
+            "w",
+        ) as f:
+            f.write(
+                "Inference of %i blocks with %s in %f s\n"
+                % (processed, self.device, t_predict)
+            )
+        return processed
+
+
 if __name__ == "__main__":
-    data_train = sys.argv[1]
-    augmentation = sys.argv[2]
-    print("run_prediction", sys.argv[3])
-    data_eval = json.loads(sys.argv[3])
-    samples = json.loads(sys.argv[4])
-    gpu = int(sys.argv[5])
-    iteration = int(sys.argv[6])
-    single_gpu_inference(data_train, augmentation, data_eval, samples, gpu, iteration)
+    if sys.argv[1] == "serve":
+        # persistent worker for one device (gpu<i> or cpu<i>) that takes jobs from prediction_luigi
+        address = sys.argv[2]
+        device = sys.argv[3]
+        serve(address, InferenceWorker(device).run_job)
+    else:
+        data_train = sys.argv[1]
+        augmentation = sys.argv[2]
+        print("run_prediction", sys.argv[3])
+        queue_file = sys.argv[3]
+        device = sys.argv[4]
+        iteration = int(sys.argv[5])
+        InferenceWorker(device).run_job(data_train, augmentation, queue_file, iteration)
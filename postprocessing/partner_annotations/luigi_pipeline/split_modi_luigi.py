@@ -5,7 +5,9 @@ import z5py
 import h5py
 import numpy as np
 from cremi.io import CremiFile
+from utils.annotations import annotations_in_mask, filter_annotations
 from find_partners_luigi import FindPartners
+from crop_luigi import SampleTask
 
 
 def sub(a, b):
@@ -16,15 +18,16 @@ def add(a, b):
     return tuple([a[d] + b[d] for d in range(len(b))])
 
 
-class SplitModi(luigi.Task):
+class SplitModi(SampleTask):
     it = luigi.IntParameter()
     dt = luigi.Parameter()
     aug = luigi.Parameter()
     de = luigi.Parameter()
     m = luigi.Parameter()
+    s = luigi.Parameter()
     samples = luigi.TupleParameter()
     data_eval = luigi.TupleParameter()
-    resources = {"ram": 50}
+    default_ram = 50
 
     @property
     def priority(self):
@@ -35,55 +38,41 @@ class SplitModi(luigi.Task):
 
     def requires(self):
         return FindPartners(
-            self.it, self.dt, self.aug, self.de, self.samples, self.data_eval
+            self.it, self.dt, self.aug, self.de, self.s, self.samples, self.data_eval
         )
 
     def output(self):
         return luigi.LocalTarget(
-            os.path.join(os.path.dirname(self.input().fn), "split." + self.m + ".msg")
+            os.path.join(
+                os.path.dirname(self.input().fn),
+                self.s + ".split." + self.m + ".msg",
+            )
         )
 
     def run(self):
-        progress = 0.0
-        self.set_progress_percentage(progress)
-        for s in self.samples:
-            print(s)
-            filename = os.path.join(os.path.dirname(self.input().fn), s + ".h5")
-            mask_filename = os.path.join(
-                "/groups/saalfeld/saalfeldlab/larissa/data/cremieval",
-                self.de,
-                s + ".n5",
-            )
-            mask_dataset = "volumes/masks/" + self.m
-            filename_tgt = filename.replace("h5", self.m + ".h5")
-            # shutil.copy(filename, filename_tgt)
-            f = CremiFile(filename, "a")
-            g = CremiFile(filename_tgt, "a")
-            maskf = z5py.File(mask_filename, use_zarr_format=False)
-            mask = maskf[mask_dataset]
-            off = mask.attrs["offset"]
-            res = mask.attrs["resolution"]
-            mask = np.array(mask[:])
-            ann = f.read_annotations()
-            shift = sub(ann.offset, off)
-            ids = ann.ids()
-            rmids = []
-            for i in ids:
-                t, loc = ann.get_annotation(i)
-                vx_idx = (np.array(add(loc, shift)) / res).astype(np.int)
-                if not mask[tuple(vx_idx)]:
-                    rmids.append(i)
-            print(rmids)
-            for i in rmids:
-                print("removing {0:}".format(i))
-                ann.remove_annotation(i)
-            print(ann.comments.keys())
-            print(ann.pre_post_partners)
-            g.write_annotations(ann)
-            progress += 100.0 / len(self.samples)
-            try:
-                self.set_progress_percentage(progress)
-            except:
-                pass
+        print(self.s)
+        filename = os.path.join(os.path.dirname(self.input().fn), self.s + ".h5")
+        mask_filename = os.path.join(
+            "/groups/saalfeld/saalfeldlab/larissa/data/cremieval",
+            self.de,
+            self.s + ".n5",
+        )
+        mask_dataset = "volumes/masks/" + self.m
+        filename_tgt = filename.replace("h5", self.m + ".h5")
+        # shutil.copy(filename, filename_tgt)
+        f = CremiFile(filename, "a")
+        g = CremiFile(filename_tgt, "a")
+        maskf = z5py.File(mask_filename, use_zarr_format=False)
+        mask = maskf[mask_dataset]
+        off = mask.attrs["offset"]
+        res = mask.attrs["resolution"]
+        ann = f.read_annotations()
+        ids, inside = annotations_in_mask(ann, mask, off, res)
+        rmids = [i for i, k in zip(ids, inside) if not k]
+        print(rmids)
+        ann = filter_annotations(ann, [i for i, k in zip(ids, inside) if k])
+        print(ann.comments.keys())
+        print(ann.pre_post_partners)
+        g.write_annotations(ann)
         done = self.output().open("w")
         done.close()
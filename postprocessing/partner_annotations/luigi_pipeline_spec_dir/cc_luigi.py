@@ -1,9 +1,8 @@
 import luigi
 import os
-import numpy as np
-import scipy.ndimage
 import z5py
-from threshold_luigi import Threshold
+from crop_luigi import Crop
+from utils.blockwise_cc import label_volume
 
 
 class ConnectedComponents(luigi.Task):
@@ -22,7 +21,7 @@ class ConnectedComponents(luigi.Task):
             return 0.0
 
     def requires(self):
-        return Threshold(self.it, self.path, self.de, self.samples, self.data_eval)
+        return Crop(self.it, self.path, self.de, self.samples, self.data_eval)
 
     def output(self):
         return luigi.LocalTarget(
@@ -30,45 +29,31 @@ class ConnectedComponents(luigi.Task):
         )
 
     def run(self):
+        # threshold and double threshold connected components in one blockwise pass
         thr_high = 127
         thr_low = 42
-        dataset_src = "clefts_cropped_thr{0:}"
+        dataset_src = "clefts_cropped"
         dataset_tgt = "clefts_cropped_thr{0:}_cc{1:}".format(thr_high, thr_low)
         progress = 0.0
         self.set_progress_percentage(progress)
         for s in self.samples:
             filename = os.path.join(os.path.dirname(self.input().fn), s + ".n5")
             f = z5py.File(filename, use_zarr_format=False)
-            assert (
-                f[dataset_src.format(thr_high)].attrs["offset"]
-                == f[dataset_src.format(thr_low)].attrs["offset"]
-            )
-            assert (
-                f[dataset_src.format(thr_high)].shape
-                == f[dataset_src.format(thr_low)].shape
-            )
             f.create_dataset(
                 dataset_tgt,
-                shape=f[dataset_src.format(thr_high)].shape,
+                shape=f[dataset_src].shape,
                 compression="gzip",
                 dtype="uint64",
-                chunks=f[dataset_src.format(thr_high)].chunks,
+                chunks=f[dataset_src].chunks,
             )
-            data_high_thr = np.array(f[dataset_src.format(thr_high)][:])
-            data_low_thr = np.array(f[dataset_src.format(thr_low)][:])
-            tgt = np.ones(data_low_thr.shape, dtype=np.uint64)
-            maxid = scipy.ndimage.label(data_low_thr, output=tgt)
-            maxes = scipy.ndimage.maximum(
-                data_high_thr, labels=tgt, index=range(1, maxid + 1)
+            maxid = label_volume(
+                (filename, dataset_src),
+                (filename, dataset_tgt),
+                thr=thr_low,
+                seeds=(filename, dataset_src),
+                thr_seeds=thr_high,
             )
-            maxes = np.array([0] + list(maxes))
-            factors = maxes[tgt]
-            tgt *= factors.astype(np.uint64)
-            maxid = scipy.ndimage.label(tgt, output=tgt)
-            f[dataset_tgt][:] = tgt.astype(np.uint64)
-            f[dataset_tgt].attrs["offset"] = f[dataset_src.format(thr_high)].attrs[
-                "offset"
-            ]
+            f[dataset_tgt].attrs["offset"] = f[dataset_src].attrs["offset"]
             f[dataset_tgt].attrs["max_id"] = maxid
             progress += 100.0 / len(self.samples)
             try:
@@ -1,92 +1,16 @@
 import luigi
 import os
 import numpy as np
-from scipy import ndimage
 import h5py
 import json
 import z5py
-from threshold_luigi import Threshold
-
-# d OUTSIDE
-# e INVALID
-# f TRANSPARENT
-class Clefts:
-    def __init__(self, to_be_evaluated, gt, inverted_mask):
-        test_clefts = to_be_evaluated
-        truth_clefts = gt
-        self.truth_clefts_invalid = np.logical_or(
-            truth_clefts == 0xFFFFFFFFFFFFFFFE, truth_clefts == 0xFFFFFFFFFFFFFFFD
-        )
-
-        self.truth_clefts_mask = np.logical_or(
-            np.logical_or(
-                truth_clefts == 0xFFFFFFFFFFFFFFFF, self.truth_clefts_invalid
-            ),
-            inverted_mask,
-        )
-
-        self.test_clefts_mask = np.logical_or.reduce(
-            (test_clefts == 0, self.truth_clefts_invalid, inverted_mask)
-        )
-        self.test_clefts_edt = ndimage.distance_transform_edt(
-            self.test_clefts_mask, sampling=(40.0, 4.0, 4.0)
-        )
-        self.truth_clefts_edt = ndimage.distance_transform_edt(
-            self.truth_clefts_mask, sampling=(40.0, 4.0, 4.0)
-        )
-
-    def count_false_positives(self, threshold=200):
-        mask1 = np.invert(self.test_clefts_mask)
-        mask2 = self.truth_clefts_edt > threshold
-        false_positives = self.truth_clefts_edt[np.logical_and(mask1, mask2)]
-        return false_positives.size
-
-    def count_false_negatives(self, threshold=200):
-        mask1 = np.invert(self.truth_clefts_mask)
-        mask2 = self.test_clefts_edt > threshold
-        false_negatives = self.test_clefts_edt[np.logical_and(mask1, mask2)]
-        return false_negatives.size
-
-    def acc_false_positives(self):
-        mask = np.invert(self.test_clefts_mask)
-        false_positives = self.truth_clefts_edt[mask]
-        try:
-            stats = {
-                "mean": np.mean(false_positives),
-                "std": np.std(false_positives),
-                "max": np.amax(false_positives),
-                "count": false_positives.size,
-                "median": np.median(false_positives),
-            }
-        except ValueError:
-            assert np.sum(mask) == 0
-            stats = {
-                "mean": np.mean(false_positives),
-                "std": np.std(false_positives),
-                "max": 0,
-                "count": false_positives.size,
-                "median": np.median(false_positives),
-            }
-
-        return stats
-
-    def acc_false_negatives(self):
-        mask = np.invert(self.truth_clefts_mask)
-        false_negatives = self.test_clefts_edt[mask]
-        stats = {
-            "mean": np.mean(false_negatives),
-            "std": np.std(false_negatives),
-            "max": np.amax(false_negatives),
-            "count": false_negatives.size,
-            "median": np.median(false_negatives),
-        }
-        return stats
+from utils.cleft_evaluation import Clefts
+from crop_luigi import Crop
 
 
 class CleftReport(luigi.Task):
     it = luigi.IntParameter()
-    dt = luigi.Parameter()
-    aug = luigi.Parameter()
+    path = luigi.Parameter()
     de = luigi.Parameter()
     m = luigi.Parameter()
     samples = luigi.TupleParameter()
@@ -101,9 +25,7 @@ class CleftReport(luigi.Task):
             return 0.0
 
     def requires(self):
-        return Threshold(
-            self.it, self.dt, self.aug, self.de, self.samples, self.data_eval
-        )
+        return Crop(self.it, self.path, self.de, self.samples, self.data_eval)
 
     def output(self):
         cleftrep = os.path.join(
@@ -123,11 +45,13 @@ class CleftReport(luigi.Task):
                 self.de,
                 s + ".n5",
             )
-            test = np.array(
-                z5py.File(testfile, use_zarr_format=False)[
-                    "clefts_cropped_thr" + str(thr)
-                ][:]
-            )
+            # the whole crop is loaded anyway, no need for a thresholded copy
+            test = (
+                np.array(
+                    z5py.File(testfile, use_zarr_format=False)["clefts_cropped"][:]
+                )
+                > thr
+            ).astype(np.uint8)
             truth = np.array(
                 z5py.File(truthfile, use_zarr_format=False)[
                     "volumes/labels/clefts_cropped"
@@ -1,6 +1,7 @@
 import luigi
 import os
 import z5py
+from utils import streaming
 from prediction_luigi import Predict
 
 
@@ -68,8 +69,7 @@ class Crop(luigi.Task):
                     dtype=f[dss].dtype,
                     chunks=chunk_size,
                 )
-                bb = tuple(slice(o, o + shi, None) for o, shi in zip(off, sh))
-                f[dst][:] = f[dss][bb]
+                streaming.stream(f[dss], [(f[dst], streaming.copy)], offset=off)
                 f[dst].attrs["offset"] = off[::-1]
 
                 progress += 100.0 / (len(self.samples) * len(datasets_src))
@@ -3,10 +3,12 @@ import luigi
 import z5py
 import os
 import numpy as np
-import numpy.ma as ma
 import scipy.ndimage
 import itertools
 import cremi
+from utils.label_index import LabelIndex, label_segment_components, sum_labels
+from utils import morphology
+from utils.point_cloud import PointCloud
 from cc_luigi import ConnectedComponents
 import logging
 
@@ -32,7 +34,7 @@ class SynapticRegion(object):
         self,
         segmentid,
         parentcleft,
-        region,
+        label,
         pre_thr=42,
         post_thr=42,
         size_thr=5,
@@ -40,6 +42,7 @@ class SynapticRegion(object):
     ):
         self.segmentid = segmentid
         self.cleft = parentcleft
+        self.label = label
         self.pre_thr = pre_thr
         self.post_thr = post_thr
         self.dist_thr = dist_thr
@@ -56,24 +59,29 @@ class SynapticRegion(object):
         self.post_status = None
 
         # these are wasteful to keep
-        self.region_for_acc = region
+        self.region_for_acc = None
         self.dilated_region = None
         self.eroded_region = None
         self.region_minus_cleft = None
-        self.distance_map = None
+        self.point_cloud = None
         self.segmask_eroded = None
         self.region_for_point = None
 
     def uninitialize_mem_save(self):
         self.region_for_acc = None
         self.region_minus_cleft = None
-        self.distance_map = None
+        self.point_cloud = None
         self.segmask_eroded = None
         self.region_for_point = None
 
     def get_region_for_acc(self):
+        if self.region_for_acc is None:
+            self.make_region_for_acc()
         return self.region_for_acc
 
+    def make_region_for_acc(self):
+        self.region_for_acc = self.cleft.get_region_labels() == self.label
+
     def get_eroded_region(self):
         if self.eroded_region is None:
             self.erode_region()
@@ -85,7 +93,7 @@ class SynapticRegion(object):
         return self.size
 
     def accumulate_acc_size(self):
-        self.size = float(np.sum(self.get_region_for_acc()))
+        self.size = float(self.cleft.get_region_sizes()[self.label])
 
     def get_pre_evidence(self):
         if self.pre_evidence is None:
@@ -94,10 +102,7 @@ class SynapticRegion(object):
 
     def accumulate_pre_evidence(self):
         try:
-            ev = (
-                np.sum(self.cleft.get_pre()[self.get_region_for_acc()])
-                / self.get_size()
-            )
+            ev = self.cleft.get_region_pre_sums()[self.label] / self.get_size()
         except RuntimeWarning:
             print(np.sum(self.get_region_for_acc()))
             print(self.get_region_for_acc())
@@ -115,10 +120,7 @@ class SynapticRegion(object):
 
     def accumulate_post_evidence(self):
         try:
-            ev = (
-                np.sum(self.cleft.get_post()[self.get_region_for_acc()])
-                / self.get_size()
-            )
+            ev = self.cleft.get_region_post_sums()[self.label] / self.get_size()
         except RuntimeWarning:
             print(np.sum(self.get_region_for_acc()))
             print(self.get_region_for_acc())
@@ -147,32 +149,19 @@ class SynapticRegion(object):
         return self.post_status
 
     def erode_region(self):
-        self.eroded_region = self.get_region_for_acc()
-        xy_structure = np.zeros((3, 3, 3))
-        xy_structure[1, :] = np.ones((3, 3))
-        z_structure = np.zeros((3, 3, 3))
-        z_structure[:, 1, 1] = np.ones((3,))
-        for k in range(int(self.erosion_steps / 10.0)):
-            self.eroded_region = scipy.ndimage.morphology.binary_erosion(
-                self.eroded_region, structure=xy_structure, iterations=10
-            )
-            self.eroded_region = scipy.ndimage.morphology.binary_erosion(
-                self.eroded_region, structure=z_structure, iterations=1
-            )
-        if self.erosion_steps % 10 != 0:
-            self.eroded_region = scipy.ndimage.morphology.binary_erosion(
-                self.eroded_region,
-                structure=xy_structure,
-                iterations=self.erosion_steps % 10,
-            )
-        if not np.any(self.eroded_region):
-            self.erosion_steps -= 1
+        self.eroded_region = self.erode_without_vanishing(self.get_region_for_acc())
+
+    def erode_without_vanishing(self, mask):
+        erosion = morphology.ErosionDepth(mask)
+        steps = erosion.max_steps(self.erosion_steps)
+        if steps != self.erosion_steps:
             print(
-                "segment {0:} has been eroded so much that it disappeared, try with one less step, i.e. {1:}".format(
-                    self.segmentid, self.erosion_steps
+                "segment {0:} disappears when eroded by {1:} steps, using {2:} steps instead".format(
+                    self.segmentid, self.erosion_steps, steps
                 )
             )
-            self.erode_region()
+            self.erosion_steps = steps
+        return erosion.erode(steps)
 
     def get_region_for_point(self):
         if self.region_for_point is None:
@@ -191,20 +180,16 @@ class SynapticRegion(object):
             )
             self.region_for_point = self.get_eroded_region()
 
-    def get_distance_map(self):
-        if self.distance_map is None:
-            self.compute_distance_map()
-        return self.distance_map
+    def get_point_cloud(self):
+        if self.point_cloud is None:
+            self.make_point_cloud()
+        return self.point_cloud
 
-    def compute_distance_map(self):
-        self.distance_map = scipy.ndimage.morphology.distance_transform_edt(
-            np.logical_not(self.get_region_for_point()), sampling=(40, 4, 4)
-        )
+    def make_point_cloud(self):
+        self.point_cloud = PointCloud(self.get_region_for_point(), (40, 4, 4))
 
     def is_neighbor(self, partner):
-        structure = np.zeros((3, 3, 3))
-        structure[1, :] = np.ones((3, 3))
-        structure[:, 1, 1] = np.ones((3,))
+        structure = morphology.NEIGHBOR_STRUCTURE
         if self.segmentid == partner.segmentid:
             return False
         else:
@@ -233,13 +218,9 @@ class SynapticRegion(object):
                 )
             )
             return False
-        post_masked_distance_map = ma.array(
-            self.get_distance_map(), mask=np.logical_not(partner.get_region_for_point())
+        post_spot, post_to_pre_dist = partner.get_point_cloud().closest_to(
+            self.get_point_cloud()
         )
-        post_spot = np.unravel_index(
-            np.argmin(post_masked_distance_map), post_masked_distance_map.shape
-        )
-        post_to_pre_dist = post_masked_distance_map[post_spot]
         self.distances.append(post_to_pre_dist)
         if post_to_pre_dist >= self.dist_thr:
             print(
@@ -248,12 +229,7 @@ class SynapticRegion(object):
                 )
             )
             return False
-        pre_masked_distance_map = ma.array(
-            partner.get_distance_map(), mask=np.logical_not(self.get_region_for_point())
-        )
-        pre_spot = np.unravel_index(
-            np.argmin(pre_masked_distance_map), pre_masked_distance_map.shape
-        )
+        pre_spot, _ = self.get_point_cloud().closest_to(partner.get_point_cloud())
         pre_spot = np.array(pre_spot)
         post_spot = np.array(post_spot)
         vec = (post_spot - pre_spot) * np.array([40, 4, 4]) / post_to_pre_dist
@@ -302,9 +278,7 @@ class Cleft(object):
         self.cleft_id = cleft_id
         self.safe_mem = safe_mem
 
-        cleft_mask_full = self.mm.cleft_cc_np == cleft_id
-
-        bbox = bbox_ND(cleft_mask_full)
+        bbox = self.mm.cleft_index.get_bbox(cleft_id)
 
         bbox = [
             bb + shift
@@ -322,11 +296,11 @@ class Cleft(object):
         ]
 
         bbox[0] = max(0, bbox[0])
-        bbox[1] = min(cleft_mask_full.shape[0], bbox[1])
+        bbox[1] = min(self.mm.cleft_index.shape[0], bbox[1])
         bbox[2] = max(0, bbox[2])
-        bbox[3] = min(cleft_mask_full.shape[1], bbox[3])
+        bbox[3] = min(self.mm.cleft_index.shape[1], bbox[3])
         bbox[4] = max(0, bbox[4])
-        bbox[5] = min(cleft_mask_full.shape[2], bbox[5])
+        bbox[5] = min(self.mm.cleft_index.shape[2], bbox[5])
         self.bbox = bbox
         self.bbox_slice = (
             slice(bbox[0], bbox[1], None),
@@ -340,36 +314,76 @@ class Cleft(object):
         if self.safe_mem:
             self.cleft_mask = None
         else:
-            self.cleft_mask = cleft_mask_full[self.bbox_slice]
-        del cleft_mask_full
+            self.cleft_mask = self.mm.cleft_cc_np[self.bbox_slice] == cleft_id
         self.dilation_steps = dilation_steps
         self.dilated_cleft_mask = None
+        self.region_structure = morphology.NEIGHBOR_STRUCTURE
+        self.region_labels = None
+        self.region_segments = None
+        self.region_sizes = None
+        self.region_pre_sums = None
+        self.region_post_sums = None
 
         # self.region_for_acc = np.copy(self.get_cleft_mask())
         # self.region_for_acc[np.logical_not(self.get_seg() == self.segmentid)] = False
         self.segments_overlapping = self.find_segments()
 
-        self.synregions = []
-        structure = np.zeros((3, 3, 3))
-        structure[1, :] = np.ones((3, 3))
-        structure[:, 1, 1] = np.ones((3,))
-        for segid in self.segments_overlapping:
-            region = np.copy(self.get_cleft_mask())
-            region[np.logical_not(self.get_seg() == segid)] = False
-            region = region.astype(np.uint32)
-            num = scipy.ndimage.label(region, output=region, structure=structure)
-            for k in range(1, num + 1):
-                self.synregions.append(
-                    SynapticRegion(
-                        segid,
-                        self,
-                        region == k,
-                        pre_thr=pre_thr,
-                        post_thr=post_thr,
-                        size_thr=size_thr,
-                        dist_thr=dist_thr,
-                    )
-                )
+        self.synregions = [
+            SynapticRegion(
+                segid,
+                self,
+                k + 1,
+                pre_thr=pre_thr,
+                post_thr=post_thr,
+                size_thr=size_thr,
+                dist_thr=dist_thr,
+            )
+            for k, segid in enumerate(self.get_region_segments())
+        ]
+
+    def get_region_labels(self):
+        if self.region_labels is None:
+            self.set_region_labels()
+        return self.region_labels
+
+    def get_region_segments(self):
+        if self.region_segments is None:
+            self.set_region_labels()
+        return self.region_segments
+
+    def set_region_labels(self):
+        # components of the cleft mask within every overlapping segment, labeled in one pass over the cleft's bbox
+        self.region_labels, self.region_segments = label_segment_components(
+            self.get_cleft_mask(),
+            self.get_seg(),
+            self.region_structure,
+            bg_label=SEG_BG_VAL,
+        )
+
+    def get_region_sizes(self):
+        if self.region_sizes is None:
+            self.region_sizes = sum_labels(
+                self.get_region_labels(), len(self.get_region_segments())
+            )
+        return self.region_sizes
+
+    def get_region_pre_sums(self):
+        if self.region_pre_sums is None:
+            self.region_pre_sums = sum_labels(
+                self.get_region_labels(),
+                len(self.get_region_segments()),
+                weights=self.get_pre(),
+            )
+        return self.region_pre_sums
+
+    def get_region_post_sums(self):
+        if self.region_post_sums is None:
+            self.region_post_sums = sum_labels(
+                self.get_region_labels(),
+                len(self.get_region_segments()),
+                weights=self.get_post(),
+            )
+        return self.region_post_sums
 
     def get_cleft_mask(self):
         if self.cleft_mask is None:
@@ -447,6 +461,7 @@ class Cleft(object):
         for synreg in self.synregions:
             synreg.uninitialize_mem_save()
         self.dilated_cleft_mask = None
+        self.region_labels = None
         self.seg = None
         self.pre = None
         self.post = None
@@ -478,15 +493,13 @@ class Matchmaker(object):
         self.segf = z5py.File(seg_file, use_zarr_format=False)
         self.cleft_cc = self.synf[cleft_cc_ds]
         self.cleft_cc_np = self.synf[cleft_cc_ds][:]
+        self.cleft_index = LabelIndex(self.cleft_cc_np)
         self.seg = self.segf[seg_ds]
         self.pre = self.synf[pre_ds]
         self.post = self.synf[post_ds]
         self.partners = None
         logging.debug("finding list of cleftids")
-        try:
-            self.list_of_cleftids = range(1, self.cleft_cc.attrs["max_id"] + 1)
-        except AssertionError:
-            self.list_of_cleftids = np.unique(self.cleft_cc[:])[1:]
+        self.list_of_cleftids = self.cleft_index.ids()
         logging.debug(
             "list of cleftids from {0:} to {1:}".format(
                 np.min(self.list_of_cleftids), np.max(self.list_of_cleftids)
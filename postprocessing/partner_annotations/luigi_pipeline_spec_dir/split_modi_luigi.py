@@ -5,6 +5,7 @@ import z5py
 import h5py
 import numpy as np
 from cremi.io import CremiFile
+from utils.annotations import annotations_in_mask, filter_annotations
 from find_partners_luigi import FindPartners
 
 
@@ -68,20 +69,11 @@ class SplitModi(luigi.Task):
             mask = maskf[mask_dataset]
             off = mask.attrs["offset"]
             res = mask.attrs["resolution"]
-            mask = np.array(mask[:])
             ann = f.read_annotations()
-            shift = sub(ann.offset, off)
-            ids = ann.ids()
-            rmids = []
-            for i in ids:
-                t, loc = ann.get_annotation(i)
-                vx_idx = (np.array(add(loc, shift)) / res).astype(np.int)
-                if not mask[tuple(vx_idx)]:
-                    rmids.append(i)
+            ids, inside = annotations_in_mask(ann, mask, off, res)
+            rmids = [i for i, k in zip(ids, inside) if not k]
             print(rmids)
-            for i in rmids:
-                print("removing {0:}".format(i))
-                ann.remove_annotation(i)
+            ann = filter_annotations(ann, [i for i, k in zip(ids, inside) if k])
             print(ann.comments.keys())
             print(ann.pre_post_partners)
             g.write_annotations(ann)
@@ -40,11 +40,14 @@ def crop_main(it):
         "predictions_it{0:}/pre_dist_cropped".format(it),
         "predictions_it{0:}/post_dist_cropped".format(it),
     ]
+    # the cleft distances are thresholded while they are cropped
+    dataset_thrs = [[127, 42], [], []]
+    dataset_tgt_thr = "predictions_it{0:}".format(it) + "/cleft_dist_cropped_thr{0:}"
     for sample in samples:
         logging.info("cropping sample {0:}".format(sample))
         off = offsets[sample]
         sh = shapes[sample]
-        for ds_src, ds_tgt in zip(dataset_srcs, dataset_tgts):
+        for ds_src, ds_tgt, thrs in zip(dataset_srcs, dataset_tgts, dataset_thrs):
             logging.info("   dataset {0:}".format(ds_src))
             crop.crop_to_seg(
                 filename_src.format(sample),
@@ -53,6 +56,8 @@ def crop_main(it):
                 ds_tgt,
                 off,
                 sh,
+                thrs=thrs,
+                dataset_tgt_thr=dataset_tgt_thr,
             )
 
 
@@ -62,10 +67,7 @@ def thr_main(it):
     filename_src = (
         "/nrs/saalfeld/heinrichl/synapses/pre_and_post/pre_and_post-v6.3/cremi/{0:}.n5"
     )
-    dataset_srcs = [
-        "predictions_it{0:}/cleft_dist_cropped".format(it),
-        "predictions_it{0:}/cleft_dist_cropped".format(it),
-    ]
+    dataset_src = "predictions_it{0:}/cleft_dist_cropped".format(it)
     filename_tgt = (
         "/nrs/saalfeld/heinrichl/synapses/pre_and_post/pre_and_post-v6.3/cremi/{0:}.n5"
     )
@@ -77,15 +79,14 @@ def thr_main(it):
     for sample in samples:
         logging.info("thresholding sample {0:}".format(sample))
         for thrs in thrs_mult:
-            for ds_src, ds_tgt, thr in zip(dataset_srcs, dataset_tgts, thrs):
-                logging.info("    dataset {0:} at {1:}".format(ds_src, thr))
-                threshold.threshold(
-                    filename_src.format(sample),
-                    ds_src,
-                    filename_tgt.format(sample),
-                    ds_tgt.format(thr),
-                    thr,
-                )
+            logging.info("    dataset {0:} at {1:}".format(dataset_src, thrs))
+            threshold.thresholds(
+                filename_src.format(sample),
+                dataset_src,
+                filename_tgt.format(sample),
+                [ds_tgt.format(thr) for ds_tgt, thr in zip(dataset_tgts, thrs)],
+                thrs,
+            )
 
 
 def cc_main(it):
@@ -121,5 +122,4 @@ if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
     i = sys.argv[1]
     crop_main(i)
-    thr_main(i)
     cc_main(i)
@@ -1,9 +1,9 @@
 from cremi.io import CremiFile
 import h5py
 import shutil
-import numpy as np
 import sys
 import z5py
+from utils.annotations import annotations_in_mask, filter_annotations
 
 
 def remove_annotations_in_mask(filename, mask_filename, mask_ds):
@@ -15,20 +15,11 @@ def remove_annotations_in_mask(filename, mask_filename, mask_ds):
     mask = maskfh[mask_ds]
     off = mask.attrs["offset"]
     res = mask.attrs["resolution"]
-    mask = mask[:]
     ann = fh.read_annotations()
-    shift = sub(ann.offset, off)
-
-    ids = ann.ids()
-    rmids = []
-    for i in ids:
-        t, loc = ann.get_annotation(i)
-        vx_idx = (np.array(add(loc, shift)) / res).astype(np.int)
-        if not mask[tuple(vx_idx)]:
-            rmids.append(i)
-    for i in rmids:
-        print("removing {0:}".format(i))
-        ann.remove_annotation(i)
+    ids, inside = annotations_in_mask(ann, mask, off, res)
+    rmids = [i for i, k in zip(ids, inside) if not k]
+    print("removing {0:} of {1:} annotations".format(len(rmids), len(ids)))
+    ann = filter_annotations(ann, [i for i, k in zip(ids, inside) if k])
     fh.write_annotations(ann)
 
 
@@ -1,29 +1,35 @@
 import z5py
 import os
-import numpy as np
 import logging
+from utils import streaming
 
 
 def threshold(filename_src, dataset_src, filename_tgt, dataset_tgt, thr):
+    thresholds(filename_src, dataset_src, filename_tgt, [dataset_tgt], [thr])
 
+
+def thresholds(
+    filename_src, dataset_src, filename_tgt, datasets_tgt, thrs, num_threads=4
+):
+    # thresholds the source at all thrs in a single streaming pass, every chunk of the source is read once
     srcf = z5py.File(filename_src, use_zarr_format=False)
     if not os.path.exists(filename_tgt):
         os.makedirs(filename_tgt)
     tgtf = z5py.File(filename_tgt, use_zarr_format=False)
-    tgtf.create_dataset(
-        dataset_tgt,
-        shape=srcf[dataset_src].shape,
-        compression="gzip",
-        dtype="uint8",
-        chunks=srcf[dataset_src].chunks,
-    )
-    ds = srcf[dataset_src][:]
-    print(np.sum(ds > thr))
-    print(np.min(ds))
-    print(np.max(ds))
-    tgtf[dataset_tgt][:] = (srcf[dataset_src][:] > thr).astype(np.uint8)
-    if "offset" in srcf[dataset_src].attrs.keys():
-        tgtf[dataset_tgt].attrs["offset"] = srcf[dataset_src].attrs["offset"]
+    targets = []
+    for dataset_tgt, thr in zip(datasets_tgt, thrs):
+        tgtf.create_dataset(
+            dataset_tgt,
+            shape=srcf[dataset_src].shape,
+            compression="gzip",
+            dtype="uint8",
+            chunks=srcf[dataset_src].chunks,
+        )
+        targets.append((tgtf[dataset_tgt], streaming.threshold(thr)))
+    streaming.stream(srcf[dataset_src], targets, num_threads=num_threads)
+    for dataset_tgt in datasets_tgt:
+        if "offset" in srcf[dataset_src].attrs.keys():
+            tgtf[dataset_tgt].attrs["offset"] = srcf[dataset_src].attrs["offset"]
 
 
 def main():
@@ -32,10 +38,7 @@ def main():
     filename_src = (
         "/nrs/saalfeld/heinrichl/synapses/pre_and_post/pre_and_post-v3.0/cremi/{0:}.n5"
     )
-    dataset_srcs = [
-        "predictions_it100000/cleft_dist_cropped",
-        "predictions_it100000/cleft_dist_cropped",
-    ]
+    dataset_src = "predictions_it100000/cleft_dist_cropped"
     filename_tgt = (
         "/nrs/saalfeld/heinrichl/synapses/pre_and_post/pre_and_post-v3.0/cremi/{0:}.n5"
     )
@@ -47,15 +50,14 @@ def main():
     for sample in samples:
         logging.info("thresholding sample {0:}".format(sample))
         for thrs in thrs_mult:
-            for ds_src, ds_tgt, thr in zip(dataset_srcs, dataset_tgts, thrs):
-                logging.info("    dataset {0:} at {1:}".format(ds_src, thr))
-                threshold(
-                    filename_src.format(sample),
-                    ds_src,
-                    filename_tgt.format(sample),
-                    ds_tgt.format(thr),
-                    thr,
-                )
+            logging.info("    dataset {0:} at {1:}".format(dataset_src, thrs))
+            thresholds(
+                filename_src.format(sample),
+                dataset_src,
+                filename_tgt.format(sample),
+                [ds_tgt.format(thr) for ds_tgt, thr in zip(dataset_tgts, thrs)],
+                thrs,
+            )
 
 
 def run():
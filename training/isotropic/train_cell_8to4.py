@@ -16,6 +16,13 @@ import collections
 print("syspath", sys.path)
 import z5py
 from utils.label import *
+from utils.distance_targets import (
+    precompute_distances,
+    add_precomputed_distances,
+    normalize_distances,
+)
+from utils.location_sampler import MaskedRandomLocation
+from utils.shared_precache import SharedMemoryPreCache
 import numpy as np
 
 
@@ -31,6 +38,7 @@ def train_until(
     net_name,
     min_masked_voxels=17561.0,
     mask_ds_name="volumes/masks/training",
+    precomputed_distances=False,
 ):
     with open("net_io_names.json", "r") as f:
         net_io_names = json.load(f)
@@ -124,6 +132,12 @@ def train_until(
         trained_until = 0
         print("Starting fresh training")
 
+    if precomputed_distances:
+        add_precomputed_distances(
+            [datasets_ribo, datasets_no_ribo],
+            array_specs,
+            [label for label in labels if label.labelname != "ribosomes"],
+        )
     for src in data_sources:
         for subsample_variant in range(8):
             dnr = datasets_no_ribo.copy()
@@ -143,15 +157,21 @@ def train_until(
             data_providers.append(n5_source)
 
     # create a tuple of data sources, one for each HDF file
+    if precomputed_distances:
+        data_providers = [
+            normalize_distances(
+                provider, [label for label in labels if label.labelname != "ribosomes"]
+            )
+            for provider in data_providers
+        ]
     data_stream = tuple(
         provider + Normalize(ArrayKeys.RAW) +  # ensures RAW is in float in [0, 1]
         # zero-pad provided RAW and MASK to be able to draw batches close to
         # the boundary of the available data
         # size more or less irrelevant as followed by Reject Node
         # Pad(ArrayKeys.RAW, context) +
-        RandomLocation()
-        + Reject(  # chose a random location inside the provided arrays
-            ArrayKeys.MASK, min_masked=keep_thr
+        MaskedRandomLocation(  # chose a random location inside the provided arrays
+            [(ArrayKeys.MASK, keep_thr)]
         )
         for provider in data_providers
     )
@@ -177,6 +197,8 @@ def train_until(
 
     for label in labels:
         if label.labelname != "ribosomes":
+            if precomputed_distances:
+                continue
             train_pipeline += AddDistance(
                 label_array_key=ArrayKeys.GT_LABELS,
                 distance_array_key=label.gt_dist_key,
@@ -201,9 +223,14 @@ def train_until(
                 label.gt_dist_key, label.scale_key, mask=label.mask_key
             )
 
+    # the batch size the network was built for, as many batches are stacked into one training step
+    batch_size = net_io_names.get("batch_size", 1)
+    if batch_size > 1:
+        train_pipeline += Stack(batch_size)
+
     train_pipeline = (
         train_pipeline
-        + PreCache(cache_size=10, num_workers=20)
+        + SharedMemoryPreCache(cache_size=10, num_workers=20)
         + Train(
             net_name,
             optimizer=net_io_names["optimizer"],
@@ -289,6 +316,7 @@ if __name__ == "__main__":
     dt_scaling_factor = 50
     max_iteration = 500000
     loss_name = "loss_total"
+    batch_size = 1
 
     labels = list()
     labels.append(Label("ecs", 1, data_sources=data_sources, data_dir=data_dir))
@@ -446,7 +474,12 @@ if __name__ == "__main__":
     make_net(labels, (340, 340, 340), mode="inference")
     tf.reset_default_graph()
     net_name, output_shape = make_net(
-        labels, input_shape, mode="train", loss_name=loss_name
+        labels, input_shape, mode="train", loss_name=loss_name, batch_size=batch_size
+    )
+    precompute_distances(
+        data_sources,
+        [label for label in labels if label.labelname != "ribosomes"],
+        dt_scaling_factor,
     )
     train_until(
         max_iteration,
@@ -458,4 +491,5 @@ if __name__ == "__main__":
         loss_name,
         labels,
         net_name,
+        precomputed_distances=True,
     )
@@ -18,6 +18,13 @@ import z5py
 from networks import scale_net
 from networks.isotropic.mk_scale_net_cell_generic import *
 from utils.label import *
+from utils.distance_targets import (
+    precompute_distances,
+    add_precomputed_distances,
+    normalize_distances,
+)
+from utils.location_sampler import MaskedRandomLocation
+from utils.shared_precache import SharedMemoryPreCache
 
 
 def train_until(
@@ -30,6 +37,7 @@ def train_until(
     scnet,
     raw_name="raw",
     min_masked_voxels=17561.0,
+    precomputed_distances=False,
 ):
     with open("net_io_names.json", "r") as f:
         net_io_names = json.load(f)
@@ -127,6 +135,12 @@ def train_until(
     else:
         trained_until = 0
         print("Starting fresh training")
+    if precomputed_distances:
+        add_precomputed_distances(
+            [datasets_ribo, datasets_no_ribo],
+            array_specs,
+            [label for label in labels if label.labelname != "ribosomes"],
+        )
     for src in data_sources:
 
         if src not in ribo_sources:
@@ -143,12 +157,16 @@ def train_until(
     data_stream = []
     for provider in data_providers:
         data_stream.append(provider)
+        if precomputed_distances:
+            data_stream[-1] = normalize_distances(
+                data_stream[-1],
+                [label for label in labels if label.labelname != "ribosomes"],
+            )
         for ak, context in zip(raw_array_keys, contexts):
             data_stream[-1] += Normalize(ak)
             # data_stream[-1] += Pad(ak, context) # this shouldn't be necessary as I cropped the input data to have
             # sufficient padding
-        data_stream[-1] += RandomLocation()
-        data_stream[-1] += Reject(ArrayKeys.MASK, min_masked=keep_thr)
+        data_stream[-1] += MaskedRandomLocation([(ArrayKeys.MASK, keep_thr)])
     data_stream = tuple(data_stream)
 
     train_pipeline = (
@@ -172,6 +190,8 @@ def train_until(
 
     for label in labels:
         if label.labelname != "ribosomes":
+            if precomputed_distances:
+                continue
             train_pipeline += AddDistance(
                 label_array_key=ArrayKeys.GT_LABELS,
                 distance_array_key=label.gt_dist_key,
@@ -196,9 +216,14 @@ def train_until(
                 label.gt_dist_key, label.scale_key, mask=label.mask_key
             )
 
+    # the batch size the network was built for, as many batches are stacked into one training step
+    batch_size = net_io_names.get("batch_size", 1)
+    if batch_size > 1:
+        train_pipeline += Stack(batch_size)
+
     train_pipeline = (
         train_pipeline
-        + PreCache(cache_size=10, num_workers=40)
+        + SharedMemoryPreCache(cache_size=10, num_workers=40)
         + Train(
             scnet.name,
             optimizer=net_io_names["optimizer"],
@@ -281,6 +306,7 @@ if __name__ == "__main__":
     dt_scaling_factor = 50
     max_iteration = 500000
     loss_name = "loss_total"
+    batch_size = 1
 
     labels = list()
     labels.append(Label("ecs", 1, data_sources=data_sources, data_dir=data_dir))
@@ -465,7 +491,17 @@ if __name__ == "__main__":
     make_any_scale_net([unet0, unet1], labels, 4, mode="inference")
     tf.reset_default_graph()
     train_sc_net = make_any_scale_net(
-        [unet0, unet1], labels, 5, mode="train", loss_name=loss_name
+        [unet0, unet1],
+        labels,
+        5,
+        mode="train",
+        loss_name=loss_name,
+        batch_size=batch_size,
+    )
+    precompute_distances(
+        data_sources,
+        [label for label in labels if label.labelname != "ribosomes"],
+        dt_scaling_factor,
     )
     train_until(
         max_iteration,
@@ -475,6 +511,7 @@ if __name__ == "__main__":
         loss_name,
         labels,
         train_sc_net,
+        precomputed_distances=True,
     )
     # train_until(max_iteration, data_sources, labeled_voxels, ribo_sources, input_shape, output_shape,
     #            dt_scaling_factor, loss_name,
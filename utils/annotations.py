@@ -0,0 +1,64 @@
+import collections
+import numpy as np
+import cremi
+
+# blocks to read from datasets that are not chunked (contiguous hdf5)
+DEFAULT_BLOCK_SHAPE = (16, 512, 512)
+
+
+def annotation_locations(ann, ids):
+    # locations of the given annotations as a single (n, 3) array
+    locations = [ann.get_annotation(i)[1] for i in ids]
+    return np.array(locations, dtype=np.float64).reshape((len(locations), 3))
+
+
+def lookup(dataset, voxels, block_shape=None):
+    # values of a dataset at the given (n, 3) voxel indices. Only the blocks (by default the chunks) of the dataset
+    # that contain any of the voxels are read, each of them once. Voxels outside of the dataset get 0.
+    if block_shape is None:
+        block_shape = dataset.chunks
+    if block_shape is None:
+        block_shape = DEFAULT_BLOCK_SHAPE
+    values = np.zeros(len(voxels), dtype=dataset.dtype)
+    inside = np.all(
+        np.logical_and(voxels >= 0, voxels < np.array(dataset.shape)), axis=1
+    )
+    by_block = collections.defaultdict(list)
+    for idx, block in zip(np.nonzero(inside)[0], voxels[inside] // block_shape):
+        by_block[tuple(block)].append(idx)
+    for block, idxs in by_block.items():
+        start = np.array(block) * block_shape
+        bs = tuple(
+            slice(s, min(s + b, sh))
+            for s, b, sh in zip(start, block_shape, dataset.shape)
+        )
+        data = dataset[bs]
+        local = voxels[idxs] - start
+        values[idxs] = data[tuple(local.T)]
+    return values
+
+
+def annotations_in_mask(ann, mask, mask_offset, resolution, block_shape=None):
+    # ids of all annotations and whether each of them lies within the mask, with all locations converted to voxels
+    # at once and looked up in the mask chunks that contain annotations only
+    ids = list(ann.ids())
+    shift = np.array(ann.offset, dtype=np.float64) - np.array(mask_offset)
+    voxels = (annotation_locations(ann, ids) + shift) / np.array(resolution)
+    inside = lookup(mask, voxels.astype(np.int64), block_shape=block_shape)
+    return ids, inside.astype(np.bool_)
+
+
+def filter_annotations(ann, ids):
+    # a copy of the annotations that only contains the given ids, their comments and the partners between them, such
+    # that removing many annotations does not require going through all partners for every single one of them
+    keep = set(ids)
+    filtered = cremi.Annotations(offset=ann.offset)
+    for i in ids:
+        annotation_type, location = ann.get_annotation(i)
+        filtered.add_annotation(i, annotation_type, location)
+        if i in ann.comments:
+            filtered.add_comment(i, ann.comments[i])
+    for pre, post in ann.pre_post_partners:
+        if pre in keep and post in keep:
+            filtered.set_pre_post_partners(pre, post)
+    return filtered
@@ -0,0 +1,79 @@
+import json
+import os
+import numpy as np
+
+
+def block_grid(shape, block_shape):
+    # number of blocks along each axis, the last one is cropped to the volume
+    return tuple(-(-sh // bsh) for sh, bsh in zip(shape, block_shape))
+
+
+def mask_ranges(shape, block_shape, downscale, mask_shape):
+    # per axis, the range of mask voxels [start, stop) that every block overlaps, for a mask that covers the volume at a
+    # resolution downscale times lower
+    ranges = []
+    for sh, bsh, ds, msh in zip(shape, block_shape, downscale, mask_shape):
+        starts = np.arange(0, sh, bsh)
+        stops = np.minimum(starts + bsh, sh)
+        ranges.append(
+            (
+                np.clip(np.floor(starts / float(ds)).astype(np.int64), 0, msh),
+                np.clip(np.ceil(stops / float(ds)).astype(np.int64), 0, msh),
+            )
+        )
+    return ranges
+
+
+def pool_any(mask, ranges, axis):
+    # whether any voxel of mask is set within each of the ranges along axis, vectorized over all other axes (ranges of
+    # neighboring blocks can overlap for non-integer downscale factors, so this is done with a cumulative sum)
+    starts, stops = ranges
+    counts = np.cumsum(mask, axis=axis, dtype=np.int64)
+    counts = np.concatenate(
+        (np.zeros_like(np.take(counts, [0], axis=axis)), counts), axis=axis
+    )
+    return (np.take(counts, stops, axis=axis) - np.take(counts, starts, axis=axis)) > 0
+
+
+def blocks_in_mask(mask, shape, block_shape, downscale=None):
+    # boolean array over the block grid of a volume of the given shape that marks the blocks intersecting the mask,
+    # i.e. a block-wise max-pooling of the mask. The mask (an array or a dataset) covers the volume at a resolution
+    # downscale times lower, by default the downscale factors follow from the shapes of the volume and the mask. The
+    # mask is read in slabs of one block row at a time.
+    if downscale is None:
+        downscale = [sh / float(msh) for sh, msh in zip(shape, mask.shape)]
+    ranges = mask_ranges(shape, block_shape, downscale, mask.shape)
+    grid = np.zeros(block_grid(shape, block_shape), dtype=np.bool_)
+    for i, (start, stop) in enumerate(zip(*ranges[0])):
+        if stop <= start:
+            continue
+        slab = np.asarray(mask[start:stop]) != 0
+        pooled = slab.any(axis=0)
+        for axis in range(1, len(shape)):
+            pooled = pool_any(pooled, ranges[axis], axis - 1)
+        grid[i] = pooled
+    return grid
+
+
+def offsets_in_mask(mask, shape, block_shape, downscale=None):
+    # offsets of all blocks of a volume that intersect the mask, in raster order. Blocks without any mask voxel (e.g.
+    # empty background) are skipped.
+    grid = blocks_in_mask(mask, shape, block_shape, downscale=downscale)
+    return [
+        [int(i) * bsh for i, bsh in zip(idx, block_shape)]
+        for idx in np.transpose(np.nonzero(grid))
+    ]
+
+
+def all_offsets(shape, block_shape):
+    return [
+        [int(i) * bsh for i, bsh in zip(idx, block_shape)]
+        for idx in np.ndindex(*block_grid(shape, block_shape))
+    ]
+
+
+def write_offset_lists(offsets, gpu_list, out_folder):
+    # splits offsets into one list_gpu_<gpu>.json per gpu, as read by run_prediction.single_gpu_inference
+    for k, gpu in enumerate(gpu_list):
+        with open(os.path.join(out_folder, "list_gpu_{0:}.json".format(gpu)), "w") as f:
+            json.dump(offsets[k :: len(gpu_list)], f)
@@ -0,0 +1,246 @@
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from utils.sqlite_transaction import Transaction
+
+PENDING = 0
+CLAIMED = 1
+DONE = 2
+FAILED = 3
+
+
+def worker_name(device):
+    return "{0:}:{1:}:{2:}".format(socket.gethostname(), os.getpid(), device)
+
+
+class BlockQueue(object):
+    # a queue of blocks to be processed, kept in a sqlite file such that any number of worker processes can pull blocks
+    # from it without a service. Every block is claimed by one worker at a time, completed blocks are recorded one by
+    # one and blocks whose worker failed or died (its claim was not renewed for lease seconds) are handed out again, up
+    # to max_attempts times. A block is identified by the file it is written to and its offset.
+    def __init__(self, filename, lease=600, max_attempts=4, timeout=600):
+        self.filename = filename
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        with self.connect() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS blocks (out_file TEXT, offset TEXT, "
+                "src_file TEXT, state INTEGER, worker TEXT, claimed_at REAL, "
+                "attempts INTEGER, PRIMARY KEY (out_file, offset))"
+            )
+
+    def connect(self):
+        # isolation_level=None such that transactions are only started explicitly
+        db = sqlite3.connect(self.filename, timeout=self.timeout, isolation_level=None)
+        return Transaction(db)
+
+    def add(self, src_file, out_file, offsets):
+        # blocks that are already in the queue keep their state, such that adding the blocks of a partially processed
+        # volume again only leaves the missing ones to be done
+        with self.connect() as db:
+            db.executemany(
+                "INSERT OR IGNORE INTO blocks VALUES (?, ?, ?, ?, NULL, NULL, 0)",
+                [
+                    (out_file, json.dumps([int(o) for o in offset]), src_file, PENDING)
+                    for offset in offsets
+                ],
+            )
+
+    def requeue(self, db, where, args=()):
+        # hands the blocks selected by where out again, blocks that have failed max_attempts times are given up on
+        db.execute(
+            "UPDATE blocks SET state = (CASE WHEN attempts + 1 >= ? THEN ? ELSE ? END), "
+            "attempts = attempts + 1, worker = NULL WHERE " + where,
+            (self.max_attempts, FAILED, PENDING) + tuple(args),
+        )
+
+    def claim(self, worker, max_blocks=1):
+        # atomically claims the next block and up to max_blocks - 1 blocks that follow it in the same file for worker
+        # and returns (src_file, out_file, offsets) or None if there is nothing left to claim. Expired claims of dead
+        # or stalled workers count as failed attempts.
+        now = time.time()
+        with self.connect() as db:
+            self.requeue(
+                db, "state = ? AND claimed_at < ?", (CLAIMED, now - self.lease)
+            )
+            row = db.execute(
+                "SELECT out_file, offset, src_file FROM blocks WHERE state = ? "
+                "ORDER BY attempts, rowid LIMIT 1",
+                (PENDING,),
+            ).fetchone()
+            if row is None:
+                return None
+            out_file, offset, src_file = row
+            offsets = [offset]
+            if max_blocks > 1:
+                offsets += [
+                    row[0]
+                    for row in db.execute(
+                        "SELECT offset FROM blocks WHERE state = ? AND out_file = ? "
+                        "AND offset != ? AND rowid > (SELECT rowid FROM blocks "
+                        "WHERE out_file = ? AND offset = ?) ORDER BY rowid LIMIT ?",
+                        (PENDING, out_file, offset, out_file, offset, max_blocks - 1),
+                    )
+                ]
+            db.executemany(
+                "UPDATE blocks SET state = ?, worker = ?, claimed_at = ? "
+                "WHERE out_file = ? AND offset = ?",
+                [(CLAIMED, worker, now, out_file, o) for o in offsets],
+            )
+        return src_file, out_file, [json.loads(o) for o in offsets]
+
+    def renew(self, worker):
+        # extends all claims of worker, such that blocks that take longer than the lease are not handed out again
+        # while their worker is alive
+        with self.connect() as db:
+            db.execute(
+                "UPDATE blocks SET claimed_at = ? WHERE state = ? AND worker = ?",
+                (time.time(), CLAIMED, worker),
+            )
+
+    def complete(self, out_file, offset, worker):
+        # records the block as done if it is still claimed by worker, i.e. a worker whose claim expired does not
+        # overwrite the state of the block's new owner. Returns whether it was recorded.
+        with self.connect() as db:
+            return (
+                db.execute(
+                    "UPDATE blocks SET state = ?, worker = NULL WHERE out_file = ? "
+                    "AND offset = ? AND state = ? AND worker = ?",
+                    (
+                        DONE,
+                        out_file,
+                        json.dumps([int(o) for o in offset]),
+                        CLAIMED,
+                        worker,
+                    ),
+                ).rowcount
+                > 0
+            )
+
+    def fail(self, out_file, offset, worker):
+        with self.connect() as db:
+            self.requeue(
+                db,
+                "out_file = ? AND offset = ? AND state = ? AND worker = ?",
+                (out_file, json.dumps([int(o) for o in offset]), CLAIMED, worker),
+            )
+
+    def unclaim(self, out_file, offset, worker):
+        # hands a block claimed by worker out again without counting an attempt, e.g. when it was not started
+        with self.connect() as db:
+            db.execute(
+                "UPDATE blocks SET state = ?, worker = NULL WHERE out_file = ? "
+                "AND offset = ? AND state = ? AND worker = ?",
+                (
+                    PENDING,
+                    out_file,
+                    json.dumps([int(o) for o in offset]),
+                    CLAIMED,
+                    worker,
+                ),
+            )
+
+    def release(self, worker=None):
+        # hands the blocks claimed by worker (by default by any worker, e.g. after all of them exited) out again,
+        # counting this as a failed attempt
+        with self.connect() as db:
+            if worker is None:
+                self.requeue(db, "state = ?", (CLAIMED,))
+            else:
+                self.requeue(db, "state = ? AND worker = ?", (CLAIMED, worker))
+
+    def retry_failed(self):
+        # gives blocks that have exhausted their attempts a fresh start
+        with self.connect() as db:
+            db.execute(
+                "UPDATE blocks SET state = ?, attempts = 0 WHERE state = ?",
+                (PENDING, FAILED),
+            )
+
+    def counts(self):
+        # number of blocks per state
+        with self.connect() as db:
+            rows = db.execute(
+                "SELECT state, COUNT(*) FROM blocks GROUP BY state"
+            ).fetchall()
+        counts = {PENDING: 0, CLAIMED: 0, DONE: 0, FAILED: 0}
+        counts.update(dict(rows))
+        return counts
+
+    def is_done(self):
+        counts = self.counts()
+        return counts[PENDING] + counts[CLAIMED] + counts[FAILED] == 0
+
+
+class LeaseRenewal(threading.Thread):
+    # renews the claims of worker every interval seconds until stopped
+    def __init__(self, queue, worker, interval):
+        super(LeaseRenewal, self).__init__()
+        self.daemon = True
+        self.queue = queue
+        self.worker = worker
+        self.interval = interval
+        self.stopping = threading.Event()
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                self.queue.renew(self.worker)
+            except sqlite3.Error:
+                # tried again at the next interval, well before the lease expires
+                logging.exception("Could not renew the claims of " + self.worker)
+
+    def stop(self):
+        self.stopping.set()
+        self.join()
+
+
+def run_worker(queue, process_blocks, worker, max_blocks=1):
+    # pulls blocks from the queue until there are none left and processes them with
+    # process_blocks(src_file, out_file, offsets, done), up to max_blocks consecutive blocks of a file at a time.
+    # process_blocks calls done(offset) for every block that it has finished, in the order of offsets. When it returns
+    # or raises, the first block that is not done is recorded as failed and the ones after it (that were not started)
+    # are handed out again later. The claims are renewed in the background for as long as the worker runs, such that
+    # only the blocks of dead workers expire, no matter how long a block takes on the device. Returns the number of
+    # blocks processed by this worker.
+    processed = 0
+    renewal = LeaseRenewal(queue, worker, queue.lease / 4.0)
+    renewal.start()
+    try:
+        while True:
+            claimed = queue.claim(worker, max_blocks=max_blocks)
+            if claimed is None:
+                return processed
+            src_file, out_file, offsets = claimed
+            finished = set()
+
+            def done(offset, out_file=out_file, finished=finished):
+                if not queue.complete(out_file, offset, worker):
+                    logging.warning(
+                        "{0:} lost its claim on block {1:} of {2:}".format(
+                            worker, offset, out_file
+                        )
+                    )
+                finished.add(tuple(offset))
+
+            try:
+                process_blocks(src_file, out_file, offsets, done)
+            except Exception:
+                logging.exception(
+                    "{0:} failed on blocks {1:} of {2:}".format(
+                        worker, offsets, out_file
+                    )
+                )
+            processed += len(finished)
+            remaining = [offset for offset in offsets if tuple(offset) not in finished]
+            if remaining:
+                queue.fail(out_file, remaining[0], worker)
+            for offset in remaining[1:]:
+                queue.unclaim(out_file, offset, worker)
+    finally:
+        renewal.stop()
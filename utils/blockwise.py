@@ -0,0 +1,57 @@
+import itertools
+import numpy as np
+
+
+def iterate_blocks(shape, block_shape):
+    # slices of all blocks of a volume, the last block along each axis is cropped to the volume
+    ranges = [range(0, sh, bsh) for sh, bsh in zip(shape, block_shape)]
+    for offset in itertools.product(*ranges):
+        yield tuple(
+            slice(o, min(o + bsh, sh)) for o, bsh, sh in zip(offset, block_shape, shape)
+        )
+
+
+def block_of(coordinate, block_shape):
+    return tuple(int(c) // bsh for c, bsh in zip(coordinate, block_shape))
+
+
+def block_slice(block_id, block_shape, shape):
+    return tuple(
+        slice(b * bsh, min((b + 1) * bsh, sh))
+        for b, bsh, sh in zip(block_id, block_shape, shape)
+    )
+
+
+def grow_slice(sl, halo, shape):
+    # grow a tuple of slices by halo on both sides, clipped to the volume
+    return tuple(
+        slice(max(0, s.start - h), min(sh, s.stop + h))
+        for s, h, sh in zip(sl, halo, shape)
+    )
+
+
+def contains(outer, inner):
+    return all(o.start <= i.start and i.stop <= o.stop for o, i in zip(outer, inner))
+
+
+def local_slice(sl, roi):
+    # express a slice of the volume relative to the start of roi
+    return tuple(slice(s.start - r.start, s.stop - r.start) for s, r in zip(sl, roi))
+
+
+class CachedRoi(object):
+    # reads a region of interest of a dataset once (lazily) and serves all reads that lie within it from memory,
+    # reads that exceed the region of interest fall back to the dataset
+    def __init__(self, dataset, roi):
+        self.dataset = dataset
+        self.roi = roi
+        self.shape = dataset.shape
+        self.data = None
+
+    def __getitem__(self, sl):
+        if contains(self.roi, sl):
+            if self.data is None:
+                self.data = self.dataset[self.roi]
+            return np.copy(self.data[local_slice(sl, self.roi)])
+        else:
+            return self.dataset[sl]
@@ -0,0 +1,149 @@
+import numpy as np
+import scipy.ndimage
+import scipy.sparse
+import scipy.sparse.csgraph
+import z5py
+from utils.blockwise import iterate_blocks, block_of
+from utils.parallel import imap_ordered
+
+
+def open_dataset(filename, dataset):
+    return z5py.File(filename, use_zarr_format=False)[dataset]
+
+
+def threshold_mask(data, thr):
+    # voxels above thr, or all nonzero voxels if no threshold is given (like scipy.ndimage.label)
+    if thr is None:
+        return data != 0
+    return data > thr
+
+
+def first_voxels(labels, num, offset, shape):
+    # flat index within the whole volume of the first voxel (in raster order) of every label 1..num in a block that
+    # starts at offset. Raster order within a block agrees with raster order within the volume.
+    _, first = np.unique(labels.ravel(), return_index=True)
+    first = first[len(first) - num :]
+    coords = np.unravel_index(first, labels.shape)
+    coords = tuple(c + o for c, o in zip(coords, offset))
+    return np.ravel_multi_index(coords, shape)
+
+
+def global_labels(labels, offset):
+    # 0-based volume wide ids of the labels 1..num of a block, -1 for background
+    out = labels.astype(np.int64) - 1 + offset
+    out[labels == 0] = -1
+    return out
+
+
+def label_block(src, tgt, bs, thr=None, seeds=None, thr_seeds=None):
+    # first pass for a single block: labels the thresholded source within the block, writes these labels (1..num) to
+    # the target and returns what is needed to merge them with the other blocks, i.e. the number of labels, the first
+    # voxel of every label, which labels contain a seed voxel and the labels on the lower and upper faces of the block
+    ds = open_dataset(*src)
+    data = ds[bs]
+    labels = np.zeros(data.shape, dtype=np.uint32)
+    num = scipy.ndimage.label(threshold_mask(data, thr), output=labels)
+    firsts = first_voxels(labels, num, [s.start for s in bs], ds.shape)
+    if seeds is None:
+        seeded = None
+    else:
+        if tuple(seeds) != tuple(src):
+            data = open_dataset(*seeds)[bs]
+        seed_labels = labels[threshold_mask(data, thr_seeds)].astype(np.intp)
+        seeded = np.bincount(seed_labels, minlength=num + 1)[1:] > 0
+    open_dataset(*tgt)[bs] = labels.astype(np.uint64)
+    lower_faces = [np.take(labels, 0, axis=axis) for axis in range(labels.ndim)]
+    upper_faces = [np.take(labels, -1, axis=axis) for axis in range(labels.ndim)]
+    return num, firsts, seeded, lower_faces, upper_faces
+
+
+def relabel_block(tgt, bs, ids):
+    # second pass for a single block: maps the block's labels 1..num to their final ids
+    lookup = np.concatenate(([0], ids)).astype(np.uint64)
+    ds = open_dataset(*tgt)
+    ds[bs] = lookup[ds[bs]]
+
+
+def merge_labels(num, pairs, firsts, seeded=None):
+    # final ids for num labels (0-based) given pairs of equivalent labels: equivalence classes are found as connected
+    # components of the graph of all pairs (a vectorized union-find), classes without a seed are dropped and the others
+    # are numbered in the raster order of their first voxel
+    graph = scipy.sparse.coo_matrix(
+        (np.ones(len(pairs), dtype=np.bool_), (pairs[:, 0], pairs[:, 1])),
+        shape=(num, num),
+    )
+    num_classes, classes = scipy.sparse.csgraph.connected_components(
+        graph, directed=False
+    )
+    class_firsts = np.full(num_classes, np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(class_firsts, classes, firsts)
+    if seeded is None:
+        kept = np.arange(num_classes)
+    else:
+        kept = np.nonzero(np.bincount(classes[seeded], minlength=num_classes))[0]
+    kept = kept[np.argsort(class_firsts[kept])]
+    class_ids = np.zeros(num_classes, dtype=np.uint64)
+    class_ids[kept] = np.arange(1, len(kept) + 1, dtype=np.uint64)
+    return class_ids[classes], len(kept)
+
+
+def label_volume(
+    src, tgt, thr=None, seeds=None, thr_seeds=None, block_shape=None, num_workers=1
+):
+    # connected components (face connectivity) of the thresholded dataset src, written to tgt (an existing uint64
+    # dataset of the same shape). If seeds is given, only components that contain a voxel of the thresholded seeds
+    # dataset are kept (double threshold components). Datasets are given as (filename, dataset) tuples. Blocks are
+    # labeled independently by num_workers processes, labels touching across block faces are merged globally and the
+    # target is relabeled in a second blockwise pass, such that memory scales with the block shape and the number of
+    # labels rather than with the volume. Ids are identical to labeling the whole volume in memory. Returns the max id.
+    shape = open_dataset(*src).shape
+    chunks = open_dataset(*tgt).chunks
+    if block_shape is None:
+        block_shape = chunks
+    # concurrent writes to the same chunk are not safe
+    assert num_workers <= 1 or all(b % c == 0 for b, c in zip(block_shape, chunks))
+    blocks = list(iterate_blocks(shape, block_shape))
+    jobs = ((src, tgt, bs, thr, seeds, thr_seeds) for bs in blocks)
+
+    offset = 0
+    offsets = []
+    nums = []
+    firsts = []
+    seeded = []
+    pairs = []
+    upper = dict()
+    for bs, result in zip(blocks, imap_ordered(label_block, jobs, num_workers)):
+        num, block_firsts, block_seeded, lower_faces, upper_faces = result
+        block_id = block_of([s.start for s in bs], block_shape)
+        for axis in range(len(shape)):
+            lower_id = tuple(b - (a == axis) for a, b in enumerate(block_id))
+            if (lower_id, axis) in upper:
+                lower = upper.pop((lower_id, axis))
+                face = global_labels(lower_faces[axis], offset)
+                touching = np.logical_and(lower >= 0, face >= 0)
+                pairs.append(np.stack((lower[touching], face[touching]), axis=1))
+            if bs[axis].stop < shape[axis]:
+                upper[(block_id, axis)] = global_labels(upper_faces[axis], offset)
+        offsets.append(offset)
+        nums.append(num)
+        firsts.append(block_firsts)
+        seeded.append(block_seeded)
+        offset += num
+    if offset == 0:
+        return 0
+
+    pairs = np.concatenate(pairs) if pairs else np.zeros((0, 2), dtype=np.int64)
+    ids, max_id = merge_labels(
+        offset,
+        pairs,
+        np.concatenate(firsts),
+        None if seeds is None else np.concatenate(seeded),
+    )
+    jobs = (
+        (tgt, bs, ids[o : o + num])
+        for bs, o, num in zip(blocks, offsets, nums)
+        if num > 0
+    )
+    for _ in imap_ordered(relabel_block, jobs, num_workers):
+        pass
+    return max_id
@@ -0,0 +1,110 @@
+import numpy as np
+from scipy import ndimage
+from utils.point_cloud import PointCloud
+
+# d OUTSIDE
+# e INVALID
+# f TRANSPARENT
+SAMPLING = (40.0, 4.0, 4.0)
+
+
+def distances_to(voxels, mask, sampling=SAMPLING, cloud=None):
+    # euclidean distances from voxels to the closest voxel of mask, i.e. the distance transform of the inverted mask
+    # evaluated only at voxels. Only voxels outside of the mask need a nearest neighbor query against the mask's
+    # boundary, such that the cost scales with the number of voxels rather than with the volume.
+    if cloud is None:
+        cloud = PointCloud(mask, sampling)
+    if len(cloud) == 0:
+        # same (degenerate) distances as scipy for a distance transform without background
+        edt = ndimage.distance_transform_edt(np.logical_not(mask), sampling=sampling)
+        return edt[tuple(voxels.T)]
+    distances = np.zeros(len(voxels))
+    outside = np.logical_not(mask[tuple(voxels.T)])
+    if np.any(outside):
+        distances[outside], _ = cloud.get_tree().query(
+            voxels[outside] * np.array(sampling)
+        )
+    return distances
+
+
+class CleftTruth:
+    # everything of the cleft evaluation that only depends on the ground truth and the mask, such that it can be
+    # computed once and reused for all predictions that are evaluated against the same ground truth
+    def __init__(self, gt, inverted_mask, sampling=SAMPLING):
+        self.sampling = sampling
+        self.invalid = np.logical_or(gt == 0xFFFFFFFFFFFFFFFE, gt == 0xFFFFFFFFFFFFFFFD)
+        self.clefts = np.logical_not(
+            np.logical_or.reduce(
+                (gt == 0xFFFFFFFFFFFFFFFF, self.invalid, inverted_mask)
+            )
+        )
+        self.excluded = np.logical_or(self.invalid, inverted_mask)
+        self.voxels = np.transpose(np.nonzero(self.clefts))
+        self.cloud = PointCloud(self.clefts, sampling)
+
+
+class Clefts:
+    # distances of predicted cleft voxels to the closest ground truth cleft (false positive distances) and of ground
+    # truth cleft voxels to the closest predicted cleft (false negative distances). Distances are only computed for
+    # these voxels instead of two distance transforms of the whole volume. gt is either the ground truth labels or
+    # a CleftTruth that is reused. If scale is given, distances are saturated as tanh(distance / scale).
+    def __init__(self, to_be_evaluated, gt, inverted_mask=None, scale=None):
+        if not isinstance(gt, CleftTruth):
+            gt = CleftTruth(gt, inverted_mask)
+        self.truth = gt
+        test_clefts = np.logical_and(
+            to_be_evaluated != 0, np.logical_not(self.truth.excluded)
+        )
+        test_voxels = np.transpose(np.nonzero(test_clefts))
+        # distances of ground truth clefts to predicted clefts (and vice versa)
+        self.false_negative_distances = distances_to(
+            self.truth.voxels, test_clefts, self.truth.sampling
+        )
+        self.false_positive_distances = distances_to(
+            test_voxels, self.truth.clefts, self.truth.sampling, cloud=self.truth.cloud
+        )
+        if scale is not None:
+            self.false_negative_distances = np.tanh(
+                self.false_negative_distances / scale
+            )
+            self.false_positive_distances = np.tanh(
+                self.false_positive_distances / scale
+            )
+
+    def count_false_positives(self, threshold=200):
+        return int(np.sum(self.false_positive_distances > threshold))
+
+    def count_false_negatives(self, threshold=200):
+        return int(np.sum(self.false_negative_distances > threshold))
+
+    def acc_false_positives(self):
+        false_positives = self.false_positive_distances
+        try:
+            stats = {
+                "mean": np.mean(false_positives),
+                "std": np.std(false_positives),
+                "max": np.amax(false_positives),
+                "count": false_positives.size,
+                "median": np.median(false_positives),
+            }
+        except ValueError:
+            stats = {
+                "mean": np.mean(false_positives),
+                "std": np.std(false_positives),
+                "max": 0,
+                "count": false_positives.size,
+                "median": np.median(false_positives),
+            }
+
+        return stats
+
+    def acc_false_negatives(self):
+        false_negatives = self.false_negative_distances
+        stats = {
+            "mean": np.mean(false_negatives),
+            "std": np.std(false_negatives),
+            "max": np.amax(false_negatives),
+            "count": false_negatives.size,
+            "median": np.median(false_negatives),
+        }
+        return stats
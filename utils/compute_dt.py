@@ -17,7 +17,7 @@ def find_boundaries(labels):
     in_shape = labels.shape
     out_shape = tuple(2 * s - 1 for s in in_shape)
     out_slices = tuple(slice(0, s) for s in out_shape)
-    boundaries = np.zeros(out_shape, dtype=np.bool)
+    boundaries = np.zeros(out_shape, dtype=bool)
     logger.info("boundaries shape is %s", boundaries.shape)
     for d in range(dims):
         logger.info("processing dimension %d", d)
@@ -25,12 +25,12 @@ def find_boundaries(labels):
         shift_p[d] = slice(1, in_shape[d])
         shift_n = [slice(None)] * dims
         shift_n[d] = slice(0, in_shape[d] - 1)
-        diff = (labels[shift_p] - labels[shift_n]) != 0
+        diff = (labels[tuple(shift_p)] - labels[tuple(shift_n)]) != 0
         logger.info("diff shape is %s", diff.shape)
         target = [slice(None, None, 2)] * dims
         target[d] = slice(1, out_shape[d], 2)
         logger.info("target slices are %s", target)
-        boundaries[target] = diff
+        boundaries[tuple(target)] = diff
     return boundaries
 
 
@@ -69,37 +69,41 @@ def normalize(distances, normalize_mode, normalize_args):
 #    gradients *= factors
 
 
-def create_dt(
-    labels, target_file, voxel_size=(1, 1, 1), normalize_mode=None, normalize_args=None
-):
+def signed_distance(labels, voxel_size=(1, 1, 1), max_distance=None):
+    # distances of all voxels to the boundaries between labels, negative in the background (label 0). Without any
+    # boundary (or where it is further away than max_distance) distances are max_distance.
     boundaries = 1.0 - find_boundaries(labels)
-    print(np.sum(boundaries == 0))
-    if False:  # np.sum(boundaries == 0) == 0:
-        max_distance = min(dim * vs for dim, vs in zip(labels.shape, voxel_size))
-        if np.sum(labels) == 0:
-            distances = -np.ones(labels.shape, dtype=np.float32) * max_distance
-        else:
-            distances = np.ones(labels.shape, dtype=np.float32) * max_distance
+    logger.debug("%d boundary voxels", np.sum(boundaries == 0))
+    if np.sum(boundaries == 0) == 0 and max_distance is not None:
+        distances = np.ones(labels.shape, dtype=np.float32) * max_distance
 
     else:
 
         # get distances (voxel_size/2 because image is doubled)
-        print("compute dt")
+        logger.debug("compute dt")
         distances = distance_transform_edt(
             boundaries, sampling=tuple(float(v) / 2 for v in voxel_size)
         )
-        print("type conversion")
+        logger.debug("type conversion")
         distances = distances.astype(np.float32)
 
         # restore original shape
-        print("downsampling")
+        logger.debug("downsampling")
         downsample = (slice(None, None, 2),) * len(voxel_size)
         distances = distances[downsample]
+        if max_distance is not None:
+            np.minimum(distances, max_distance, out=distances)
+
+    logger.debug("signed dt")
+    # todo: inverted distance
+    distances[labels == 0] = -distances[labels == 0]
+    return distances
 
-        print("signed dt")
-        # todo: inverted distance
-        distances[labels == 0] = -distances[labels == 0]
 
+def create_dt(
+    labels, target_file, voxel_size=(1, 1, 1), normalize_mode=None, normalize_args=None
+):
+    distances = signed_distance(labels, voxel_size)
     distances = np.expand_dims(distances, 0)
 
     if normalize_mode is not None:
@@ -0,0 +1,122 @@
+import logging
+import numpy as np
+import z5py
+from gunpowder import ArraySpec, Normalize, IntensityScaleShift
+from utils.blockwise import iterate_blocks, grow_slice, local_slice
+from utils.compute_dt import signed_distance
+from utils.parallel import imap_ordered
+
+# the saturation of tanh(distance / scale) beyond halo_scales * scale (1 - tanh(3) = 0.005) is below the quantization
+# step of the stored distances (1 / 127.5), such that distances computed blockwise with this halo differ from those of
+# the whole volume by at most one step
+halo_scales = 3
+
+
+def distance_dataset(labelname):
+    return "volumes/distances/" + labelname
+
+
+def quantize(normalized):
+    # [-1, 1] to uint8, converted back by Normalize (to [0, 1]) and IntensityScaleShift(2, -1)
+    return np.round((normalized + 1) * 127.5).astype(np.uint8)
+
+
+def distance_block(
+    src_path, labels_ds, tgt_path, tgt_ds, label_id, block, voxel_size, scale, factor
+):
+    # computes the distances of the output block (at factor times lower resolution than the labels) from the labels
+    # of the block grown by the halo
+    src = z5py.File(src_path, use_zarr_format=False)[labels_ds]
+    max_distance = halo_scales * scale
+    halo = [int(np.ceil(max_distance / float(vs))) for vs in voxel_size]
+    up = tuple(
+        slice(b.start * factor, min(b.stop * factor, sh))
+        for b, sh in zip(block, src.shape)
+    )
+    grown = grow_slice(up, halo, src.shape)
+    mask = np.isin(src[grown], label_id).astype(np.uint8)
+    distances = signed_distance(mask, voxel_size, max_distance=max_distance)
+    distances = distances[local_slice(up, grown)][(slice(None, None, factor),) * 3]
+    tgt = z5py.File(tgt_path, use_zarr_format=False)[tgt_ds]
+    tgt[block] = quantize(np.tanh(distances / scale))
+
+
+def precompute_distances(
+    data_sources,
+    labels,
+    scale,
+    labels_ds="volumes/labels/all",
+    factor=2,
+    block_shape=(64, 64, 64),
+    num_workers=8,
+):
+    # writes the tanh normalized signed distances of every label (as added by AddDistance with normalize="tanh",
+    # normalize_args=scale and the given factor during training) to distance_dataset(labelname) of every data source.
+    # Distances that already exist for the same label ids and scale are kept.
+    for ds in data_sources:
+        f = z5py.File(ds.full_path, use_zarr_format=False)
+        src = f[labels_ds]
+        # resolution and offset are stored in xyz order
+        voxel_size = tuple(src.attrs["resolution"][::-1])
+        shape = tuple(-(-sh // factor) for sh in src.shape)
+        for label in labels:
+            attrs = {
+                "label_id": [int(l) for l in label.labelid],
+                "scale": scale,
+                "factor": factor,
+                "source": labels_ds,
+            }
+            name = distance_dataset(label.labelname)
+            if name in f and all(
+                k in f[name].attrs and f[name].attrs[k] == v for k, v in attrs.items()
+            ):
+                continue
+            logging.info(
+                "computing distances of {0:} in {1:}".format(name, ds.filename)
+            )
+            tgt = f.require_dataset(
+                name,
+                shape=shape,
+                chunks=block_shape,
+                dtype="uint8",
+                compression="gzip",
+            )
+            jobs = [
+                (
+                    ds.full_path,
+                    labels_ds,
+                    ds.full_path,
+                    name,
+                    label.labelid,
+                    block,
+                    voxel_size,
+                    scale,
+                    factor,
+                )
+                for block in iterate_blocks(shape, block_shape)
+            ]
+            for _ in imap_ordered(distance_block, jobs, num_workers):
+                pass
+            tgt.attrs["resolution"] = [v * factor for v in src.attrs["resolution"]]
+            if "offset" in src.attrs:
+                tgt.attrs["offset"] = src.attrs["offset"]
+            # written last, such that interrupted computations are redone
+            for k, v in attrs.items():
+                tgt.attrs[k] = v
+
+
+def add_precomputed_distances(datasets, array_specs, labels):
+    # makes an N5Source with datasets and array_specs provide the precomputed distances of labels instead of them
+    # being added by AddDistance, they are warped along with the raw data by ElasticAugment
+    for label in labels:
+        for d in datasets:
+            d[label.gt_dist_key] = distance_dataset(label.labelname)
+        array_specs[label.gt_dist_key] = ArraySpec(interpolatable=True)
+
+
+def normalize_distances(provider, labels):
+    # converts the stored uint8 distances of labels back to [-1, 1]
+    for label in labels:
+        provider += Normalize(label.gt_dist_key)
+        provider += IntensityScaleShift(label.gt_dist_key, 2, -1)
+    return provider
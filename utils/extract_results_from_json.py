@@ -1,6 +1,7 @@
 import json
 import numpy as np
 import matplotlib.pyplot as plt
+from utils.results_store import ResultsStore
 
 
 class ResultFile:
@@ -11,8 +12,12 @@ class ResultFile:
         iteration,
         mode="validation",
         json_name="validation",
+        results=None,
     ):
         self.mode = mode
+        if results is not None:
+            self.results = results
+            return
         jsonfile = "synapses/{0:}/{1}.n5/it_{2:}/{3:}.json".format(
             experiment_name, sample, iteration, json_name
         )
@@ -76,6 +81,24 @@ class ExpResult:
     def __init__(self, experiment_name, all_iterations=(10000, 20000, 30000, 40000)):
         self.experiment_name = experiment_name
         self.all_iterations = all_iterations
+        self.stored = dict()
+
+    def result_file(self, sample, iteration, mode, json_name):
+        # the results of all iterations are loaded from the results store in one query, results that were only
+        # written to json files are read from those
+        if json_name not in self.stored:
+            self.stored[json_name] = ResultsStore().reports(
+                report=json_name, experiment=self.experiment_name
+            )
+        key = (json_name, self.experiment_name, "", "", sample, iteration, "")
+        return ResultFile(
+            self.experiment_name,
+            sample,
+            iteration,
+            mode,
+            json_name,
+            results=self.stored[json_name].get(key),
+        )
 
     def get_all_it_cs(
         self, mode="validation", json_name="validation", sample=("A", "B", "C")
@@ -86,7 +109,7 @@ class ExpResult:
         for it in self.all_iterations:
             res_thisit = []
             for s in sample:
-                rf = ResultFile(self.experiment_name, s, it, mode, json_name)
+                rf = self.result_file(s, it, mode, json_name)
                 res_thisit.append(rf.get_cremi_score())
             res.append(np.mean(res_thisit))
         return res
@@ -100,7 +123,7 @@ class ExpResult:
         for it in self.all_iterations:
             res_thisit = []
             for s in sample:
-                rf = ResultFile(self.experiment_name, s, it, mode, json_name)
+                rf = self.result_file(s, it, mode, json_name)
                 res_thisit.append(rf.get_geometric_cremi_score())
             res.append(np.mean(res_thisit))
         return res
@@ -114,7 +137,7 @@ class ExpResult:
         for it in self.all_iterations:
             res_thisit = []
             for s in sample:
-                rf = ResultFile(self.experiment_name, s, it, mode, json_name)
+                rf = self.result_file(s, it, mode, json_name)
                 res_thisit.append(rf.get_adgt())
             res.append(np.mean(res_thisit))
         return res
@@ -128,7 +151,7 @@ class ExpResult:
         for it in self.all_iterations:
             res_thisit = []
             for s in sample:
-                rf = ResultFile(self.experiment_name, s, it, mode, json_name)
+                rf = self.result_file(s, it, mode, json_name)
                 res_thisit.append(rf.get_adf())
             res.append(np.mean(res_thisit))
         return res
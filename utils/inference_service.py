@@ -0,0 +1,74 @@
+import logging
+import os
+import time
+import traceback
+from multiprocessing.connection import Listener, Client
+
+STOP = "stop"
+
+
+def serve(address, handle_job):
+    # serves jobs sent with submit over the local socket at address one after the other, such that whatever
+    # handle_job(**job) keeps loaded (e.g. a network) is reused across jobs, until a STOP message arrives. Failing jobs
+    # are reported back to the client and do not stop the service.
+    if os.path.exists(address):
+        os.remove(address)
+    listener = Listener(address, family="AF_UNIX")
+    logging.info("Serving jobs at {0:}".format(address))
+    try:
+        while True:
+            conn = listener.accept()
+            try:
+                job = conn.recv()
+                if job == STOP:
+                    conn.send(("ok", None))
+                    return
+                try:
+                    result = ("ok", handle_job(**job))
+                except Exception:
+                    logging.exception("Job {0:} failed".format(job))
+                    result = ("error", traceback.format_exc())
+                conn.send(result)
+            except EOFError:
+                # e.g. a client that only checked whether the service is running
+                pass
+            except IOError:
+                logging.exception("Lost connection to client")
+            finally:
+                conn.close()
+    finally:
+        listener.close()
+
+
+def is_serving(address):
+    try:
+        Client(address, family="AF_UNIX").close()
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def wait_for_service(address, timeout=600, interval=5):
+    # waits until a service (that is starting up) accepts connections at address
+    t_start = time.time()
+    while not is_serving(address):
+        if time.time() - t_start > timeout:
+            raise RuntimeError(
+                "No service at {0:} after {1:} s".format(address, timeout)
+            )
+        time.sleep(interval)
+
+
+def submit(address, job):
+    # sends a job (a dict of keyword arguments, or STOP) to the service at address and waits for its result
+    conn = Client(address, family="AF_UNIX")
+    try:
+        conn.send(job)
+        status, result = conn.recv()
+    finally:
+        conn.close()
+    if status != "ok":
+        raise RuntimeError(
+            "Job {0:} failed at {1:}:\n{2:}".format(job, address, result)
+        )
+    return result
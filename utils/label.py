@@ -1,4 +1,8 @@
 import collections
+import fcntl
+import json
+import os
+import numpy as np
 import z5py
 from gunpowder import ArrayKey
 
@@ -47,20 +51,8 @@ class Label(object):
         self.data_dir = data_dir
         self.data_sources = data_sources
         self.total_voxels = compute_total_voxels(self.data_dir, self.data_sources)
-        num = 0
-        if data_sources is not None:
-            for ds in data_sources:
-                zf = z5py.File(ds.full_path, use_zarr_format=False)
-                for l in labelid:
-                    if l in zf["volumes/labels/all"].attrs["relabeled_ids"]:
-                        num += zf["volumes/labels/all"].attrs["relabeled_counts"][
-                            zf["volumes/labels/all"].attrs["relabeled_ids"].index(l)
-                        ]
-        if num > 0:
-            self.class_weight = float(self.total_voxels) / num
-        else:
-            self.class_weight = 0.0
-        print(labelname, self.class_weight)
+        self._class_weight = None
+        unweighted_labels.append(self)
         if self.scale_loss:
             self.scale_key = ArrayKey("SCALE_" + self.labelname.upper())
         if scale_key is not None:
@@ -68,6 +60,13 @@ class Label(object):
         if not self.scale_loss and scale_key is None:
             self.scale_key = self.mask_key
 
+    @property
+    def class_weight(self):
+        # computed on first use, together with all other labels created until then
+        if self._class_weight is None:
+            assign_class_weights()
+        return self._class_weight
+
 
 def filter_by_category(list_of_datasets, category):
     filtered = []
@@ -77,15 +76,117 @@ def filter_by_category(list_of_datasets, category):
     return filtered
 
 
-def compute_total_voxels(data_dir, data_sources):
-    voxels = 0
-    if data_sources is not None:
-        for ds in data_sources:
-            zf = z5py.File(ds.full_path, use_zarr_format=False)
+# statistics of the labels of every data source read so far, shared by all labels
+statistics_cache = dict()
+# labels whose class weight has not been computed yet
+unweighted_labels = []
+
+
+def statistics_file(ds):
+    # the statistics of all data sources of a directory are kept in one json file next to them
+    return os.path.join(os.path.dirname(ds.full_path), "label_statistics.json")
+
+
+def load_statistics(ds):
+    try:
+        with open(statistics_file(ds), "r") as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return dict()
+
+
+def store_statistics(ds, key, statistics):
+    # adds the statistics of a data source to the json file, under a lock since several processes can start at once.
+    # Without write access they are only kept for this process.
+    try:
+        with open(statistics_file(ds), "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
             try:
-                for c in zf["volumes/labels/all"].attrs["orig_counts"]:
-                    voxels += c
+                f.seek(0)
+                try:
+                    stored = json.loads(f.read())
+                except ValueError:
+                    stored = dict()
+                stored[key] = statistics
+                f.seek(0)
+                f.truncate()
+                json.dump(stored, f)
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+    except (IOError, OSError):
+        pass
+
+
+def label_statistics(ds, labels_ds="volumes/labels/all"):
+    # total number of voxels and the number of voxels per (relabeled) id of the labels of the data source ds. They are
+    # read from the labels once and stored next to the data source, and only read again if the attributes of the
+    # labels changed.
+    mtime = os.stat(os.path.join(ds.full_path, labels_ds, "attributes.json")).st_mtime
+    key = (ds.full_path, labels_ds)
+    if key not in statistics_cache or statistics_cache[key][0] != mtime:
+        stored = load_statistics(ds).get(os.path.join(*key))
+        if stored is None or stored["mtime"] != mtime:
+            attrs = z5py.File(ds.full_path, use_zarr_format=False)[labels_ds].attrs
+            try:
+                total = sum(attrs["orig_counts"])
             except KeyError as e:
                 print(ds.filename)
                 raise e
+            stored = {
+                "mtime": mtime,
+                "total": total,
+                "ids": list(attrs["relabeled_ids"]),
+                "counts": list(attrs["relabeled_counts"]),
+            }
+            store_statistics(ds, os.path.join(*key), stored)
+        counts = dict(zip(stored["ids"], stored["counts"]))
+        statistics_cache[key] = (mtime, stored["total"], counts)
+    return statistics_cache[key][1:]
+
+
+def compute_total_voxels(data_dir, data_sources):
+    voxels = 0
+    if data_sources is not None:
+        for ds in data_sources:
+            voxels += label_statistics(ds)[0]
     return voxels
+
+
+def class_weights(labelids, data_sources):
+    # class weights (total number of voxels / number of voxels of the label) of all labels given by their ids at once,
+    # labels without any voxels get a weight of 0
+    labelids = [
+        lid if isinstance(lid, collections.Iterable) else (lid,) for lid in labelids
+    ]
+    if not data_sources:
+        return np.zeros(len(labelids))
+    statistics = [label_statistics(ds) for ds in data_sources]
+    total = sum(t for t, _ in statistics)
+    ids = sorted(set(i for _, counts in statistics for i in counts))
+    index = dict((i, k) for k, i in enumerate(ids))
+    counts = np.zeros(len(ids))
+    for _, c in statistics:
+        for i, n in c.items():
+            counts[index[i]] += n
+    membership = np.zeros((len(labelids), len(ids)))
+    for row, lid in enumerate(labelids):
+        for l in lid:
+            if l in index:
+                membership[row, index[l]] += 1
+    num = membership.dot(counts)
+    return np.where(num > 0, float(total) / np.maximum(num, 1), 0.0)
+
+
+def assign_class_weights():
+    # computes the class weights of all labels that do not have one yet, in one call of class_weights per set of data
+    # sources (usually one for all labels of a network)
+    groups = collections.OrderedDict()
+    for label in unweighted_labels:
+        groups.setdefault(id(label.data_sources), []).append(label)
+    del unweighted_labels[:]
+    for labels in groups.values():
+        weights = class_weights([l.labelid for l in labels], labels[0].data_sources)
+        for label, weight in zip(labels, weights):
+            label._class_weight = float(weight)
+            print(label.labelname, label._class_weight)
@@ -0,0 +1,133 @@
+import numpy as np
+import scipy.ndimage
+import scipy.sparse
+import scipy.sparse.csgraph
+from utils.blockwise import iterate_blocks
+
+
+def count_labels(labels, minlength=0):
+    return np.bincount(labels.ravel().astype(np.intp, copy=False), minlength=minlength)
+
+
+class LabelIndex(object):
+    # bounding boxes and voxel counts of all objects in a label volume, computed in a single pass over the volume
+    # such that looking up a single object does not require comparing the full volume against its id
+    def __init__(self, labels, bg_label=0):
+        self.shape = labels.shape
+        self.bg_label = bg_label
+        self.slices = scipy.ndimage.find_objects(labels)
+        self.counts = count_labels(labels, len(self.slices) + 1)
+
+    @classmethod
+    def from_blocks(cls, dataset, block_shape, bg_label=0):
+        # build the same index from a dataset that is read block by block, such that it never needs to be loaded as a
+        # whole. Memory only scales with the number of objects.
+        index = cls.__new__(cls)
+        index.shape = tuple(dataset.shape)
+        index.bg_label = bg_label
+        index.slices = []
+        index.counts = np.zeros(1, dtype=np.int64)
+        for bs in iterate_blocks(index.shape, block_shape):
+            block = dataset[bs]
+            offset = [s.start for s in bs]
+            block_slices = scipy.ndimage.find_objects(block)
+            if len(block_slices) > len(index.slices):
+                index.slices.extend([None] * (len(block_slices) - len(index.slices)))
+            for k, sl in enumerate(block_slices):
+                if sl is None:
+                    continue
+                sl = tuple(slice(s.start + o, s.stop + o) for s, o in zip(sl, offset))
+                if index.slices[k] is not None:
+                    sl = tuple(
+                        slice(min(s0.start, s1.start), max(s0.stop, s1.stop))
+                        for s0, s1 in zip(index.slices[k], sl)
+                    )
+                index.slices[k] = sl
+            block_counts = count_labels(block, len(block_slices) + 1)
+            if len(block_counts) > len(index.counts):
+                index.counts = np.pad(
+                    index.counts, (0, len(block_counts) - len(index.counts)), "constant"
+                )
+            index.counts[: len(block_counts)] += block_counts
+        return index
+
+    def ids(self):
+        ids = np.nonzero(self.counts)[0]
+        return ids[ids != self.bg_label]
+
+    def max_id(self):
+        return len(self.slices)
+
+    def get_count(self, label):
+        if label >= len(self.counts):
+            return 0
+        return int(self.counts[label])
+
+    def get_slice(self, label):
+        if label < 1 or label > len(self.slices):
+            return None
+        return self.slices[label - 1]
+
+    def get_bbox(self, label):
+        # same format as bbox_ND, i.e. (min_0, max_0, min_1, max_1, ...) with inclusive upper bounds
+        sl = self.get_slice(label)
+        if sl is None:
+            return None
+        out = []
+        for s in sl:
+            out.extend((s.start, s.stop - 1))
+        return tuple(out)
+
+
+def label_segment_components(mask, seg, structure, bg_label=0):
+    # connected components of mask & (seg == s) for all segments s != bg_label at once, i.e. components of mask that
+    # do not cross segment boundaries, via a single graph over all neighboring voxel pairs within the same segment.
+    # Components are numbered by segment id and within each segment in the raster order of their first voxel (like
+    # scipy.ndimage.label would number them). Returns the label image and the segment id of every component.
+    mask = np.logical_and(mask, seg != bg_label)
+    voxels = np.flatnonzero(mask)
+    labels = np.zeros(mask.shape, dtype=np.uint32)
+    if len(voxels) == 0:
+        return labels, np.zeros(0, dtype=seg.dtype)
+    nodes = np.full(mask.shape, -1, dtype=np.int64)
+    nodes.flat[voxels] = np.arange(len(voxels))
+    center = np.array(structure.shape) // 2
+    rows = []
+    cols = []
+    for offset in np.argwhere(structure) - center:
+        # every edge only needs to be added in one direction
+        if tuple(offset) <= (0,) * len(offset):
+            continue
+        src = tuple(
+            slice(max(0, -o), sh - max(0, o)) for o, sh in zip(offset, mask.shape)
+        )
+        dst = tuple(
+            slice(max(0, o), sh - max(0, -o)) for o, sh in zip(offset, mask.shape)
+        )
+        connected = np.logical_and(nodes[src] >= 0, nodes[dst] >= 0)
+        connected &= seg[src] == seg[dst]
+        rows.append(nodes[src][connected])
+        cols.append(nodes[dst][connected])
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    graph = scipy.sparse.coo_matrix(
+        (np.ones(len(rows), dtype=np.bool_), (rows, cols)),
+        shape=(len(voxels), len(voxels)),
+    )
+    _, components = scipy.sparse.csgraph.connected_components(graph, directed=False)
+    _, first = np.unique(components, return_index=True)
+    segments = seg.flat[voxels[first]]
+    order = np.lexsort((first, segments))
+    rank = np.empty(len(order), dtype=np.uint32)
+    rank[order] = np.arange(1, len(order) + 1)
+    labels.flat[voxels] = rank[components]
+    return labels, segments[order]
+
+
+def sum_labels(labels, num, weights=None):
+    # per-label sums (or voxel counts without weights) for labels 0..num as one bincount over the whole image
+    if weights is not None:
+        weights = weights.ravel()
+    return np.bincount(
+        labels.ravel().astype(np.intp, copy=False), weights=weights, minlength=num + 1
+    )
@@ -0,0 +1,198 @@
+import bisect
+import itertools
+import logging
+import random
+import numpy as np
+from gunpowder import BatchRequest, Coordinate, RandomLocation, Roi
+
+logger = logging.getLogger(__name__)
+
+
+class SummedVolumeTable(object):
+    # number of nonzero voxels of an array per block of granularity voxels, as summed-volume table (a 3d integral
+    # image with a leading zero in every dimension) such that the count of any box of blocks is a constant time lookup
+    def __init__(self, shape, granularity):
+        self.shape = tuple(shape)
+        self.granularity = tuple(granularity)
+        self.blocks = tuple(-(-s // g) for s, g in zip(self.shape, self.granularity))
+        self.counts = np.zeros(self.blocks, dtype=np.int64)
+
+    def add(self, data, offset):
+        # counts the nonzero voxels of data, a part of the array at voxel offset that starts at a block boundary
+        assert all(o % g == 0 for o, g in zip(offset, self.granularity))
+        padded = np.zeros(
+            tuple(-(-s // g) * g for s, g in zip(data.shape, self.granularity)),
+            dtype=np.int64,
+        )
+        padded[tuple(slice(0, s) for s in data.shape)] = data > 0
+        counts = padded.reshape(
+            sum(((b // g, g) for b, g in zip(padded.shape, self.granularity)), ())
+        ).sum(axis=(1, 3, 5))
+        self.counts[
+            tuple(
+                slice(o // g, o // g + c)
+                for o, g, c in zip(offset, self.granularity, counts.shape)
+            )
+        ] = counts
+
+    def finish(self):
+        table = np.zeros(tuple(b + 1 for b in self.blocks), dtype=np.int64)
+        table[1:, 1:, 1:] = self.counts.cumsum(0).cumsum(1).cumsum(2)
+        self.table = table
+        del self.counts
+
+    def min_counts(self, begins, width):
+        # lower bounds of the number of nonzero voxels of windows of width voxels, for all windows starting in
+        # [begin, begin + granularity) with the begins of every dimension given separately (i.e. the result has shape
+        # (len(begins[0]), len(begins[1]), len(begins[2]))): only blocks that all of these windows cover are counted
+        lo = []
+        hi = []
+        for b, w, g, n in zip(begins, width, self.granularity, self.blocks):
+            b = np.asarray(b)
+            first = np.clip(-(-(b + g - 1) // g), 0, n)
+            last = np.clip((b + w) // g, 0, n)
+            lo.append(first)
+            hi.append(np.maximum(first, last))
+        total = 0
+        for corner in itertools.product((0, 1), repeat=3):
+            idx = np.ix_(*[hi[d] if c else lo[d] for d, c in enumerate(corner)])
+            total = total + (-1) ** (3 - sum(corner)) * self.table[idx]
+        return total
+
+
+class MaskedRandomLocation(RandomLocation):
+    # RandomLocation followed by Reject(key, min_masked, reject_probability) for every entry of rejects, without the
+    # rejected reads: the arrays of the rejects are read once in setup and summarized in summed-volume tables, from
+    # which the valid locations are weighted directly. Locations are drawn as cells of granularity voxels (of the
+    # first reject's array) and a uniformly random shift inside of them, a cell is valid if every location in it
+    # passes the rejects. That is decided conservatively from the blocks all of its locations cover, such that a few
+    # valid locations at the border of masks are never drawn, smaller granularities lose less of them.
+    def __init__(self, rejects, granularity=(8, 8, 8)):
+        super(MaskedRandomLocation, self).__init__()
+        # (key, min_masked) or (key, min_masked, reject_probability), as the arguments of Reject
+        self.rejects = [
+            tuple(reject) + (1.0,) * (3 - len(reject)) for reject in rejects
+        ]
+        self.granularity = Coordinate(granularity)
+        self.tables = dict()
+        self.cells = dict()
+
+    def setup(self):
+        upstream = self.get_upstream_provider()
+        for key, _, _ in self.rejects:
+            spec = upstream.spec[key]
+            assert not spec.roi.unbounded(), "{0:} needs a bounded ROI".format(key)
+            shape = spec.roi.get_shape() / spec.voxel_size
+            table = SummedVolumeTable(shape, self.granularity)
+            # read in slabs of one row of blocks to keep the memory footprint small
+            slab = self.granularity[0] * spec.voxel_size[0]
+            for z in range(0, shape[0], self.granularity[0]):
+                roi = Roi(
+                    spec.roi.get_begin() + Coordinate((z * spec.voxel_size[0], 0, 0)),
+                    Coordinate((slab,) + spec.roi.get_shape()[1:]),
+                ).intersect(spec.roi)
+                request = BatchRequest()
+                request[key] = spec.copy()
+                request[key].roi = roi
+                table.add(upstream.request_batch(request).arrays[key].data, (z, 0, 0))
+            table.finish()
+            self.tables[key] = table
+            logger.info("summarized {0:} in {1:} blocks".format(key, table.blocks))
+        super(MaskedRandomLocation, self).setup()
+
+    def prepare(self, request):
+        shift_roi = self.possible_shifts(request)
+        lcm_voxel_size = self.spec.get_lcm_voxel_size(request.array_specs.keys())
+        shift_roi = shift_roi.snap_to_grid(lcm_voxel_size, mode="shrink")
+        cell_size = self.granularity * self.upstream_spec[self.rejects[0][0]].voxel_size
+        assert cell_size % lcm_voxel_size == (0,) * 3
+        cache_key = (str(shift_roi),) + tuple(
+            str(request[key].roi) for key, _, _ in self.rejects
+        )
+        if cache_key not in self.cells:
+            self.cells[cache_key] = self.weigh_cells(request, shift_roi, cell_size)
+        shape, cumulative = self.cells[cache_key]
+        cell = np.unravel_index(
+            bisect.bisect_right(cumulative, random.random() * cumulative[-1]), shape
+        )
+        # a random shift inside of the cell (restricted to shift_roi) on the lcm voxel grid
+        cell_roi = Roi(
+            shift_roi.get_begin() + Coordinate(cell) * cell_size, cell_size
+        ).intersect(shift_roi)
+        lcm_cell_roi = cell_roi / lcm_voxel_size
+        random_shift = (
+            Coordinate(
+                randint_in(b, e)
+                for b, e in zip(lcm_cell_roi.get_begin(), lcm_cell_roi.get_end())
+            )
+            * lcm_voxel_size
+        )
+        logger.debug("random shift: " + str(random_shift))
+        self.random_shift = random_shift
+        for key, spec in request.items():
+            if spec.roi is not None:
+                spec.roi = spec.roi.shift(random_shift)
+        return request
+
+    def possible_shifts(self, request):
+        # the shifts for which all requested ROIs lie inside of the provided ones, as in RandomLocation
+        total_shift_roi = None
+        for key, spec in request.items():
+            if spec.roi is None:
+                continue
+            provided_roi = self.upstream_spec[key].roi
+            shift_roi = provided_roi.shift(-spec.roi.get_begin()).grow(
+                (0,) * spec.roi.dims(), -spec.roi.get_shape()
+            )
+            if total_shift_roi is None:
+                total_shift_roi = shift_roi
+            else:
+                total_shift_roi = total_shift_roi.intersect(shift_roi)
+        assert not total_shift_roi.unbounded(), (
+            "Can not pick a random location, intersection of upstream ROIs is "
+            "unbounded."
+        )
+        assert (
+            total_shift_roi.size() > 0
+        ), "Can not satisfy batch request, no location covers all requested ROIs."
+        return total_shift_roi
+
+    def weigh_cells(self, request, shift_roi, cell_size):
+        # the probability of every cell of shift_roi to be drawn, as shape and cumulative (flat) weights. A cell that
+        # fails a reject is drawn with its 1 - reject_probability, i.e. as often as RandomLocation + Reject would
+        # accept its locations.
+        shape = tuple(-(-s // c) for s, c in zip(shift_roi.get_shape(), cell_size))
+        weights = np.ones(shape, dtype=np.float64)
+        for key, min_masked, reject_probability in self.rejects:
+            assert key in request, "{0:} has to be requested".format(key)
+            spec = self.upstream_spec[key]
+            table = self.tables[key]
+            assert cell_size % spec.voxel_size == (0,) * 3
+            begin = (
+                request[key].roi.get_begin()
+                + shift_roi.get_begin()
+                - spec.roi.get_begin()
+            ) / spec.voxel_size
+            step = cell_size / spec.voxel_size
+            width = request[key].roi.get_shape() / spec.voxel_size
+            begins = [b + np.arange(n) * s for b, n, s in zip(begin, shape, step)]
+            counts = table.min_counts(begins, width)
+            passed = counts > min_masked * np.prod(width)
+            weights *= np.where(passed, 1.0, 1.0 - reject_probability)
+        logger.info(
+            "{0:} of {1:} cells pass all rejects".format(
+                int(np.sum(weights == 1)), weights.size
+            )
+        )
+        cumulative = np.cumsum(weights.flatten())
+        if cumulative[-1] <= 0:
+            raise RuntimeError(
+                "No location of {0:} passes the rejects {1:}".format(
+                    shift_roi, self.rejects
+                )
+            )
+        return shape, cumulative
+
+
+def randint_in(begin, end):
+    return random.randint(begin, end - 1)
@@ -0,0 +1,74 @@
+import numpy as np
+import scipy.ndimage
+
+# anisotropic morphology for (z, y, x) volumes where z is about 10 times coarser than x and y. One step grows/shrinks
+# by one voxel in xy (8-neighborhood) and every 10th step additionally by one voxel in z.
+Z_RATIO = 10
+
+XY_STRUCTURE = np.zeros((3, 3, 3), dtype=np.bool_)
+XY_STRUCTURE[1, :] = True
+Z_STRUCTURE = np.zeros((3, 3, 3), dtype=np.bool_)
+Z_STRUCTURE[:, 1, 1] = True
+NEIGHBOR_STRUCTURE = np.logical_or(XY_STRUCTURE, Z_STRUCTURE)
+FULL_STRUCTURE = np.ones((3, 3, 3), dtype=np.bool_)
+
+
+def radii(steps):
+    # (z, y, x) radius of the box that `steps` anisotropic steps add up to
+    return steps // Z_RATIO, steps, steps
+
+
+def dilate(mask, steps):
+    # equivalent to alternating binary dilations with XY_STRUCTURE (Z_RATIO iterations) and Z_STRUCTURE (1
+    # iteration), but computed as a single separable maximum filter with the combined box
+    if steps <= 0:
+        return np.copy(mask).astype(np.bool_)
+    size = tuple(2 * r + 1 for r in radii(steps))
+    return scipy.ndimage.maximum_filter(
+        mask.astype(np.bool_), size=size, mode="constant", cval=0
+    )
+
+
+def erode(mask, steps):
+    return ErosionDepth(mask).erode(steps)
+
+
+class ErosionDepth(object):
+    # erosions of a mask by any number of anisotropic steps. The mask is eroded in z via a distance transform along z
+    # and then in xy via a chessboard distance transform within each section, such that the erosion by a number of
+    # steps is only a threshold of the (cached) distances, and trying one less step is a lookup rather than a
+    # recomputation. Voxels outside the mask's array count as background, like for scipy's binary_erosion.
+    def __init__(self, mask):
+        self.mask = mask.astype(np.bool_)
+        self.inner = tuple(slice(1, -1) for _ in range(self.mask.ndim))
+        padded = np.pad(self.mask, 1, "constant")
+        self.z_depth = scipy.ndimage.distance_transform_cdt(padded, metric=Z_STRUCTURE)
+        self.xy_depths = dict()
+        self.max_xy_depths = dict()
+
+    def get_xy_depth(self, z_radius):
+        if z_radius not in self.xy_depths:
+            self.xy_depths[z_radius] = scipy.ndimage.distance_transform_cdt(
+                self.z_depth > z_radius, metric=XY_STRUCTURE
+            )
+            self.max_xy_depths[z_radius] = np.max(self.xy_depths[z_radius])
+        return self.xy_depths[z_radius]
+
+    def erode(self, steps):
+        if steps <= 0:
+            return np.copy(self.mask)
+        z_radius = radii(steps)[0]
+        return (self.get_xy_depth(z_radius) > steps)[self.inner]
+
+    def is_empty(self, steps):
+        if steps <= 0:
+            return not np.any(self.mask)
+        z_radius = radii(steps)[0]
+        self.get_xy_depth(z_radius)
+        return self.max_xy_depths[z_radius] <= steps
+
+    def max_steps(self, steps):
+        # the largest number of steps up to `steps` for which the eroded mask does not vanish
+        while steps > 0 and self.is_empty(steps):
+            steps -= 1
+        return max(steps, 0)
@@ -0,0 +1,43 @@
+import collections
+import multiprocessing
+import multiprocessing.pool
+
+
+def imap_ordered(
+    func,
+    jobs,
+    num_workers,
+    initializer=None,
+    initargs=(),
+    max_pending_per_worker=2,
+    threads=False,
+):
+    # yields func(*job) for all jobs in order. With num_workers > 1 jobs are processed by a pool of workers and at
+    # most max_pending_per_worker * num_workers results are outstanding at any time, such that memory is bounded and
+    # the output does not depend on the scheduling. For a process pool func has to be a module level function, a
+    # thread pool (threads=True) is enough if func mostly waits for I/O or releases the GIL.
+    if num_workers <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for job in jobs:
+            yield func(*job)
+        return
+    if threads:
+        pool_class = multiprocessing.pool.ThreadPool
+    else:
+        pool_class = multiprocessing.Pool
+    pool = pool_class(num_workers, initializer=initializer, initargs=initargs)
+    pending = collections.deque()
+    try:
+        for job in jobs:
+            pending.append(pool.apply_async(func, job))
+            if len(pending) >= max_pending_per_worker * num_workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
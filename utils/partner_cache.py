@@ -0,0 +1,89 @@
+import hashlib
+import json
+import sqlite3
+import numpy as np
+from utils.sqlite_transaction import Transaction
+
+
+def content_key(params, *arrays):
+    # a hash of the parameters (anything json serializable) and the shape, type and content of the arrays
+    h = hashlib.sha1(json.dumps(params, sort_keys=True).encode())
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        h.update(json.dumps([a.shape, a.dtype.str]).encode())
+        h.update(a.tobytes())
+    return h.hexdigest()
+
+
+def plain(value):
+    # numpy scalars as the python number of the same kind, such that ints stay ints through json
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class PartnerCache(object):
+    # results of the partner finding of single clefts, addressed by a content_key of everything the result depends on
+    # (the crops of the cleft mask, segmentation and pre/post predictions and the thresholds). Checkpoints of a sweep
+    # share most clefts unchanged, their partners are only computed for the first one.
+    def __init__(self, filename, timeout=600):
+        self.filename = filename
+        self.timeout = timeout
+        with self.connect() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS partners (key TEXT PRIMARY KEY, partners TEXT)"
+            )
+
+    def connect(self, exclusive=True):
+        db = sqlite3.connect(self.filename, timeout=self.timeout, isolation_level=None)
+        return Transaction(db, exclusive=exclusive)
+
+    def get_many(self, keys, batch_size=500):
+        # the cached partners of all keys that are in the cache, read on one connection without taking the write lock
+        # (in batches below sqlite's limit on the number of parameters of a statement)
+        keys = sorted(set(keys))
+        rows = []
+        with self.connect(exclusive=False) as db:
+            for i in range(0, len(keys), batch_size):
+                batch = keys[i : i + batch_size]
+                rows.extend(
+                    db.execute(
+                        "SELECT key, partners FROM partners WHERE key IN ({0:})".format(
+                            ", ".join("?" * len(batch))
+                        ),
+                        batch,
+                    ).fetchall()
+                )
+        return dict(
+            (
+                key,
+                [
+                    (tuple(pre), tuple(post)) + tuple(stats)
+                    for pre, post, stats in json.loads(partners)
+                ],
+            )
+            for key, partners in rows
+        )
+
+    def put_many(self, items):
+        # items maps keys to lists of partners (pre location, post location, stats...)
+        with self.connect() as db:
+            db.executemany(
+                "INSERT OR REPLACE INTO partners VALUES (?, ?)",
+                [
+                    (
+                        key,
+                        json.dumps(
+                            [
+                                [
+                                    [int(p) for p in partner[0]],
+                                    [int(p) for p in partner[1]],
+                                    [plain(s) for s in partner[2:]],
+                                ]
+                                for partner in partners
+                            ]
+                        ),
+                    )
+                    for key, partners in items.items()
+                ],
+            )
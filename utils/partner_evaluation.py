@@ -0,0 +1,126 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import pickle
+import tempfile
+import numpy as np
+from cremi import Volume
+from cremi.io import CremiFile
+from cremi.evaluation import SynapticPartners, SynapticPartnersMultRecGt
+from utils.parallel import imap_ordered
+
+
+class TruthCache(object):
+    # ground truth neuron ids and annotations of CREMI files, converted once to files in cache_dir. The neuron ids are
+    # stored as .npy and memory mapped, such that any number of evaluations (also in different processes) share the
+    # same pages in the page cache instead of each reading the whole volume from hdf5. Entries are keyed by path,
+    # size and modification time of the truth file, such that a changed truth file is converted again.
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.loaded = dict()
+
+    def key(self, truth_file):
+        stat = os.stat(truth_file)
+        return hashlib.sha1(
+            "{0:}:{1:}:{2:}".format(
+                os.path.abspath(truth_file), stat.st_size, stat.st_mtime
+            ).encode()
+        ).hexdigest()
+
+    def convert(self, truth_file, prefix):
+        # files are written under temporary names and renamed, such that concurrent conversions of the same truth file
+        # do not see each other's partial files
+        truth = CremiFile(truth_file, "r")
+        neuron_ids = truth.read_neuron_ids()
+        annotations = truth.read_annotations()
+        truth.close()
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".npy")
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, np.asarray(neuron_ids.data))
+        os.rename(tmp, prefix + ".neuron_ids.npy")
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir)
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(
+                {
+                    "resolution": tuple(neuron_ids.resolution),
+                    "offset": tuple(neuron_ids.offset),
+                    "annotations": annotations,
+                },
+                f,
+                pickle.HIGHEST_PROTOCOL,
+            )
+        os.rename(tmp, prefix + ".pkl")
+        logging.info("Cached ground truth of {0:} at {1:}".format(truth_file, prefix))
+
+    def get(self, truth_file):
+        # returns the neuron ids (a Volume of memory mapped data) and the annotations of truth_file
+        key = self.key(truth_file)
+        if key not in self.loaded:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            prefix = os.path.join(self.cache_dir, key)
+            if not os.path.exists(prefix + ".pkl"):
+                self.convert(truth_file, prefix)
+            with open(prefix + ".pkl", "rb") as f:
+                meta = pickle.load(f)
+            neuron_ids = Volume(
+                np.load(prefix + ".neuron_ids.npy", mmap_mode="r"),
+                resolution=meta["resolution"],
+                offset=meta["offset"],
+            )
+            self.loaded[key] = (neuron_ids, meta["annotations"])
+        return self.loaded[key]
+
+
+def evaluate_partners(test_file, truth_file, cache, multrecgt=False):
+    # synaptic partner scores of the annotations in test_file against truth_file, with the truth taken from cache
+    neuron_ids, truth_annotations = cache.get(truth_file)
+    test = CremiFile(test_file, "r")
+    test_annotations = test.read_annotations()
+    test.close()
+    if multrecgt:
+        synaptic_partners_eval = SynapticPartnersMultRecGt()
+    else:
+        synaptic_partners_eval = SynapticPartners()
+    fscore, precision, recall, fp, fn, filtered_matches = synaptic_partners_eval.fscore(
+        test_annotations, truth_annotations, neuron_ids, all_stats=True
+    )
+    return {
+        "fscore": fscore,
+        "precision": precision,
+        "recall": recall,
+        "fp": fp,
+        "fn": fn,
+        "filtered_matches": filtered_matches,
+    }
+
+
+worker_cache = None
+
+
+def init_worker(cache_dir):
+    global worker_cache
+    worker_cache = TruthCache(cache_dir)
+
+
+def evaluate_job(test_file, truth_file, multrecgt):
+    return evaluate_partners(test_file, truth_file, worker_cache, multrecgt=multrecgt)
+
+
+def evaluate_many(jobs, cache_dir, num_workers=None):
+    # evaluates jobs of (test_file, truth_file, multrecgt) with a pool of processes and yields their results in order.
+    # Every truth file is converted once up front, afterwards all workers only map the cached files.
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    jobs = list(jobs)
+    cache = TruthCache(cache_dir)
+    for truth_file in sorted(set(job[1] for job in jobs)):
+        cache.get(truth_file)
+    return imap_ordered(
+        evaluate_job,
+        jobs,
+        min(num_workers, len(jobs)),
+        initializer=init_worker,
+        initargs=(cache_dir,),
+    )
@@ -0,0 +1,44 @@
+import numpy as np
+import scipy.ndimage
+import scipy.spatial
+
+FACE_STRUCTURE = scipy.ndimage.generate_binary_structure(3, 1)
+
+
+def inner_boundary(mask):
+    # voxels of the mask with a face-neighbor outside of the mask. The voxel of a mask that is closest to any point
+    # outside of it always lies on this boundary (stepping towards the point would otherwise decrease the distance),
+    # voxels at the border of the array therefore do not need to be included.
+    return np.logical_and(
+        mask,
+        np.logical_not(
+            scipy.ndimage.binary_erosion(mask, structure=FACE_STRUCTURE, border_value=1)
+        ),
+    )
+
+
+class PointCloud(object):
+    # voxels of a mask in raster order, scaled to physical units, with a kd-tree for nearest point queries such that
+    # distances between two disjoint masks only cost in the number of their boundary voxels instead of a distance
+    # transform over the whole array
+    def __init__(self, mask, sampling, boundary_only=True):
+        if boundary_only:
+            mask = inner_boundary(mask)
+        self.voxels = np.transpose(np.nonzero(mask))
+        self.points = self.voxels * np.array(sampling, dtype=np.float64)
+        self.tree = None
+
+    def __len__(self):
+        return len(self.voxels)
+
+    def get_tree(self):
+        if self.tree is None:
+            self.tree = scipy.spatial.cKDTree(self.points)
+        return self.tree
+
+    def closest_to(self, other):
+        # voxel of this point cloud that is closest to the other point cloud and its distance. Ties are resolved in
+        # raster order, i.e. the same way as an argmin over a distance map of the other mask.
+        distances, _ = other.get_tree().query(self.points)
+        idx = np.argmin(distances)
+        return tuple(self.voxels[idx]), distances[idx]
@@ -0,0 +1,222 @@
+import fcntl
+import glob
+import json
+import os
+import resource
+import threading
+import time
+import numpy as np
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+GB = 1024.0 ** 3
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def read_proc(name):
+    # key value pairs of /proc/self/<name>, None if not available (i.e. not on linux)
+    try:
+        with open(os.path.join("/proc/self", name), "r") as f:
+            lines = f.readlines()
+    except (IOError, OSError):
+        return None
+    values = dict()
+    for line in lines:
+        key, value = line.split(":", 1)
+        if value.strip():
+            values[key.strip()] = value.split()[0]
+    return values
+
+
+def reset_peak_rss():
+    # resets the high water mark of the resident set size to the current one (linux >= 4.0), such that the peak of a
+    # single task can be measured in a process that has run others before. Returns whether that was possible.
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def peak_rss():
+    # peak resident set size of this process in bytes
+    status = read_proc("status")
+    if status is not None and "VmHWM" in status:
+        return int(status["VmHWM"]) * 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def tree_rss(pid=None):
+    # current resident set size of a process and all of its descendants in bytes, None if not available. Uses psutil
+    # if it is installed and follows /proc/<pid>/task/*/children otherwise.
+    if pid is None:
+        pid = os.getpid()
+    if psutil is not None:
+        try:
+            root = psutil.Process(pid)
+            processes = [root] + root.children(recursive=True)
+        except psutil.Error:
+            return None
+        total = 0
+        for process in processes:
+            try:
+                total += process.memory_info().rss
+            except psutil.Error:
+                # exited in the meantime
+                pass
+        return total
+    total = None
+    pending = [pid]
+    while pending:
+        p = pending.pop()
+        try:
+            with open("/proc/{0:}/statm".format(p), "r") as f:
+                rss = int(f.read().split()[1]) * PAGE_SIZE
+        except (IOError, OSError, ValueError, IndexError):
+            continue
+        total = (total or 0) + rss
+        for children in glob.glob("/proc/{0:}/task/*/children".format(p)):
+            try:
+                with open(children, "r") as f:
+                    pending.extend(int(c) for c in f.read().split())
+            except (IOError, OSError):
+                pass
+    return total
+
+
+class TreeRssSampler(threading.Thread):
+    # polls the rss of this process and all of its descendants every interval seconds and keeps the maximum. Unlike
+    # the rusage of the children (the peak of the largest one) this covers children running concurrently, e.g. a
+    # worker pool, but can miss short spikes between two samples.
+    def __init__(self, interval=0.5):
+        super(TreeRssSampler, self).__init__()
+        self.daemon = True
+        self.interval = interval
+        self.peak = None
+        self.stopping = threading.Event()
+
+    def run(self):
+        while True:
+            rss = tree_rss()
+            if rss is not None:
+                self.peak = max(self.peak, rss) if self.peak is not None else rss
+            if self.stopping.wait(self.interval):
+                break
+
+    def stop(self):
+        self.stopping.set()
+        self.join()
+        return self.peak
+
+
+class Profiler(object):
+    # measures wall time, peak rss and io of this process (and its children) between start and stop
+    def __init__(self, interval=0.5):
+        self.t_start = None
+        self.io_start = None
+        self.peak_reset = False
+        self.interval = interval
+        self.sampler = None
+
+    def start(self):
+        self.peak_reset = reset_peak_rss()
+        self.io_start = read_proc("io")
+        self.sampler = TreeRssSampler(self.interval)
+        self.sampler.start()
+        self.t_start = time.time()
+
+    def cancel(self):
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler = None
+
+    def stop(self):
+        profile = dict()
+        profile["wall_time"] = time.time() - self.t_start
+        profile["peak_rss"] = peak_rss()
+        # the peak of the largest child process, e.g. of a worker pool
+        profile["peak_rss_children"] = (
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+        )
+        # the sampled peak of this process and all children running at the same time
+        profile["peak_rss_tree"] = self.sampler.stop()
+        self.sampler = None
+        # without a reset the peak of this process can include earlier work, i.e. is an upper bound
+        profile["peak_rss_exact"] = self.peak_reset
+        io_stop = read_proc("io")
+        if self.io_start is not None and io_stop is not None:
+            # bytes passed to read/write calls and bytes actually fetched from/sent to the storage layer
+            profile["bytes_read"] = int(io_stop["rchar"]) - int(self.io_start["rchar"])
+            profile["bytes_written"] = int(io_stop["wchar"]) - int(
+                self.io_start["wchar"]
+            )
+            profile["storage_bytes_read"] = int(io_stop["read_bytes"]) - int(
+                self.io_start["read_bytes"]
+            )
+            profile["storage_bytes_written"] = int(io_stop["write_bytes"]) - int(
+                self.io_start["write_bytes"]
+            )
+        return profile
+
+
+class ProfileHistory(object):
+    # recorded profiles of all tasks, one json record per line, from which the resources of future tasks are estimated.
+    # Records are appended under a file lock since tasks finish concurrently, the file is read once per process.
+    def __init__(self, filename, max_records=50, margin=1.25):
+        self.filename = filename
+        self.max_records = max_records
+        self.margin = margin
+        self.records = None
+
+    def load(self):
+        self.records = dict()
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # partially written line
+                    continue
+                self.records.setdefault(record["task_family"], []).append(record)
+
+    def get_records(self, task_family):
+        if self.records is None:
+            self.load()
+        return self.records.get(task_family, [])[-self.max_records :]
+
+    def append(self, record):
+        if self.records is None:
+            self.load()
+        with open(self.filename, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write(json.dumps(record) + "\n")
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        self.records.setdefault(record["task_family"], []).append(record)
+
+    def estimate_ram(self, task_family, voxels=None):
+        # ram (in GB) for a task of the given family on a volume with the given number of voxels, from the largest
+        # recorded peak per voxel of that family and a safety margin. None if there is no history to go by.
+        peaks = []
+        for record in self.get_records(task_family):
+            if record.get("peak_rss_tree") is not None:
+                # the peak of this process itself is exact, the sampled one can miss spikes
+                peak = max(record["peak_rss_tree"], record["peak_rss"])
+            else:
+                # older records, only an approximation for concurrent children
+                peak = record["peak_rss"] + record["peak_rss_children"]
+            if voxels is None:
+                peaks.append(peak)
+            elif record.get("voxels"):
+                peaks.append(peak * voxels / float(record["voxels"]))
+        if len(peaks) == 0:
+            return None
+        return int(np.ceil(self.margin * max(peaks) / GB))
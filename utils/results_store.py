@@ -0,0 +1,160 @@
+import json
+import numbers
+import os
+import sqlite3
+import tempfile
+import time
+import numpy as np
+from utils.sqlite_transaction import Transaction
+
+# the keys every result is recorded under, an experiment is e.g. the training data (of the luigi pipeline) or the name
+# of a training run. Keys that do not apply to a result are left empty (an iteration of -1).
+KEYS = ("experiment", "augmentation", "data_eval", "sample", "iteration", "mode")
+EMPTY = {"iteration": -1}
+
+# sqlite's file locking is unreliable on network file systems (e.g. /nrs), where many luigi tasks append at once, so
+# the store belongs on a local disk. It can be placed with the environment variable CNNECTOME_RESULTS_STORE.
+default_store = os.environ.get(
+    "CNNECTOME_RESULTS_STORE",
+    os.path.join(tempfile.gettempdir(), "cnnectome_results.sqlite"),
+)
+
+
+def flatten(results, prefix=""):
+    # nested dicts of results to (metric, value) with metric names joined by "/", e.g. "false positive distance/mean"
+    for k, v in results.items():
+        metric = prefix + str(k)
+        if isinstance(v, dict):
+            for item in flatten(v, metric + "/"):
+                yield item
+        else:
+            yield metric, v
+
+
+def unflatten(metrics):
+    results = dict()
+    for metric, v in metrics:
+        d = results
+        path = metric.split("/")
+        for k in path[:-1]:
+            d = d.setdefault(k, dict())
+        d[path[-1]] = v
+    return results
+
+
+def where(filters, prefix=""):
+    # sql conditions and their arguments matching the columns of filters, a list or tuple matches any of its values
+    conditions = []
+    args = []
+    for k, v in sorted(filters.items()):
+        if isinstance(v, (list, tuple)):
+            conditions.append(
+                "{0:}{1:} IN ({2:})".format(prefix, k, ", ".join("?" * len(v)))
+            )
+            args.extend(v)
+        else:
+            conditions.append("{0:}{1:} = ?".format(prefix, k))
+            args.append(v)
+    return conditions, args
+
+
+class ResultsStore(object):
+    # an append-only table of the evaluation results of all experiments in a single sqlite file, with one row per
+    # metric. Re-evaluating a result appends new rows that supersede all rows of the previous evaluation, such that
+    # writers never modify rows and concurrent luigi tasks only contend for the short append. A whole sweep is loaded
+    # with a single query.
+    def __init__(self, filename=default_store, timeout=600):
+        self.filename = filename
+        self.timeout = timeout
+        with self.connect() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS results (experiment TEXT, augmentation TEXT, "
+                "data_eval TEXT, sample TEXT, iteration INTEGER, mode TEXT, "
+                "report TEXT, metric TEXT, value REAL, text TEXT, recorded_at REAL)"
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS results_keys ON results (experiment, "
+                "augmentation, data_eval, report, iteration)"
+            )
+
+    def connect(self):
+        db = sqlite3.connect(self.filename, timeout=self.timeout, isolation_level=None)
+        return Transaction(db)
+
+    def add(self, report, results, **keys):
+        # appends the (nested) dict results of the report (e.g. "cleft" or "partners") under keys. Numbers are stored
+        # as values, anything else json encoded as text.
+        unknown = set(keys) - set(KEYS)
+        if unknown:
+            raise ValueError("Unknown keys {0:}".format(sorted(unknown)))
+        key_values = tuple(keys.get(k, EMPTY.get(k, "")) for k in KEYS)
+        now = time.time()
+        rows = []
+        for metric, v in flatten(results):
+            if isinstance(v, numbers.Number) and not isinstance(v, bool):
+                rows.append(key_values + (report, metric, float(v), None, now))
+            else:
+                rows.append(key_values + (report, metric, None, json.dumps(v), now))
+        with self.connect() as db:
+            db.executemany(
+                "INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+            )
+
+    def query(self, report=None, metrics=None, **keys):
+        # the values of the metrics of the latest evaluation of every result matching report, metrics and keys as
+        # columns, i.e. a dict of arrays with one entry per (result, metric). A key (or report, metrics) given as list
+        # or tuple matches any of its values.
+        filters = dict(keys)
+        if report is not None:
+            filters["report"] = report
+        for k in filters:
+            if k not in KEYS + ("report",):
+                raise ValueError("Unknown key {0:}".format(k))
+        conditions, args = where(filters)
+        metric_conditions, metric_args = where(
+            dict(metric=metrics) if metrics is not None else dict(), prefix="r."
+        )
+        result_keys = KEYS + ("report",)
+        columns = result_keys + ("metric",)
+        # the latest evaluation is picked per result rather than per metric, such that metrics that a re-evaluation no
+        # longer contains are not mixed into it
+        sql = (
+            "SELECT {0:}, r.value, r.text FROM results r JOIN "
+            "(SELECT {1:}, MAX(recorded_at) AS latest FROM results {2:} GROUP BY {1:}) l "
+            "ON {3:} AND r.recorded_at = l.latest {4:}".format(
+                ", ".join("r." + c for c in columns),
+                ", ".join(result_keys),
+                "WHERE " + " AND ".join(conditions) if conditions else "",
+                " AND ".join("r.{0:} = l.{0:}".format(k) for k in result_keys),
+                "WHERE " + " AND ".join(metric_conditions) if metric_conditions else "",
+            )
+        )
+        with self.connect() as db:
+            rows = db.execute(sql, args + metric_args).fetchall()
+        if rows:
+            data = list(zip(*rows))
+        else:
+            data = [()] * (len(columns) + 2)
+        table = dict(
+            (k, list(column)) for k, column in zip(columns + ("value", "text"), data)
+        )
+        table["iteration"] = np.array(table["iteration"], dtype=np.int64)
+        table["value"] = np.array(
+            [np.nan if v is None else v for v in table["value"]], dtype=np.float64
+        )
+        return table
+
+    def reports(self, report=None, **keys):
+        # all matching results as nested dicts like the ones they were added as, keyed by (report,) + KEYS
+        table = self.query(report=report, **keys)
+        grouped = dict()
+        for i in range(len(table["metric"])):
+            key = (table["report"][i],) + tuple(
+                table[k][i] if k != "iteration" else int(table[k][i]) for k in KEYS
+            )
+            if table["text"][i] is None:
+                v = float(table["value"][i])
+            else:
+                v = json.loads(table["text"][i])
+            grouped.setdefault(key, []).append((table["metric"][i], v))
+        return dict((key, unflatten(metrics)) for key, metrics in grouped.items())
@@ -0,0 +1,207 @@
+import copy
+import ctypes
+import logging
+import multiprocessing
+import os
+import random
+import time
+import traceback
+import numpy as np
+from gunpowder import BatchFilter
+from gunpowder.profiling import Timing
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+logger = logging.getLogger(__name__)
+
+
+class SharedSlots(object):
+    # a ring of num_slots buffers in shared memory, each holding one array per key of the shapes and types of a
+    # template batch. Allocated before the workers are forked, such that workers write into the same memory that the
+    # training process reads batches from.
+    def __init__(self, batch, num_slots):
+        self.layout = dict(
+            (key, (array.data.shape, array.data.dtype))
+            for key, array in batch.arrays.items()
+        )
+        self.slots = []
+        for _ in range(num_slots):
+            slot = dict()
+            for key, (shape, dtype) in self.layout.items():
+                buf = multiprocessing.RawArray(
+                    ctypes.c_char, max(1, int(np.prod(shape)) * dtype.itemsize)
+                )
+                slot[key] = np.frombuffer(buf, dtype=dtype, count=int(np.prod(shape)))
+                slot[key] = slot[key].reshape(shape)
+            self.slots.append(slot)
+
+    def write(self, i, batch):
+        # copies the arrays of batch to slot i and detaches them from the batch, which then only carries specs and
+        # anything that is not an array (cheap to send through a queue)
+        for key, array in batch.arrays.items():
+            if self.layout[key][0] != array.data.shape:
+                raise ValueError(
+                    "{0:} has shape {1:}, expected {2:}".format(
+                        key, array.data.shape, self.layout[key][0]
+                    )
+                )
+            self.slots[i][key][...] = array.data
+            array.data = None
+
+    def read(self, i, batch):
+        # attaches the arrays of slot i to batch, without copying
+        for key, array in batch.arrays.items():
+            array.data = self.slots[i][key]
+
+
+class SharedMemoryPreCache(BatchFilter):
+    # A replacement of PreCache that produces batches of repeated equal requests in num_workers processes and hands
+    # them over through a ring of cache_size + hold buffers in shared memory instead of pickling the arrays through a
+    # queue. The upstream nodes (augmentations, distances, balancing) run in separate processes and do not compete
+    # for the GIL of the training process.
+    # Batches are returned as views of the shared buffers, the arrays of the last `hold` batches stay valid (e.g. to
+    # stack several batches into one training step), older ones are overwritten by the workers.
+    # stats() reports the number of batches waiting, the time downstream waited for them and the throughput of every
+    # worker, these are also logged every log_every batches. If the queue is mostly empty, more workers are needed to
+    # keep the training saturated.
+    def __init__(self, cache_size=50, num_workers=20, hold=1, log_every=100):
+        self.cache_size = cache_size
+        self.num_workers = num_workers
+        self.hold = hold
+        self.log_every = log_every
+        self.current_request = None
+        self.workers = []
+        self.held = []
+
+    def teardown(self):
+        self.stop_workers()
+
+    def provide(self, request):
+        if request != self.current_request:
+            if self.workers:
+                logger.info("new request received, stopping current workers...")
+                self.stop_workers()
+            self.current_request = copy.deepcopy(request)
+            # the first batch is produced here to learn the shapes and types of the arrays
+            batch = self.get_upstream_provider().request_batch(self.current_request)
+            self.start_workers(batch)
+            return batch
+        timing = Timing(self)
+        timing.start()
+        self.queue_depth += self.ready.qsize()
+        while True:
+            try:
+                item = self.ready.get(timeout=1)
+                break
+            except Queue.Empty:
+                if not all(worker.is_alive() for worker in self.workers):
+                    raise RuntimeError("at least one batch producer died")
+        timing.stop()
+        self.waited += timing.elapsed()
+        if isinstance(item, Exception):
+            raise item
+        i, worker, seconds, batch = item
+        self.slots.read(i, batch)
+        batch.profiling_stats.add(timing)
+        self.produced[worker] += 1
+        self.producing[worker] += seconds
+        self.held.append(i)
+        if len(self.held) > self.hold:
+            self.free.put(self.held.pop(0))
+        self.num_batches += 1
+        if self.log_every and self.num_batches % self.log_every == 0:
+            self.log_stats()
+        return batch
+
+    def start_workers(self, batch):
+        self.slots = SharedSlots(batch, self.cache_size + self.hold)
+        self.free = multiprocessing.Queue()
+        for i in range(self.cache_size + self.hold):
+            self.free.put(i)
+        self.ready = multiprocessing.Queue()
+        self.stopping = multiprocessing.Event()
+        self.held = []
+        self.num_batches = 0
+        self.queue_depth = 0
+        self.waited = 0.0
+        self.produced = [0] * self.num_workers
+        self.producing = [0.0] * self.num_workers
+        self.workers = [
+            multiprocessing.Process(target=self.run_worker, args=(w, os.getpid()))
+            for w in range(self.num_workers)
+        ]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+        logger.info(
+            "started {0:} batch producers with {1:} shared buffers".format(
+                self.num_workers, self.cache_size + self.hold
+            )
+        )
+
+    def stop_workers(self):
+        if not self.workers:
+            return
+        self.stopping.set()
+        for worker in self.workers:
+            worker.join(5)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        self.workers = []
+
+    def run_worker(self, w, parent_pid):
+        # forked processes start with the random state of the parent
+        np.random.seed(None)
+        random.seed()
+        upstream = self.get_upstream_provider()
+        try:
+            while not self.stopping.is_set() and os.getppid() == parent_pid:
+                try:
+                    i = self.free.get(timeout=1)
+                except Queue.Empty:
+                    continue
+                start = time.time()
+                try:
+                    batch = upstream.request_batch(self.current_request)
+                    self.slots.write(i, batch)
+                    self.ready.put((i, w, time.time() - start, batch))
+                except Exception as e:
+                    traceback.print_exc()
+                    self.free.put(i)
+                    self.ready.put(e)
+        except KeyboardInterrupt:
+            pass
+        os._exit(0)
+
+    def stats(self):
+        n = max(1, self.num_batches)
+        return {
+            "batches": self.num_batches,
+            "queue_depth": self.ready.qsize(),
+            "mean_queue_depth": float(self.queue_depth) / n,
+            "mean_wait": self.waited / n,
+            "seconds_per_batch": [
+                s / p if p else None for s, p in zip(self.producing, self.produced)
+            ],
+            "batches_per_second": sum(
+                p / s for s, p in zip(self.producing, self.produced) if s
+            ),
+        }
+
+    def log_stats(self):
+        stats = self.stats()
+        logger.info(
+            "{0:} batches, mean queue depth {1:.1f} of {2:}, mean wait {3:.3f}s, "
+            "producing {4:.2f} batches/s with {5:} workers".format(
+                stats["batches"],
+                stats["mean_queue_depth"],
+                self.cache_size,
+                stats["mean_wait"],
+                stats["batches_per_second"],
+                self.num_workers,
+            )
+        )
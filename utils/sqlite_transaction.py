@@ -0,0 +1,20 @@
+class Transaction(object):
+    # a transaction on a sqlite connection that is committed on success and rolled back on errors, the connection is
+    # closed in either case. Exclusive transactions take the write lock right away, others (e.g. only reading) share
+    # the database with other readers until they write. The connection has to be opened with isolation_level=None.
+    def __init__(self, db, exclusive=True):
+        self.db = db
+        self.exclusive = exclusive
+
+    def __enter__(self):
+        self.db.execute("BEGIN IMMEDIATE" if self.exclusive else "BEGIN")
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.db.execute("COMMIT")
+            else:
+                self.db.execute("ROLLBACK")
+        finally:
+            self.db.close()
@@ -0,0 +1,40 @@
+import numpy as np
+from utils.blockwise import iterate_blocks
+from utils.parallel import imap_ordered
+
+
+def copy(data):
+    return data
+
+
+def threshold(thr):
+    def apply(data):
+        return (data > thr).astype(np.uint8)
+
+    return apply
+
+
+def stream_block(src, targets, offset, bs):
+    data = src[tuple(slice(s.start + o, s.stop + o) for s, o in zip(bs, offset))]
+    for tgt, op in targets:
+        tgt[bs] = op(data)
+
+
+def stream(src, targets, offset=None, block_shape=None, num_threads=4):
+    # applies a list of (target dataset, operation) pairs to the source (cropped to the region of the targets' shape
+    # starting at offset) block by block, i.e. every block is read once for all targets and memory stays at a few
+    # blocks. Targets have to share their shape and chunks, blocks are aligned to these chunks such that no two
+    # blocks are written to the same chunk. z5py releases the GIL for (de)compression, so blocks are processed by a
+    # pool of num_threads threads.
+    shape = tuple(targets[0][0].shape)
+    chunks = tuple(targets[0][0].chunks)
+    for tgt, _ in targets:
+        assert tuple(tgt.shape) == shape and tuple(tgt.chunks) == chunks
+    if offset is None:
+        offset = (0,) * len(shape)
+    if block_shape is None:
+        block_shape = chunks
+    assert all(b % c == 0 for b, c in zip(block_shape, chunks))
+    jobs = ((src, targets, offset, bs) for bs in iterate_blocks(shape, block_shape))
+    for _ in imap_ordered(stream_block, jobs, num_threads, threads=True):
+        pass
@@ -0,0 +1,243 @@
+import collections
+import logging
+import threading
+import time
+import numpy as np
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+STOP = None
+
+
+class StageTimer(object):
+    # accumulated seconds per stage, shared by the threads of the inference loop
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.times = collections.OrderedDict()
+
+    def add(self, stage, t):
+        with self.lock:
+            self.times[stage] = self.times.get(stage, 0.0) + t
+
+    def report(self, num_blocks):
+        return ", ".join(
+            "{0:}: {1:.1f} s ({2:.3f} s/block)".format(k, v, v / max(num_blocks, 1))
+            for k, v in self.times.items()
+        )
+
+
+class HaloReader(object):
+    # reads the input windows of consecutive blocks from a dataset. Windows can extend beyond the dataset, the part
+    # inside of it is read and padded afterwards. When the window moves along a single axis by less than its extent (as
+    # when walking blocks in raster order) the overlapping halo is taken from the previous window and only the new slab
+    # is read from the dataset.
+    def __init__(self, dataset, shape, padding_mode="reflect"):
+        self.dataset = dataset
+        self.shape = shape
+        self.padding_mode = padding_mode
+        self.roi = None
+        self.data = None
+        self.voxels_read = 0
+        self.voxels_reused = 0
+
+    def clip(self, start):
+        return tuple(
+            slice(max(0, s), min(sh, s + w))
+            for s, w, sh in zip(start, self.shape, self.dataset.shape)
+        )
+
+    def read_roi(self, roi):
+        shift = None
+        if self.roi is not None:
+            moved = [
+                a
+                for a, (r, p) in enumerate(zip(roi, self.roi))
+                if (r.start, r.stop) != (p.start, p.stop)
+            ]
+            if len(moved) == 1:
+                a = moved[0]
+                overlap = (
+                    max(roi[a].start, self.roi[a].start),
+                    min(roi[a].stop, self.roi[a].stop),
+                )
+                if overlap[0] < overlap[1]:
+                    shift = a, overlap
+        if shift is None:
+            data = self.dataset[roi]
+            self.voxels_read += data.size
+            return data
+        a, (o_start, o_stop) = shift
+        data = np.empty(tuple(r.stop - r.start for r in roi), dtype=self.data.dtype)
+        src = [slice(None)] * len(roi)
+        tgt = [slice(None)] * len(roi)
+        src[a] = slice(o_start - self.roi[a].start, o_stop - self.roi[a].start)
+        tgt[a] = slice(o_start - roi[a].start, o_stop - roi[a].start)
+        data[tuple(tgt)] = self.data[tuple(src)]
+        self.voxels_reused += self.data[tuple(src)].size
+        # the rest of the window lies before or after the overlap along the axis of movement
+        for r_start, r_stop in ((roi[a].start, o_start), (o_stop, roi[a].stop)):
+            if r_start < r_stop:
+                new = list(roi)
+                new[a] = slice(r_start, r_stop)
+                tgt[a] = slice(r_start - roi[a].start, r_stop - roi[a].start)
+                slab = self.dataset[tuple(new)]
+                data[tuple(tgt)] = slab
+                self.voxels_read += slab.size
+        return data
+
+    def read(self, start):
+        roi = self.clip(start)
+        data = self.read_roi(roi)
+        self.roi = roi
+        self.data = data
+        pad = [(r.start - s, s + w - r.stop) for s, w, r in zip(start, self.shape, roi)]
+        if any(p != (0, 0) for p in pad):
+            data = np.pad(data, pad, mode=self.padding_mode)
+        return data
+
+
+def put_unless_stopped(queue, item, stop, interval=0.1):
+    # puts item into the queue unless stop is set while waiting for a free slot, returns whether it was put
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=interval)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+
+def reader(
+    src, offsets, input_shape, context, preprocess, timer, blocks, padding_mode, stop
+):
+    halo_reader = HaloReader(src, input_shape, padding_mode=padding_mode)
+    try:
+        for offset in offsets:
+            if stop.is_set():
+                return
+            t = time.time()
+            data = halo_reader.read([o - c for o, c in zip(offset, context)])
+            timer.add("read", time.time() - t)
+            t = time.time()
+            data = preprocess(data)
+            timer.add("preprocess", time.time() - t)
+            if not put_unless_stopped(blocks, (offset, data), stop):
+                return
+    except Exception as e:
+        put_unless_stopped(blocks, e, stop)
+        raise
+    finally:
+        put_unless_stopped(blocks, STOP, stop)
+        logging.info(
+            "Read {0:} voxels, reused {1:} voxels of the halo".format(
+                halo_reader.voxels_read, halo_reader.voxels_reused
+            )
+        )
+
+
+def writer(tgts, output_shape, postprocess, timer, outputs, on_done, errors):
+    while True:
+        item = outputs.get()
+        if item is STOP:
+            return
+        offset, out = item
+        try:
+            t = time.time()
+            bb = tuple(
+                slice(o, min(o + s, sh))
+                for o, s, sh in zip(offset, output_shape, tgts[0].shape)
+            )
+            local = tuple(slice(0, b.stop - b.start) for b in bb)
+            for tgt, o in zip(tgts, out):
+                tgt[bb] = postprocess(o, bb)[local]
+            timer.add("write", time.time() - t)
+            if on_done is not None:
+                on_done(offset)
+        except Exception as e:
+            logging.exception("Could not write block {0:}".format(offset))
+            errors.append(e)
+
+
+def tiled_inference(
+    predict,
+    preprocess,
+    postprocess,
+    src,
+    tgts,
+    offsets,
+    input_shape,
+    output_shape,
+    prefetch=2,
+    on_done=None,
+    padding_mode="reflect",
+):
+    # predicts the output blocks at offsets (in raster order for halo reuse) of the datasets tgts (one per output of
+    # predict) from the dataset src. Blocks are read, decompressed and preprocessed by a reader thread up to prefetch
+    # blocks ahead and postprocessed, compressed and written by a writer thread, such that i/o overlaps with predict.
+    # on_done(offset) is called for every block once it is written. Returns the seconds spent per stage, where the time
+    # predict spent waiting for the reader or the writer shows whether i/o or compute is the bottleneck.
+    context = [(i - o) // 2 for i, o in zip(input_shape, output_shape)]
+    timer = StageTimer()
+    blocks = Queue.Queue(maxsize=prefetch)
+    outputs = Queue.Queue(maxsize=prefetch)
+    errors = []
+    # tells the reader to stop when predict or the writer failed
+    stop = threading.Event()
+    read_thread = threading.Thread(
+        target=reader,
+        args=(
+            src,
+            offsets,
+            input_shape,
+            context,
+            preprocess,
+            timer,
+            blocks,
+            padding_mode,
+            stop,
+        ),
+    )
+    write_thread = threading.Thread(
+        target=writer,
+        args=(tgts, output_shape, postprocess, timer, outputs, on_done, errors),
+    )
+    read_thread.daemon = True
+    read_thread.start()
+    write_thread.start()
+    num_blocks = 0
+    try:
+        while True:
+            t = time.time()
+            item = blocks.get()
+            timer.add("wait for read", time.time() - t)
+            if item is STOP:
+                break
+            if isinstance(item, Exception):
+                raise item
+            offset, data = item
+            t = time.time()
+            out = predict(data)
+            timer.add("predict", time.time() - t)
+            t = time.time()
+            outputs.put((offset, out))
+            timer.add("wait for write", time.time() - t)
+            num_blocks += 1
+            if errors:
+                raise errors[0]
+    finally:
+        stop.set()
+        outputs.put(STOP)
+        write_thread.join()
+        # release the windows the reader has prefetched, e.g. in a worker that keeps serving after a failed job
+        read_thread.join()
+        while not blocks.empty():
+            blocks.get()
+    if errors:
+        raise errors[0]
+    logging.info(
+        "Predicted {0:} blocks: {1:}".format(num_blocks, timer.report(num_blocks))
+    )
+    return timer.times
@@ -8,6 +8,10 @@ from cremi.evaluation import (
 )
 import logging
 import sys
+from utils.partner_evaluation import evaluate_many
+
+# ground truth converted for memory mapping, shared by all evaluations
+truth_cache_dir = "/nrs/saalfeld/heinrichl/synapses/data_and_augmentations/truth_cache"
 
 
 def evaluate(test, truth):
@@ -73,40 +77,41 @@ def evaluate_multrecgt(test, truth, add_in_file=False):
     return fscore
 
 
+def files(s, data=None):
+    # the test file and the truth file it is evaluated against
+    sample = (s.split("/")[-1]).split("_")[0]
+    truth_fn = (
+        "/groups/saalfeld/saalfeldlab/larissa/data/cremi-2017/sample_{"
+        "0:}_padded_20170424.aligned.hdf".format(sample)
+    )
+    if data == "val" or data == "validation" or data == "VAL" or data == "VALIDATION":
+        assert s.endswith(".hdf")
+        return (
+            s.replace(".hdf", ".validation.hdf"),
+            truth_fn.replace(".hdf", ".validation.hdf"),
+        )
+    elif data == "train" or data == "training" or data == "TRAIN" or data == "TRAINING":
+        assert s.endswith(".hdf")
+        return (
+            s.replace(".hdf", ".training.hdf"),
+            truth_fn.replace(".hdf", ".training.hdf"),
+        )
+    else:
+        return s, truth_fn
+
+
 def main(s, mode=0, data=None):
     # samples = ['A','B', 'C']
     samples = [(s.split("/")[-1]).split("_")[0]]
     for sample in samples:
         logging.info("evaluating synapse predictions for sample {0:}".format(sample))
-        truth_fn = (
-            "/groups/saalfeld/saalfeldlab/larissa/data/cremi-2017/sample_{"
-            "0:}_padded_20170424.aligned.hdf".format(sample)
-        )
         if data is not None:
             logging.info(
                 "sample {0:} in mode {1:} using {2:}".format(sample, mode, data)
             )
-        if (
-            data == "val"
-            or data == "validation"
-            or data == "VAL"
-            or data == "VALIDATION"
-        ):
-            assert s.endswith(".hdf")
-            test = CremiFile(s.replace(".hdf", ".validation.hdf"), "a")
-            truth = CremiFile(truth_fn.replace(".hdf", ".validation.hdf"), "a")
-        elif (
-            data == "train"
-            or data == "training"
-            or data == "TRAIN"
-            or data == "TRAINING"
-        ):
-            assert s.endswith(".hdf")
-            test = CremiFile(s.replace(".hdf", ".training.hdf"), "a")
-            truth = CremiFile(truth_fn.replace(".hdf", ".training.hdf"), "a")
-        else:
-            test = CremiFile(s, "a")
-            truth = CremiFile(truth_fn, "a")
+        test_fn, truth_fn = files(s, data)
+        test = CremiFile(test_fn, "a")
+        truth = CremiFile(truth_fn, "a")
 
         if mode == 0:
             evaluate(test, truth)
@@ -116,17 +121,29 @@ def main(s, mode=0, data=None):
             evaluate_multrecgt(test, truth)
 
 
-def main_all(s):
-    # samples = ['A','B', 'C']
-    main(s, 0, "VAL")
-    main(s, 2, "VAL")
-    main(s, 0, "TRAIN")
-    main(s, 2, "TRAIN")
+def main_all(s, num_workers=None):
+    # evaluates modes 0 and 2 on validation and training data of all files in s (e.g. a sweep over iterations) in
+    # parallel, reading every truth file only once
+    jobs = []
+    for test_fn in s:
+        for data in ["VAL", "TRAIN"]:
+            for mode in [0, 2]:
+                jobs.append(files(test_fn, data) + (mode == 2,))
+    for (test_fn, truth_fn, multrecgt), results in zip(
+        jobs, evaluate_many(jobs, truth_cache_dir, num_workers=num_workers)
+    ):
+        logging.info(
+            "{0:} against {1:} in mode {2:}".format(
+                test_fn, truth_fn, 2 if multrecgt else 0
+            )
+        )
+        for k in ["fscore", "precision", "recall", "fp", "fn"]:
+            logging.info("\t{0:}: {1:}".format(k, results[k]))
 
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
-    s = sys.argv[1]
+    s = sys.argv[1:]
     # m = int(sys.argv[2])
     # d = sys.argv[3]
     # main(s, m, d)
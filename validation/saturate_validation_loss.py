@@ -1,90 +1,13 @@
 from __future__ import print_function
 import h5py
 import numpy as np
-from scipy import ndimage
 import itertools
 import json
 import os
 import sys
 import z5py
-
-
-class Clefts:
-    def __init__(self, to_be_evaluated, gt, inverted_mask, scale=200.0):
-        self.scale = scale
-        test_clefts = to_be_evaluated
-        truth_clefts = gt
-        self.truth_clefts_invalid = np.logical_or(
-            truth_clefts == 0xFFFFFFFFFFFFFFFE, truth_clefts == 0xFFFFFFFFFFFFFFFD
-        )
-        # print(np.sum(truth_clefts == 0xffffffffffffffff), np.sum(self.truth_clefts_invalid), np.sum(inverted_mask))
-        self.truth_clefts_mask = np.logical_or(
-            np.logical_or(
-                truth_clefts == 0xFFFFFFFFFFFFFFFF, self.truth_clefts_invalid
-            ),
-            inverted_mask,
-        )
-        # print(np.sum(self.truth_clefts_mask), np.sum(np.logical_not(self.truth_clefts_mask)))
-        # print(np.sum(test_clefts == 0), np.sum(self.truth_clefts_invalid), np.sum(inverted_mask))
-        self.test_clefts_mask = np.logical_or(
-            np.logical_or(test_clefts == 0, self.truth_clefts_invalid), inverted_mask
-        )
-        # print(np.sum(self.test_clefts_mask), np.sum(np.logical_not(self.test_clefts_mask)))
-        self.test_clefts_edt = ndimage.distance_transform_edt(
-            self.test_clefts_mask, sampling=(40.0, 4.0, 4.0)
-        )
-        self.test_clefts_edt = np.tanh(self.test_clefts_edt / self.scale)
-        self.truth_clefts_edt = ndimage.distance_transform_edt(
-            self.truth_clefts_mask, sampling=(40.0, 4.0, 4.0)
-        )
-        self.truth_clefts_edt = np.tanh(self.truth_clefts_edt / self.scale)
-
-    def count_false_positives(self, threshold=200):
-        mask1 = np.invert(self.test_clefts_mask)
-        mask2 = self.truth_clefts_edt > threshold
-        false_positives = self.truth_clefts_edt[np.logical_and(mask1, mask2)]
-        return false_positives.size
-
-    def count_false_negatives(self, threshold=200):
-        mask1 = np.invert(self.truth_clefts_mask)
-        mask2 = self.test_clefts_edt > threshold
-        false_negatives = self.test_clefts_edt[np.logical_and(mask1, mask2)]
-        return false_negatives.size
-
-    def acc_false_positives(self):
-        mask = np.invert(self.test_clefts_mask)
-        false_positives = self.truth_clefts_edt[mask]
-        try:
-            stats = {
-                "mean": np.mean(false_positives),
-                "std": np.std(false_positives),
-                "max": np.amax(false_positives),
-                "count": false_positives.size,
-                "median": np.median(false_positives),
-            }
-        except ValueError:
-            assert np.sum(mask) == 0
-            stats = {
-                "mean": np.mean(false_positives),
-                "std": np.std(false_positives),
-                "max": 0,
-                "count": false_positives.size,
-                "median": np.median(false_positives),
-            }
-
-        return stats
-
-    def acc_false_negatives(self):
-        mask = np.invert(self.truth_clefts_mask)
-        false_negatives = self.test_clefts_edt[mask]
-        stats = {
-            "mean": np.mean(false_negatives),
-            "std": np.std(false_negatives),
-            "max": np.amax(false_negatives),
-            "count": false_negatives.size,
-            "median": np.median(false_negatives),
-        }
-        return stats
+from utils.cleft_evaluation import Clefts, CleftTruth
+from utils.results_store import ResultsStore
 
 
 def bbox2_ND(img):
@@ -117,6 +40,8 @@ def run_evaluation(experiment_name, scale=200):
         s_val = np.s_[z_min : z_max + 1, y_min : y_max + 1, x_min : x_max + 1]
         truth_val = truth[s_val]
         mask_val = mask_val[s_val]
+        # the ground truth side of the evaluation is shared by all iterations
+        truth_clefts_val = CleftTruth(truth_val, np.logical_not(mask_val))
 
         # mask_train = np.array(mask_train[:].astype(np.bool))
         # x_min, x_max, y_min, y_max, z_min, z_max = bbox2_ND(mask_train)
@@ -151,9 +76,7 @@ def run_evaluation(experiment_name, scale=200):
                 print(
                     "quick shape test", test_val.shape, truth_val.shape, mask_val.shape
                 )
-                cleft_eval = Clefts(
-                    test_val, truth_val, np.logical_not(mask_val), scale=scale
-                )
+                cleft_eval = Clefts(test_val, truth_clefts_val, scale=scale)
                 v_res = dict()
                 v_res["v_fn"] = cleft_eval.count_false_negatives()
                 v_res["v_fp"] = cleft_eval.count_false_positives()
@@ -168,6 +91,13 @@ def run_evaluation(experiment_name, scale=200):
                     v_res["v_dgt"],
                 )
 
+                ResultsStore().add(
+                    "validation_saturated_s{0:}".format(scale),
+                    v_res,
+                    experiment="miccai_experiments/" + experiment_name,
+                    sample=sample,
+                    iteration=iteration,
+                )
                 with open(validation_json, "w") as f:
                     json.dump(v_res, f)
                 del test_val, v_res
@@ -5,6 +5,7 @@ import matplotlib.table as tab
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
 import matplotlib.lines as mlines
+from utils.results_store import ResultsStore
 
 iterations = range(30000, 150000, 2000)
 colors = {
@@ -20,26 +21,58 @@ linestyles = {
 }
 
 
-def load_result(data_train, augmentation, data_eval, iteration, mode):
-    result_json = os.path.join(
-        "/nrs/saalfeld/heinrichl/synapses/data_and_augmentations",
-        data_train,
-        augmentation,
-        "evaluation",
-        str(iteration),
-        data_eval,
-        "cleft.{0:}.json".format(mode),
+# cleft results per sweep, by (iteration, mode) and sample
+sweeps = dict()
+
+
+def load_sweep(data_train, augmentation, data_eval):
+    # all iterations of a sweep are loaded from the results store in one query
+    if (data_train, augmentation, data_eval) not in sweeps:
+        sweep = dict()
+        reports = ResultsStore().reports(
+            report="cleft",
+            experiment=data_train,
+            augmentation=augmentation,
+            data_eval=data_eval,
+        )
+        for key, results in reports.items():
+            sample, iteration, mode = key[-3:]
+            sweep.setdefault((iteration, mode), dict())[sample] = results
+        sweeps[(data_train, augmentation, data_eval)] = sweep
+    return sweeps[(data_train, augmentation, data_eval)]
+
+
+def load_result(data_train, augmentation, data_eval, iteration, mode, samples=()):
+    # results per sample, from the results store and for samples that are missing there from the json files. None if
+    # any of samples has no result in either.
+    result = dict(
+        load_sweep(data_train, augmentation, data_eval).get((iteration, mode), dict())
     )
-    try:
-        with open(result_json, "r") as f:
-            resdict = json.load(f)
-    except IOError:
+    if len(result) == 0 or any(s not in result for s in samples):
+        # results that were only written to json files
+        result_json = os.path.join(
+            "/nrs/saalfeld/heinrichl/synapses/data_and_augmentations",
+            data_train,
+            augmentation,
+            "evaluation",
+            str(iteration),
+            data_eval,
+            "cleft.{0:}.json".format(mode),
+        )
+        try:
+            with open(result_json, "r") as f:
+                resdict = json.load(f)
+        except IOError:
+            resdict = dict()
+        for s, r in resdict.items():
+            result.setdefault(s, r)
+    if len(result) == 0 or any(s not in result for s in samples):
         return None
-    return resdict
+    return result
 
 
 def compute_cremi_score(samples, data_train, augmentation, data_eval, iteration, mode):
-    result = load_result(data_train, augmentation, data_eval, iteration, mode)
+    result = load_result(data_train, augmentation, data_eval, iteration, mode, samples)
     if result is None:
         return np.nan
     score = 0.0
@@ -55,7 +88,7 @@ def compute_cremi_score(samples, data_train, augmentation, data_eval, iteration,
 def compute_cremi_score_err(
     samples, data_train, augmentation, data_eval, iteration, mode
 ):
-    result = load_result(data_train, augmentation, data_eval, iteration, mode)
+    result = load_result(data_train, augmentation, data_eval, iteration, mode, samples)
     if result.isnan():
         return result
     err = 0.0